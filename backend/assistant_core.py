@@ -1,36 +1,95 @@
-from typing import List
-from nltk.metrics import edit_distance
-import json, re, os, asyncio
-from models import Chat as ChatModel, ChatStage, Work as WorkModel
+from typing import Iterable, List
+import json, os, asyncio, difflib
+from models import Chat as ChatModel, ChatStage, Work as WorkModel, ExtractedText as ExtractedTextModel
 from sqlmodel import Session
-import PyPDF2
-import docx # python-docx
+from sqlalchemy.exc import IntegrityError
+from database import engine
 from pathlib import Path
-from io import BytesIO
-from model_utils import generate_once_mistral
-
-
-# Извлечение текста из PDF / DOCX / TXT
-def extract_text(file_data: bytes, filename: str) -> str:
-    ext = Path(filename).suffix.lower() # Приведение расширения к нижнему регистру
-    try:
-        if ext == ".pdf":
-            pdf = PyPDF2.PdfReader(BytesIO(file_data), strict=False)
-            raw = "\n".join(page.extract_text() or "" for page in pdf.pages)
-        elif ext in {".docx", ".doc"}:
-            doc = docx.Document(BytesIO(file_data))
-            raw = "\n".join(p.text for p in doc.paragraphs)
-        elif ext in {".txt", ".md"}:
-            raw = file_data.decode("utf-8", errors="ignore")
-        else:
-            raise ValueError(f"Неподдерживаесый типа файла: {ext}")
-    except Exception as error:
-        raise RuntimeError(f"Произошла ошибка извлечения текста из файла {filename}: {error}")
-    
-    # нормализация
-    cleaned = re.sub(r"[ \t]+", " ", raw)
-    cleaned = re.sub(r"\s*\n\s*", "\n", cleaned)
-    return cleaned.strip()
+from starlette.concurrency import run_in_threadpool
+from model_utils import generate_answer, count_tokens
+from json_grammar import extract_json
+from extraction import extract_text, extract_text_async
+from storage import blob_store
+import telemetry
+
+
+# Проверка длинных отчётов по частям (map-reduce)
+CHECK_CHUNK_TOKENS      = int(os.getenv("CHECK_CHUNK_TOKENS", "3000"))     # размер части отчёта в токенах
+CHECK_CHUNK_PARALLELISM = int(os.getenv("CHECK_CHUNK_PARALLELISM", "4"))   # частей, проверяемых одновременно
+
+# Проверка исправленной работы: "diff" — модели уходят только изменённые места, "full" — обе версии целиком
+REVISION_MODE           = os.getenv("REVISION_MODE", "diff")
+REVISION_DIFF_CONTEXT   = int(os.getenv("REVISION_DIFF_CONTEXT", "2"))     # строк контекста вокруг каждого изменения
+
+
+# Схемы JSON-ответов модели (локальная генерация ограничивается ими, см. json_grammar)
+_STRINGS = {"type": "array", "items": {"type": "string"}}
+_QUESTIONS = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {"q": {"type": "string"}, "a": {"type": "string"}},
+        "required": ["q", "a"],
+    },
+}
+CHECK_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "status": {"type": "string", "enum": ["ok", "needs_fix"]},
+        "feedback": {"type": "string"},
+        "missing": _STRINGS,
+        "questions": _QUESTIONS,
+    },
+    "required": ["status", "feedback"],
+}
+CHUNK_SCHEMA = {
+    "type": "object",
+    "properties": {"done": _STRINGS, "issues": _STRINGS, "summary": {"type": "string"}},
+    "required": ["done", "issues", "summary"],
+}
+REVISION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "fixed": {"type": "boolean"},
+        "missing": _STRINGS,
+        "feedback": {"type": "string"},
+        "questions": _QUESTIONS,
+    },
+    "required": ["fixed", "feedback"],
+}
+
+
+# Версия извлечения текста: увеличить при любом изменении extraction.extract_text,
+# чтобы закэшированный в extracted_text текст пересчитался
+EXTRACTOR_VERSION = 2
+
+
+# Извлечение текста с кэшем в таблице extracted_text
+async def extract_text_cached(digest: str, filename: str) -> str:
+    """
+    То же, что extract_text для файла digest из storage.blob_store, но в пуле процессов (extraction.py),
+    а результат хранится по SHA-256 байтов файла, версии извлечения и расширению: повторные проверки,
+    доработки и перезапуски того же файла (и одинаковые документы дисциплин) не читаются и не парсятся заново.
+    """
+    ext = Path(filename).suffix.lower()
+
+    # отдельные сессии: соединение не держится, пока идёт извлечение,
+    # а ошибка вставки не откатывает изменения вызывающего
+    with Session(engine) as session:
+        cached = session.get(ExtractedTextModel, (digest, EXTRACTOR_VERSION, ext))
+        if cached is not None:
+            return cached.text
+
+    file_data = await run_in_threadpool(blob_store.read, digest)
+    text = await extract_text_async(file_data, filename)
+    with Session(engine) as session:
+        session.add(ExtractedTextModel(sha256=digest, extractor_version=EXTRACTOR_VERSION, extension=ext, text=text))
+        try:
+            session.commit()
+        except IntegrityError:
+            # тот же файл параллельно извлёк другой воркер
+            session.rollback()
+    return text
 
 
 # Один шаг проверки работы цифрового помощника
@@ -97,18 +156,105 @@ async def next_turn(chat: ChatModel, user_message: str | None, session: Session)
     return "Сессия завершена. Создайте новый чат, если нужны вопросы."
 
 
-# 1. проверка работы
-async def handle_checking_the_work_stage(chat: ChatModel, session: Session) -> str:
-    # извлекаем текст из загруженного файла
-    if not chat.document_data or not chat.document_name:
-        raise RuntimeError("Документ или имя документа не установлены для чата")
-    file_text = extract_text(chat.document_data, chat.document_name)
+# Разбор JSON из ответа модели
+def parse_json_reply(resp: str) -> dict:
+    # при ограниченной генерации ответ уже чистый JSON; обёртки markdown
+    # остаются возможны для Mistral и если ограничение пришлось снять
+    # вырезаем JSON markdown из ответа
+    text = extract_json(resp)
 
-    # получаем описание задания из работы
-    work: WorkModel = session.get(WorkModel, chat.work_id)
+    # парсим JSON
+    with telemetry.span("parse_json"):
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError as error:
+            raise RuntimeError(f"Ошибка парсинга JSON: {error}\nОтвет: {text}")
+
+
+# Разбиение отчёта на части не длиннее max_tokens
+def split_into_chunks(text: str | Iterable[str], max_tokens: int) -> List[str]:
+    """text — строка или поток абзацев (например, extraction.iter_text): он читается лениво"""
+    chunks, current, current_tokens = [], [], 0
+    paragraphs = text.split("\n") if isinstance(text, str) else text
+    for paragraph in paragraphs:
+        tokens = count_tokens(paragraph)
+        # слишком длинный абзац режем по словам
+        if tokens > max_tokens:
+            words = paragraph.split(" ")
+            step = max(1, len(words) * max_tokens // tokens)
+            pieces = [" ".join(words[i:i + step]) for i in range(0, len(words), step)]
+        else:
+            pieces = [paragraph]
+
+        for piece in pieces:
+            piece_tokens = count_tokens(piece) if len(pieces) > 1 else tokens
+            if current and current_tokens + piece_tokens > max_tokens:
+                chunks.append("\n".join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+# Проверка длинного отчёта по частям
+async def evaluate_in_chunks(file_text: str, work: WorkModel) -> dict:
+    """
+    Map: части отчёта проверяются параллельно (не больше CHECK_CHUNK_PARALLELISM
+    одновременно), по каждой модель возвращает выполненные пункты задания и ошибки.
+    Reduce: короткий запрос сводит частичные вердикты в обычный JSON
+    со status / feedback / missing / questions.
+    """
     expected_task = work.task or ""
-    
-    # формируем промпт для оценки правильности
+    with telemetry.span("split_chunks"):
+        chunks = split_into_chunks(file_text, CHECK_CHUNK_TOKENS)
+
+    map_prefix = (
+        "Ты выступаешь в роли цифрового преподавателя и проверяешь ФРАГМЕНТ отчёта студента. "
+        f"Описание задания: {expected_task}\n"
+        "Определи, какие пункты задания выполнены в этом фрагменте, и какие ошибки в нём есть. "
+        "Не считай недоработкой то, чего нет во фрагменте: остальные части отчёта проверяются отдельно. "
+        "Верни объект JSON с ключами: "
+        "'done' (массив выполненных пунктов задания), "
+        "'issues' (массив найденных ошибок), "
+        "'summary' (одно предложение о содержании фрагмента).\n\n"
+        "Фрагмент отчета:\n"
+    )
+    semaphore = asyncio.Semaphore(CHECK_CHUNK_PARALLELISM)
+
+    async def check_chunk(chunk: str) -> dict:
+        async with semaphore:
+            resp = await generate_answer(chunk, prefix=map_prefix, cache_key=f"work:{work.id}:chunk", use_cache=True, schema=CHUNK_SCHEMA)
+        return parse_json_reply(resp)
+
+    partials = await asyncio.gather(*(check_chunk(chunk) for chunk in chunks))
+
+    verdicts = "\n\n".join(
+        f"Фрагмент {i}:\n"
+        f"- содержание: {partial.get('summary', '')}\n"
+        f"- выполнено: {'; '.join(map(str, partial.get('done', []) or [])) or 'нет'}\n"
+        f"- ошибки: {'; '.join(map(str, partial.get('issues', []) or [])) or 'нет'}"
+        for i, partial in enumerate(partials, start=1)
+    )
+    reduce_prefix = (
+        "Ты выступаешь в роли цифрового преподавателя. Отчёт студента проверен по фрагментам, ниже — итоги по каждому. "
+        f"Описание задания: {expected_task}\n"
+        "Сведи итоги и реши, выполнено ли задание целиком: пункт выполнен, если он выполнен хотя бы в одном фрагменте. "
+        "Верни объект JSON с ключами: "
+        "'status' ('ok' или 'needs_fix'), "
+        "'feedback' (краткое описание строки), "
+        "'missing' (массив строк, необязательно), "
+        "'questions' (массив из {'q','a'}, только если статус 'ok').\n\n"
+        "Итоги по фрагментам:\n"
+    )
+    resp = await generate_answer(verdicts, prefix=reduce_prefix, cache_key=f"work:{work.id}:reduce", use_cache=True, schema=CHECK_SCHEMA)
+    return parse_json_reply(resp)
+
+
+# Постоянная для работы часть промпта проверки — её KV-кэш переиспользуется локальной моделью,
+# после неё идёт текст отчёта
+def check_prompt_prefix(expected_task: str) -> str:
     system_prompt = (
         "Ты выступаешь в роли цифрового преподавателя. Оцени работу студента. Проверь, выполнено ли студентом задание, описанное ниже. "
         f"Описание задания: {expected_task}\n"
@@ -119,25 +265,37 @@ async def handle_checking_the_work_stage(chat: ChatModel, session: Session) -> s
         "'missing' (массив строк, необязательно), "
         "'questions' (массив из {'q','a'}, только если статус 'ok')."
     )
-    user_prompt = (
+    return (
+        system_prompt + "\n\n"
         f"Описание задания: {expected_task}\n"
-        f"Текст отчета:\n{file_text}"
+        "Текст отчета:\n"
     )
-    full_prompt = system_prompt + "\n\n" + user_prompt
-    # запрос к модели
-    resp = await generate_once_mistral(full_prompt)
 
-    # вырезаем JSON markdown из ответа
-    text = resp.strip()
-    if match := re.search(r"```(?:json)?\n([\s\S]*?)```", text):
-        text = match.group(1).strip()
-    text = re.sub(r"^json\s*", "", text, flags=re.IGNORECASE).strip()
 
-    # парсим JSON
-    try:
-        result = json.loads(text)
-    except json.JSONDecodeError as error:
-        raise RuntimeError(f"Ошибка парсинга JSON: {error}\nОтвет: {text}")
+# 1. проверка работы
+# Обработчики проверки не фиксируют сессию: новый этап чата, сообщение ассистента
+# и отметка о завершении задачи фиксируются вместе в jobs.JobRunner._run
+async def handle_checking_the_work_stage(chat: ChatModel, session: Session) -> str:
+    # извлекаем текст из загруженного файла
+    if not chat.document_sha256 or not chat.document_name:
+        raise RuntimeError("Документ или имя документа не установлены для чата")
+    with telemetry.span("extract_text"):
+        file_text = await extract_text_cached(chat.document_sha256, chat.document_name)
+
+    # получаем описание задания из работы
+    work: WorkModel = session.get(WorkModel, chat.work_id)
+    expected_task = work.task or ""
+    
+    # формируем промпт для оценки правильности
+    with telemetry.span("build_prompt"):
+        prompt_prefix = check_prompt_prefix(expected_task)
+        is_long = count_tokens(file_text) > CHECK_CHUNK_TOKENS
+    # длинный отчёт проверяем по частям, короткий — одним запросом
+    if is_long:
+        result = await evaluate_in_chunks(file_text, work)
+    else:
+        resp = await generate_answer(file_text, prefix=prompt_prefix, cache_key=f"work:{work.id}:check", use_cache=True, schema=CHECK_SCHEMA)
+        result = parse_json_reply(resp)
     status = result.get('status')
     feedback = result.get('feedback', '')
     missing = result.get('missing', []) or []
@@ -155,7 +313,7 @@ async def handle_checking_the_work_stage(chat: ChatModel, session: Session) -> s
             message += "\n\nНедоработки:" + "\n" + "\n".join(f"- {item}" for item in missing)
         chat.stage = ChatStage.RETURNED_FOR_REVISION
         session.add(chat)
-        session.commit()
+        session.flush()
         return message
     
 
@@ -165,61 +323,92 @@ async def handle_checking_the_work_stage(chat: ChatModel, session: Session) -> s
     chat.meta = json.dumps({'status': 'ok', 'feedback': feedback, 'questions': questions})
     chat.stage = ChatStage.DIALOGUE
     chat.current_q = 0
-    session.add(chat); session.commit()
+    session.add(chat); session.flush()
     first_q = questions[0]['q'] if questions else 'Опишите, что вы сделали в работе.'
     return f"✅ В работе нет недочетов ({feedback}). Начинаем самопроверку:\n\nВопрос 1: {first_q}"
 
 
-# 2. проверка исправленной работы
-async def handle_checking_the_corrected_work_stage(chat: ChatModel, session: Session) -> str:
-    # извлекаем текст из загруженного файла
-    if not chat.document_data or not chat.document_name:
-        raise RuntimeError("Документ или имя документа не установлены для чата")
-    new_text = extract_text(chat.document_data, chat.document_name)
+# Изменения между версиями отчёта в формате unified diff
+def revision_diff(old_text: str, new_text: str, context: int = REVISION_DIFF_CONTEXT) -> str:
+    lines = difflib.unified_diff(
+        old_text.split("\n"),
+        new_text.split("\n"),
+        fromfile="старая версия",
+        tofile="новая версия",
+        lineterm="",
+        n=context,
+    )
+    return "\n".join(lines)
 
-    # достаём сохранённый в chat.meta старый результат с missing и оригинальный текст
-    data = json.loads(chat.meta)
-    original_excerpt = data.get('original_excerpt', '') # Данные предыдущей загруженной работы
-    missing = data.get('missing', []) # Недоработки
 
-    # получаем описание задания из работы
-    work: WorkModel = session.get(WorkModel, chat.work_id)
-    expected_task = work.task or ""
-    
-    # промпт сравнения
+# Промпт проверки исправленной работы: (постоянная для работы часть, часть конкретного студента, фактический режим)
+def revision_prompts(expected_task: str, missing: List[str], original_excerpt: str, new_text: str, mode: str = REVISION_MODE) -> tuple[str, str, str]:
+    missing_list = "\n".join(f"- {m}" for m in missing) + "\n\n"
+    if mode == "diff":
+        diff = revision_diff(original_excerpt, new_text)
+        # при сплошной переработке diff не короче самого текста — тогда отправляем версии целиком
+        if len(diff) < len(original_excerpt) + len(new_text):
+            system_prompt = (
+                "Ты — цифровой преподаватель. "
+                "Описание задания:\n" + expected_task + "\n\n"
+                "Студент загрузил исправленную версию отчёта. Тебе показаны только изменения "
+                "относительно старой версии в формате unified diff: строки с '-' удалены, "
+                "строки с '+' добавлены, строки с пробелом в начале не менялись и даны для контекста. "
+                "Проверь, были ли устранены недоработки, перечисленные ниже. "
+                "Верни строго JSON с полями:\n"
+                "  fixed: true или false,\n"
+                "  missing: [массив оставшихся недоработок],\n"
+                "  feedback: \"краткий комментарий\".\n"
+                "  questions: (массив из {'q','a'}, только если fixed = true).\n\n"
+                "Ранее ты нашёл в этой работе следующие недоработки в отчете:\n"
+            )
+            user_prompt = missing_list + "Изменения в отчёте:\n" + (diff or "(изменений нет)")
+            return system_prompt, user_prompt, "diff"
+
     system_prompt = (
         "Ты — цифровой преподаватель. "
         "Описание задания:\n" + expected_task + "\n\n"
-        "Ранее ты нашёл в этой работе следующие недоработки в отчете:\n" +
-        "\n".join(f"- {m}" for m in missing) +
-        "\nТеперь студент загрузил исправленную версию. "
-        "Проверь, были ли эти недоработки устранены. "
+        "Студент загрузил исправленную версию отчёта. "
+        "Проверь, были ли устранены недоработки, перечисленные ниже. "
         "Верни строго JSON с полями:\n"
         "  fixed: true или false,\n"
         "  missing: [массив оставшихся недоработок],\n"
         "  feedback: \"краткий комментарий\".\n"
-        "  questions: (массив из {'q','a'}, только если fixed = true).\n"
+        "  questions: (массив из {'q','a'}, только если fixed = true).\n\n"
+        "Ранее ты нашёл в этой работе следующие недоработки в отчете:\n"
     )
     user_prompt = (
+        missing_list +
         "Старая версия отчёта:\n" + original_excerpt + "\n\n"
         "Новая версия отчёта:\n" + new_text
     )
-    full_prompt = system_prompt + "\n\n" + user_prompt
-    # запрос к модели
-    resp = await generate_once_mistral(full_prompt)
+    return system_prompt, user_prompt, "full"
 
-    # вырезаем JSON markdown из ответа
-    text = resp.strip()
-    if match := re.search(r"```(?:json)?\n([\s\S]*?)```", text):
-        text = match.group(1).strip()
-    text = re.sub(r"^json\s*", "", text, flags=re.IGNORECASE).strip()
 
-    # парсим JSON
-    try:
-        result = json.loads(text)
-    except json.JSONDecodeError as error:
-        raise RuntimeError(f"Ошибка парсинга JSON: {error}\nОтвет: {text}")
+# 2. проверка исправленной работы
+async def handle_checking_the_corrected_work_stage(chat: ChatModel, session: Session) -> str:
+    # извлекаем текст из загруженного файла
+    if not chat.document_sha256 or not chat.document_name:
+        raise RuntimeError("Документ или имя документа не установлены для чата")
+    with telemetry.span("extract_text"):
+        new_text = await extract_text_cached(chat.document_sha256, chat.document_name)
+
+    # достаём сохранённый в chat.meta старый результат с missing и оригинальный текст
+    data = json.loads(chat.meta)
+    original_excerpt = data.get('original_excerpt', '') # Данные предыдущей загруженной работы
+    missing = data.get('missing', []) # Недоработки
+
+    # получаем описание задания из работы
+    work: WorkModel = session.get(WorkModel, chat.work_id)
+    expected_task = work.task or ""
     
+    # промпт сравнения: сначала постоянная для работы часть, затем недоработки и изменения конкретного студента
+    with telemetry.span("build_prompt"):
+        system_prompt, user_prompt, mode = revision_prompts(expected_task, missing, original_excerpt, new_text)
+    # запрос к модели; у режимов разная постоянная часть промпта, поэтому и разный ключ её кэша
+    resp = await generate_answer(user_prompt, prefix=system_prompt, cache_key=f"work:{work.id}:revision:{mode}", use_cache=True, schema=REVISION_SCHEMA)
+    result = parse_json_reply(resp)
+
     fixed = result.get("fixed", False)
     still_missing = result.get("missing", [])
     
@@ -231,7 +420,7 @@ async def handle_checking_the_corrected_work_stage(chat: ChatModel, session: Ses
         })
         chat.stage = ChatStage.RETURNED_FOR_REVISION
         session.add(chat)
-        session.commit()
+        session.flush()
         return "❌ Всё ещё есть недоработки:\n" + "\n".join(f"- {m}" for m in still_missing)
         
     # если fixed==true — запустить Q&A
@@ -244,5 +433,5 @@ async def handle_checking_the_corrected_work_stage(chat: ChatModel, session: Ses
     chat.stage = ChatStage.DIALOGUE
     chat.current_q = 0
     session.add(chat)
-    session.commit()
+    session.flush()
     return f"✅ Всё исправлено ({result['feedback']}). Начинаем самопроверку:\n\nВопрос 1: {questions[0]['q']}"
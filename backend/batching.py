@@ -0,0 +1,226 @@
+import asyncio
+import os
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from threading import Condition, Thread
+from typing import Callable, List, Optional
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+from model_utils import load_model, MAX_NEW_TOKENS, TEMPERATURE, TOP_P
+
+
+# Параметры планировщика
+BATCH_MAX_SIZE    = int(os.getenv("BATCH_MAX_SIZE", "8"))          # максимум последовательностей в батче
+BATCH_MAX_WAIT    = float(os.getenv("BATCH_MAX_WAIT", "0.02"))     # сколько ждать попутчиков для пустого батча, сек
+BATCH_ADMIT_EVERY = int(os.getenv("BATCH_ADMIT_EVERY", "16"))      # как часто (в шагах декодирования) впускать новые запросы
+BATCH_ADMIT_DELAY = float(os.getenv("BATCH_ADMIT_DELAY", "0.1"))   # сколько может копиться очередь, пока не заполнит свободные места, сек
+
+
+@dataclass
+class _Request:
+    prompt: str
+    max_new_tokens: int
+    future: Future
+    prompt_ids: List[int] = field(default_factory=list)   # токенизирует фоновый поток
+    generated: List[int] = field(default_factory=list)
+    enqueued_at: float = field(default_factory=time.perf_counter)
+
+    @property
+    def remaining(self) -> int:
+        return self.max_new_tokens - len(self.generated)
+
+
+class _RoundStop(StoppingCriteria):
+    """
+    Останавливает строки батча по их собственному лимиту токенов и прерывает
+    весь раунд на границе шага, если в очереди ждут запросы и для них есть место.
+    """
+    def __init__(self, scheduler: "BatchScheduler", batch: List[_Request], start_len: int, eos_token_id: int):
+        self.scheduler = scheduler
+        self.batch = batch
+        self.start_len = start_len
+        self.eos_token_id = eos_token_id
+        self.remaining = torch.tensor([req.remaining for req in batch])
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        step = input_ids.shape[1] - self.start_len
+        done = step >= self.remaining.to(input_ids.device)
+        done |= (input_ids[:, self.start_len:] == self.eos_token_id).any(dim=1)
+
+        if step % self.scheduler.admit_every == 0:
+            free_slots = self.scheduler.max_batch_size - len(self.batch) + int(done.sum())
+            if free_slots > 0 and self.scheduler.should_admit(free_slots):
+                return torch.ones_like(done)
+        return done
+
+
+class BatchScheduler:
+    """
+    Планировщик непрерывного батчинга для локальной Gemma.
+
+    Запросы складываются в очередь, фоновый поток собирает их в батч
+    (с левым паддингом) и генерирует одним вызовом mdl.generate.
+    Модель загружает и промпты токенизирует тоже фоновый поток, так что
+    submit не блокирует вызывающего (в том числе цикл событий).
+    Каждые admit_every шагов декодирования раунд прерывается, если
+    в очереди кто-то ждёт: завершённые строки отдают результат в свой
+    Future, а незавершённые продолжают в следующем раунде вместе с
+    новыми запросами (префикс пересчитывается заново).
+
+    Пересчёт префиксов всех строк — цена каждого впуска, поэтому раунд
+    прерывается, только когда ждущих хватает на все свободные места
+    или самый старый из них ждёт дольше admit_delay.
+    """
+    def __init__(
+        self,
+        loader: Callable = load_model,
+        max_batch_size: int = BATCH_MAX_SIZE,
+        max_wait: float = BATCH_MAX_WAIT,
+        admit_every: int = BATCH_ADMIT_EVERY,
+        max_new_tokens: int = MAX_NEW_TOKENS,
+        admit_delay: float = BATCH_ADMIT_DELAY,
+    ):
+        self.loader = loader
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.admit_every = max(1, admit_every)
+        self.admit_delay = admit_delay
+        self.max_new_tokens = max_new_tokens
+
+        self._waiting: deque[_Request] = deque()
+        self._cond = Condition()
+        self._closed = False
+        self._thread = Thread(target=self._loop, name="batch-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, prompt: str, max_new_tokens: Optional[int] = None) -> Future:
+        """Ставит промпт в очередь и возвращает Future с текстом ответа"""
+        if self._closed:
+            raise RuntimeError("Планировщик остановлен")
+        request = _Request(
+            prompt=prompt,
+            max_new_tokens=max_new_tokens or self.max_new_tokens,
+            future=Future(),
+        )
+        with self._cond:
+            self._waiting.append(request)
+            self._cond.notify()
+        return request.future
+
+    def has_waiting(self) -> bool:
+        return bool(self._waiting)
+
+    def should_admit(self, free_slots: int) -> bool:
+        """Стоит ли прервать раунд ради ждущих запросов (вызывается из фонового потока)"""
+        if not self._waiting:
+            return False
+        # из очереди забирает только фоновый поток, поэтому _waiting[0] не исчезнет
+        return len(self._waiting) >= free_slots or time.perf_counter() - self._waiting[0].enqueued_at >= self.admit_delay
+
+    def close(self):
+        """Останавливает фоновый поток; ждущие запросы получают ошибку"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        while self._waiting:
+            self._waiting.popleft().future.set_exception(RuntimeError("Планировщик остановлен"))
+
+    # Фоновый цикл
+    def _loop(self):
+        active: List[_Request] = []
+        while True:
+            with self._cond:
+                while not self._closed and not self._waiting and not active:
+                    self._cond.wait()
+                if self._closed:
+                    for req in active:
+                        req.future.set_exception(RuntimeError("Планировщик остановлен"))
+                    return
+
+            # пустой батч: даём немного времени собраться попутчикам
+            if not active and len(self._waiting) < self.max_batch_size and self.max_wait > 0:
+                time.sleep(self.max_wait)
+
+            with self._cond:
+                while self._waiting and len(active) < self.max_batch_size:
+                    req = self._waiting.popleft()
+                    # отменённые до начала генерации запросы пропускаем
+                    if req.future.set_running_or_notify_cancel():
+                        active.append(req)
+            if not active:
+                continue
+
+            try:
+                active = self._run_round(active)
+            except Exception as error:
+                for req in active:
+                    req.future.set_exception(error)
+                active = []
+
+    def _run_round(self, batch: List[_Request]) -> List[_Request]:
+        """Один раунд генерации; возвращает незавершённые запросы"""
+        tok, mdl = self.loader()
+        pad_id = tok.pad_token_id if tok.pad_token_id is not None else tok.eos_token_id
+        for req in batch:
+            if not req.prompt_ids:
+                req.prompt_ids = tok(req.prompt)["input_ids"]
+
+        sequences = [req.prompt_ids + req.generated for req in batch]
+        width = max(len(seq) for seq in sequences)
+        input_ids = torch.full((len(batch), width), pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), width), dtype=torch.long)
+        for row, seq in enumerate(sequences):
+            input_ids[row, width - len(seq):] = torch.tensor(seq, dtype=torch.long)
+            attention_mask[row, width - len(seq):] = 1
+
+        stop = _RoundStop(self, batch, width, tok.eos_token_id)
+        with torch.no_grad():
+            out_ids = mdl.generate(
+                input_ids=input_ids.to(mdl.device),
+                attention_mask=attention_mask.to(mdl.device),
+                max_new_tokens=max(req.remaining for req in batch),
+                temperature=TEMPERATURE,
+                top_p=TOP_P,
+                eos_token_id=tok.eos_token_id,
+                pad_token_id=pad_id,
+                stopping_criteria=StoppingCriteriaList([stop]),
+            )
+
+        unfinished = []
+        for row, req in enumerate(batch):
+            finished = False
+            for token_id in out_ids[row, width:].tolist()[:req.remaining]:
+                if token_id == tok.eos_token_id:
+                    finished = True
+                    break
+                if token_id == pad_id:
+                    break
+                req.generated.append(token_id)
+
+            if finished or req.remaining <= 0:
+                req.future.set_result(tok.decode(req.generated, skip_special_tokens=True))
+            else:
+                unfinished.append(req)
+        return unfinished
+
+
+# Один планировщик на процесс
+_scheduler: Optional[BatchScheduler] = None
+
+
+def get_scheduler() -> BatchScheduler:
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = BatchScheduler()
+    return _scheduler
+
+
+async def generate_batched(prompt: str) -> str:
+    """
+    То же, что generate_once, но через общий планировщик батчей.
+    Не занимает поток из пула на всё время генерации.
+    """
+    return await asyncio.wrap_future(get_scheduler().submit(prompt))
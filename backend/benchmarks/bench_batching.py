@@ -0,0 +1,105 @@
+"""
+Сравнение генерации по одному запросу (generate_once в пуле потоков)
+и через планировщик непрерывного батчинга (batching.BatchScheduler).
+
+Запуск из каталога backend:
+    python -m benchmarks.bench_batching --tiny --requests 32 --concurrency 8
+"""
+import argparse
+import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+import model_utils
+from batching import BatchScheduler
+
+
+PROMPTS = [
+    "Описание задания: реализовать сортировку массива. Текст отчета: реализована быстрая сортировка.",
+    "Оцени работу студента. Верни объект JSON с ключами status, feedback, missing, questions.",
+    "Текст отчета: в работе приведены тесты и графики, выводы отсутствуют.",
+    "Описание задания: оценить сложность алгоритма.",
+]
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(name, latencies, elapsed):
+    return {
+        "mode": name,
+        "requests": len(latencies),
+        "requests_per_sec": len(latencies) / elapsed,
+        "latency_mean": statistics.mean(latencies),
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+    }
+
+
+def run_per_request(prompts, concurrency):
+    """Текущий путь: каждый запрос — отдельный mdl.generate в своём потоке"""
+    def one(prompt):
+        start = time.perf_counter()
+        model_utils.generate_once(prompt)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = list(pool.map(one, prompts))
+    return summarize("per_request", latencies, time.perf_counter() - start)
+
+
+def run_batched(prompts, concurrency, loader, max_new_tokens):
+    """Путь через планировщик: не больше concurrency запросов в полёте"""
+    scheduler = BatchScheduler(loader=loader, max_batch_size=concurrency, max_new_tokens=max_new_tokens)
+
+    def one(prompt):
+        start = time.perf_counter()
+        scheduler.submit(prompt).result()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = list(pool.map(one, prompts))
+    elapsed = time.perf_counter() - start
+    scheduler.close()
+    return summarize("batched", latencies, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tiny", action="store_true", help="крошечная случайная Gemma вместо настоящей модели")
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--output", help="куда сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    if args.tiny:
+        from benchmarks.tiny_gemma import build_tiny_gemma
+        tiny = build_tiny_gemma()
+        model_utils.load_model = lambda: tiny
+    model_utils.MAX_NEW_TOKENS = args.max_new_tokens
+    loader = model_utils.load_model
+    loader()  # прогрев: загрузка весов не должна попадать в замер
+
+    prompts = [PROMPTS[i % len(PROMPTS)] for i in range(args.requests)]
+    results = {
+        "config": vars(args),
+        "results": [
+            run_per_request(prompts, args.concurrency),
+            run_batched(prompts, args.concurrency, loader, args.max_new_tokens),
+        ],
+    }
+
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
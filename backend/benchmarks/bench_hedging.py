@@ -0,0 +1,139 @@
+"""
+Бенчмарк хеджирования (hedging.HedgedRouter) на двух фейковых бэкендах.
+
+У каждого фейкового бэкенда логнормальная задержка с медианой --*-median
+и «хвостом»: с вероятностью --*-slow-rate ответ задерживается до --*-slow.
+Сравниваются задержки p50/p95/p99 без хеджирования (только основной) и
+с хеджированием, а также доля запросов, ушедших запасному бэкенду.
+
+Запуск из каталога backend (без сети и моделей):
+    python -m benchmarks.bench_hedging --requests 500 --concurrency 16
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from hedging import HedgedRouter
+
+
+class FakeBackend:
+    """Асинхронный бэкенд с настраиваемой задержкой и долей ошибок"""
+    def __init__(self, name: str, median: float, sigma: float, slow_rate: float, slow: float, error_rate: float, seed: int):
+        self.name = name
+        self.median = median
+        self.sigma = sigma
+        self.slow_rate = slow_rate
+        self.slow = slow
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.cancelled = 0
+
+    def latency(self) -> float:
+        if self.random.random() < self.slow_rate:
+            return self.slow
+        return self.median * self.random.lognormvariate(0, self.sigma)
+
+    async def __call__(self, prompt: str) -> str:
+        self.calls += 1
+        delay, fail = self.latency(), self.random.random() < self.error_rate
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if fail:
+            raise RuntimeError(f"{self.name}: ошибка")
+        return f"{self.name}: ответ на «{prompt}»"
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def run(call, requests: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await call(f"запрос {i}")
+            except Exception:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return {
+        "ok": len(latencies),
+        "errors": errors,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+    }
+
+
+def make_backends(args, seed: int):
+    primary = FakeBackend("primary", args.primary_median, args.sigma, args.primary_slow_rate, args.primary_slow, args.primary_error_rate, seed)
+    secondary = FakeBackend("secondary", args.secondary_median, args.sigma, args.secondary_slow_rate, args.secondary_slow, 0.0, seed + 1)
+    return primary, secondary
+
+
+async def main_async(args) -> dict:
+    primary, _ = make_backends(args, args.seed)
+    baseline = await run(primary, args.requests, args.concurrency)
+
+    primary, secondary = make_backends(args, args.seed)
+    router = HedgedRouter(
+        {"primary": primary, "secondary": secondary},
+        primary="primary",
+        secondary="secondary",
+        quantile=args.quantile,
+        initial_delay=args.initial_delay,
+        min_delay=0.0,
+        min_samples=args.min_samples,
+    )
+    hedged = await run(router.generate, args.requests, args.concurrency)
+    hedged.update({
+        "router": router.stats(),
+        "secondary_calls": secondary.calls,
+        "extra_load": secondary.calls / args.requests,
+        "cancelled": primary.cancelled + secondary.cancelled,
+    })
+    return {"config": vars(args), "primary_only": baseline, "hedged": hedged}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--sigma", type=float, default=0.3, help="разброс логнормальной задержки")
+    parser.add_argument("--primary-median", type=float, default=0.05)
+    parser.add_argument("--primary-slow-rate", type=float, default=0.05)
+    parser.add_argument("--primary-slow", type=float, default=1.0)
+    parser.add_argument("--primary-error-rate", type=float, default=0.01)
+    parser.add_argument("--secondary-median", type=float, default=0.08)
+    parser.add_argument("--secondary-slow-rate", type=float, default=0.01)
+    parser.add_argument("--secondary-slow", type=float, default=1.0)
+    parser.add_argument("--quantile", type=float, default=95)
+    parser.add_argument("--initial-delay", type=float, default=0.2, help="задержка хеджа до накопления замеров, сек")
+    parser.add_argument("--min-samples", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="куда сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
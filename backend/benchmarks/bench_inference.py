@@ -0,0 +1,171 @@
+"""
+Бенчмарк инференса model_utils: generate_once (локальная Gemma) и
+generate_once_mistral (против локального фейкового сервера).
+
+Для каждой пары (уровень параллелизма, длина промпта) считает
+tokens/sec, time-to-first-token, задержки p50/p95/p99 и пиковый RSS.
+Замеры идут через потоковые варианты (stream_once / stream_once_mistral),
+чтобы видеть момент первого токена. Результаты пишутся в JSON,
+поэтому прогоны можно сравнивать между собой.
+
+Запуск из каталога backend (без сети, на CPU):
+    python -m benchmarks.bench_inference --backend local --tiny --output local.json
+    python -m benchmarks.bench_inference --backend mistral --output mistral.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime, timezone
+import torch
+from benchmarks.fake_mistral import serve
+
+
+WORDS = "студент реализовал алгоритм сортировки и привёл тесты графики выводы оценку сложности".split()
+
+
+def make_prompt(length: int) -> str:
+    """Промпт примерно из length слов"""
+    body = " ".join(WORDS[i % len(WORDS)] for i in range(length))
+    return f"Оцени работу студента и верни JSON.\nТекст отчета:\n{body}"
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss в Linux — килобайты
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def summarize(samples, elapsed):
+    latencies = [s["latency"] for s in samples]
+    ttfts = [s["ttft"] for s in samples if s["ttft"] is not None]
+    tokens = sum(s["tokens"] for s in samples)
+    return {
+        "requests": len(samples),
+        "completion_tokens": tokens,
+        "tokens_per_sec": tokens / elapsed if elapsed else 0.0,
+        "requests_per_sec": len(samples) / elapsed if elapsed else 0.0,
+        "ttft_mean": statistics.mean(ttfts) if ttfts else None,
+        "ttft_p95": percentile(ttfts, 95) if ttfts else None,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+# ---------- локальная модель ----------
+def run_local(model_utils, prompt, requests, concurrency):
+    tok, _ = model_utils.load_model()
+
+    def one(_):
+        start = time.perf_counter()
+        ttft, parts = None, []
+        for text in model_utils.stream_once(prompt):
+            if ttft is None:
+                ttft = time.perf_counter() - start
+            parts.append(text)
+        latency = time.perf_counter() - start
+        tokens = len(tok("".join(parts), add_special_tokens=False)["input_ids"])
+        return {"latency": latency, "ttft": ttft, "tokens": tokens}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        samples = list(pool.map(one, range(requests)))
+    return summarize(samples, time.perf_counter() - start)
+
+
+# ---------- Mistral ----------
+async def run_mistral(model_utils, prompt, requests, concurrency):
+    async def one(semaphore):
+        async with semaphore:
+            start = time.perf_counter()
+            ttft, parts = None, []
+            async for text in model_utils.stream_once_mistral(prompt):
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                parts.append(text)
+            latency = time.perf_counter() - start
+            return {"latency": latency, "ttft": ttft, "tokens": model_utils.count_tokens("".join(parts))}
+
+    semaphore = asyncio.Semaphore(concurrency)
+    start = time.perf_counter()
+    samples = await asyncio.gather(*(one(semaphore) for _ in range(requests)))
+    return summarize(samples, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["local", "mistral"], default="local")
+    parser.add_argument("--tiny", action="store_true", help="крошечная случайная Gemma (только для --backend local)")
+    parser.add_argument("--concurrency", default="1,2,4", help="уровни параллелизма через запятую")
+    parser.add_argument("--prompt-lengths", default="64,512", help="длины промптов в словах через запятую")
+    parser.add_argument("--requests", type=int, default=8, help="запросов на каждую комбинацию")
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--server-latency", type=float, default=0.2, help="задержка фейкового Mistral до первого токена, сек")
+    parser.add_argument("--token-latency", type=float, default=0.01, help="задержка фейкового Mistral между токенами, сек")
+    parser.add_argument("--output", help="куда сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    concurrency_levels = [int(c) for c in args.concurrency.split(",")]
+    prompt_lengths = [int(n) for n in args.prompt_lengths.split(",")]
+
+    server_ctx = serve(latency=args.server_latency, token_latency=args.token_latency) if args.backend == "mistral" else nullcontext()
+
+    with server_ctx as server:
+        if server is not None:
+            os.environ["MISTRAL_SERVER_URL"] = server.url
+        # настройки клиента Mistral читаются при импорте
+        import model_utils
+        model_utils.MAX_NEW_TOKENS = args.max_new_tokens
+        if args.backend == "local" and args.tiny:
+            from benchmarks.tiny_gemma import build_tiny_gemma
+            tiny = build_tiny_gemma()
+            model_utils.load_model = lambda: tiny
+
+        combinations = [(n, c) for n in prompt_lengths for c in concurrency_levels]
+        runs = []
+
+        def record(result, prompt_length, concurrency):
+            result.update({"concurrency": concurrency, "prompt_words": prompt_length})
+            runs.append(result)
+            print(json.dumps(result, ensure_ascii=False))
+
+        if args.backend == "local":
+            model_utils.load_model()   # загрузка весов не входит в замер
+            for prompt_length, concurrency in combinations:
+                record(run_local(model_utils, make_prompt(prompt_length), args.requests, concurrency), prompt_length, concurrency)
+        else:
+            # клиент Mistral и его семафор привязаны к одному циклу событий
+            async def run_all():
+                for prompt_length, concurrency in combinations:
+                    record(await run_mistral(model_utils, make_prompt(prompt_length), args.requests, concurrency), prompt_length, concurrency)
+            asyncio.run(run_all())
+
+    report = {
+        "backend": args.backend,
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "config": vars(args),
+        "runs": runs,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
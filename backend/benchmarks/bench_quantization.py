@@ -0,0 +1,111 @@
+"""
+Сравнение bfloat16 и динамического int8-квантования локальной модели.
+
+На фиксированном наборе промптов проверки работ (grading_prompts.json)
+обе модели генерируют ответ жадным декодированием. Скрипт сравнивает
+скорость (tokens/sec, задержка) и качество JSON-оценки int8 относительно
+bf16: долю разобранных JSON, совпадение status и пересечение missing.
+
+Запуск из каталога backend:
+    python -m benchmarks.bench_quantization --output quant.json
+    python -m benchmarks.bench_quantization --tiny      # без сети, проверка только механики
+"""
+import argparse
+import json
+import statistics
+import time
+from pathlib import Path
+import torch
+import model_utils
+from assistant_core import check_prompt_prefix, parse_json_reply
+
+
+PROMPTS_PATH = Path(__file__).with_name("grading_prompts.json")
+
+
+def generate(tok, mdl, prompt, max_new_tokens):
+    inputs = tok(prompt, return_tensors="pt").to(mdl.device)
+    start = time.perf_counter()
+    with torch.no_grad():
+        out_ids = mdl.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False, eos_token_id=tok.eos_token_id)
+    elapsed = time.perf_counter() - start
+    new_ids = out_ids[0][inputs["input_ids"].shape[1]:]
+    return tok.decode(new_ids, skip_special_tokens=True), len(new_ids), elapsed
+
+
+def parse(text):
+    try:
+        return parse_json_reply(text)
+    except RuntimeError:
+        return None
+
+
+def run(tok, mdl, prompts, max_new_tokens):
+    outputs, latencies, tokens = [], [], 0
+    for prompt in prompts:
+        text, n_tokens, elapsed = generate(tok, mdl, prompt, max_new_tokens)
+        outputs.append(parse(text))
+        latencies.append(elapsed)
+        tokens += n_tokens
+    return outputs, {
+        "tokens_per_sec": tokens / sum(latencies),
+        "latency_mean": statistics.mean(latencies),
+        "latency_max": max(latencies),
+        "json_parsed": sum(o is not None for o in outputs) / len(outputs),
+    }
+
+
+def jaccard(a, b):
+    a, b = {str(x).strip().lower() for x in a}, {str(x).strip().lower() for x in b}
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+def compare(baseline, candidate):
+    """Качество int8 относительно bf16 по тем промптам, где обе модели вернули JSON"""
+    pairs = [(b, c) for b, c in zip(baseline, candidate) if b is not None and c is not None]
+    if not pairs:
+        return {"compared": 0, "status_agreement": None, "missing_jaccard": None}
+    return {
+        "compared": len(pairs),
+        "status_agreement": sum(b.get("status") == c.get("status") for b, c in pairs) / len(pairs),
+        "missing_jaccard": statistics.mean(jaccard(b.get("missing") or [], c.get("missing") or []) for b, c in pairs),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tiny", action="store_true", help="крошечная случайная Gemma вместо настоящей модели")
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--output", help="куда сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    cases = json.loads(PROMPTS_PATH.read_text(encoding="utf-8"))
+    prompts = [check_prompt_prefix(case["task"]) + case["report"] for case in cases]
+
+    if args.tiny:
+        from benchmarks.tiny_gemma import build_tiny_gemma
+        tok, baseline_model = build_tiny_gemma(dtype=torch.bfloat16)
+        _, quantized_model = build_tiny_gemma(dtype=torch.bfloat16)
+        quantized_model = model_utils.quantize_int8(quantized_model)
+    else:
+        tok, baseline_model = model_utils.load_model_variant("none")
+        _, quantized_model = model_utils.load_model_variant("int8")
+
+    baseline_outputs, baseline_stats = run(tok, baseline_model, prompts, args.max_new_tokens)
+    quantized_outputs, quantized_stats = run(tok, quantized_model, prompts, args.max_new_tokens)
+
+    report = {
+        "config": vars(args),
+        "bf16": baseline_stats,
+        "int8": quantized_stats,
+        "speedup": quantized_stats["tokens_per_sec"] / baseline_stats["tokens_per_sec"],
+        "quality": compare(baseline_outputs, quantized_outputs),
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Размер промпта проверки исправленной работы: обе версии целиком ("full")
+против одних изменений ("diff", assistant_core.revision_prompts).
+
+Отчёт синтезируется из --paragraphs абзацев; в новой версии --edits
+случайных абзацев переписаны, а в конец добавлено --added новых.
+Токены считаются model_utils.count_tokens выбранного бэкенда
+(для Mistral — приблизительно).
+
+Запуск из каталога backend:
+    python -m benchmarks.bench_revision_prompt --paragraphs 200 --edits 5
+"""
+import argparse
+import json
+import random
+from assistant_core import revision_prompts
+from model_utils import count_tokens
+
+
+WORDS = (
+    "лабораторная работа измерение погрешность результат таблица график вывод "
+    "методика эксперимент установка значение среднее отклонение формула расчёт"
+).split()
+
+
+def paragraph(rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 60))).capitalize() + "."
+
+
+def make_versions(paragraphs: int, edits: int, added: int, seed: int) -> tuple[str, str]:
+    rng = random.Random(seed)
+    old = [paragraph(rng) for _ in range(paragraphs)]
+    new = list(old)
+    for index in rng.sample(range(paragraphs), min(edits, paragraphs)):
+        new[index] = paragraph(rng)
+    new += [paragraph(rng) for _ in range(added)]
+    return "\n".join(old), "\n".join(new)
+
+
+def measure(mode: str, task: str, missing: list[str], old: str, new: str) -> dict:
+    system_prompt, user_prompt, used = revision_prompts(task, missing, old, new, mode=mode)
+    return {
+        "mode": used,
+        "prefix_tokens": count_tokens(system_prompt),
+        "suffix_tokens": count_tokens(user_prompt),
+        "total_tokens": count_tokens(system_prompt + user_prompt),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--paragraphs", type=int, default=200)
+    parser.add_argument("--edits", type=int, default=5, help="сколько абзацев переписано")
+    parser.add_argument("--added", type=int, default=2, help="сколько абзацев добавлено в конец")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    task = "Измерить ускорение свободного падения и оценить погрешность."
+    missing = ["Нет оценки погрешности", "Нет вывода"]
+    old, new = make_versions(args.paragraphs, args.edits, args.added, args.seed)
+
+    full = measure("full", task, missing, old, new)
+    diff = measure("diff", task, missing, old, new)
+    report = {
+        "config": vars(args),
+        "full": full,
+        "diff": diff,
+        "saved_tokens": full["total_tokens"] - diff["total_tokens"],
+        "ratio": diff["total_tokens"] / full["total_tokens"],
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Проверка и замер слитого LoRA-снимка на крошечной случайной Gemma.
+
+Скрипт сохраняет случайную базовую модель и случайный LoRA-адаптер,
+прогоняет compile_merged_model, затем сравнивает логиты PeftModel и
+снимка, загруженного через mmap, и время старта обоих путей.
+
+Запуск из каталога backend:
+    python -m benchmarks.bench_snapshot
+"""
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+import torch
+from peft import LoraConfig, PeftModel, get_peft_model
+from transformers import AutoModelForCausalLM
+from benchmarks.tiny_gemma import build_tiny_gemma
+from model_utils import compile_merged_model, load_merged_snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base_dir, adapter_dir, merged_dir = (str(Path(tmp) / name) for name in ("base", "adapter", "merged"))
+
+        tokenizer, base = build_tiny_gemma()
+        base.save_pretrained(base_dir)
+
+        # адаптер со случайными (ненулевыми) весами, иначе слияние ничего не меняет
+        lora = LoraConfig(r=4, lora_alpha=8, target_modules=["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"], init_lora_weights=False)
+        get_peft_model(base, lora).save_pretrained(adapter_dir)
+        tokenizer.save_pretrained(adapter_dir)
+
+        compile_merged_model(merged_dir, base_dir, adapter_dir, dtype=torch.float32)
+
+        def load_peft():
+            model = AutoModelForCausalLM.from_pretrained(base_dir, low_cpu_mem_usage=True)
+            return PeftModel.from_pretrained(model, adapter_dir).eval()
+
+        def timed(loader):
+            times = []
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                model = loader()
+                times.append(time.perf_counter() - start)
+            return model, min(times)
+
+        peft_model, peft_time = timed(load_peft)
+        merged_model, merged_time = timed(lambda: load_merged_snapshot(merged_dir))
+
+        inputs = tokenizer("Описание задания: реализовать сортировку массива.", return_tensors="pt")
+        with torch.no_grad():
+            expected = peft_model(**inputs).logits
+            actual = merged_model(**inputs).logits
+        max_diff = (expected - actual).abs().max().item()
+
+        results = {
+            "peft_load_sec": peft_time,
+            "merged_mmap_load_sec": merged_time,
+            "max_logit_diff": max_diff,
+            "logits_match": max_diff <= args.atol,
+        }
+        print(json.dumps(results, indent=2))
+        if not results["logits_match"]:
+            raise SystemExit("Логиты слитой модели расходятся с PeftModel")
+
+
+if __name__ == "__main__":
+    main()
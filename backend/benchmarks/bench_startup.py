@@ -0,0 +1,93 @@
+"""
+Бенчмарк старта веб-воркера: время импорта main.app без доступа к сети.
+
+Импорт выполняется в отдельном процессе, где сетевые соединения запрещены
+(любая попытка подключиться — ошибка). Скрипт падает, если импорт дольше
+бюджета, если во время импорта были обращения к сети или если подтянулись
+тяжёлые ML-библиотеки (они должны грузиться только при первой генерации).
+
+Запуск из каталога backend:
+    python -m benchmarks.bench_startup --budget 3.0 --repeats 3
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+
+HEAVY_MODULES = ["torch", "transformers", "peft", "huggingface_hub", "mistralai", "PyPDF2", "docx", "nltk"]
+
+# Код дочернего процесса: блокируем сеть, импортируем приложение, отчитываемся
+CHILD = """
+import json, socket, sys, time
+
+attempts = []
+
+def blocked(*args, **kwargs):
+    attempts.append(repr(args[:2]))
+    raise OSError("Сеть запрещена во время импорта")
+
+socket.socket.connect = blocked
+socket.socket.connect_ex = blocked
+socket.create_connection = blocked
+socket.getaddrinfo = blocked
+
+start = time.perf_counter()
+from main import app
+elapsed = time.perf_counter() - start
+
+print(json.dumps({
+    "import_sec": elapsed,
+    "network_attempts": attempts,
+    "loaded_heavy_modules": [m for m in HEAVY if m in sys.modules],
+}))
+"""
+
+
+def measure() -> dict:
+    backend_dir = Path(__file__).resolve().parent.parent
+    env = dict(os.environ, HF_HUB_OFFLINE="1", TRANSFORMERS_OFFLINE="1")
+    code = f"HEAVY = {HEAVY_MODULES!r}\n" + CHILD
+    completed = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=backend_dir,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget", type=float, default=3.0, help="допустимое время импорта main.app, сек")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    runs = [measure() for _ in range(args.repeats)]
+    best = min(run["import_sec"] for run in runs)
+    report = {
+        "budget_sec": args.budget,
+        "import_sec_best": best,
+        "import_sec_all": [run["import_sec"] for run in runs],
+        "network_attempts": runs[-1]["network_attempts"],
+        "loaded_heavy_modules": runs[-1]["loaded_heavy_modules"],
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+    errors = []
+    if best > args.budget:
+        errors.append(f"импорт main.app занял {best:.2f} с при бюджете {args.budget:.2f} с")
+    if report["network_attempts"]:
+        errors.append(f"обращения к сети при импорте: {report['network_attempts']}")
+    if report["loaded_heavy_modules"]:
+        errors.append(f"при импорте загружены тяжёлые модули: {report['loaded_heavy_modules']}")
+    if errors:
+        raise SystemExit("; ".join(errors))
+
+
+if __name__ == "__main__":
+    main()
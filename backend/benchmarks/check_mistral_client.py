@@ -0,0 +1,63 @@
+"""
+Проверка пула клиента Mistral против фейкового сервера.
+
+Запускает benchmarks.fake_mistral с задержкой и долей ошибок 429/503,
+отправляет пачку одновременных запросов через model_utils.generate_once_mistral
+и проверяет, что все они завершились успешно (за счёт повторов), а сервер
+ни разу не видел больше MISTRAL_MAX_IN_FLIGHT запросов одновременно.
+
+Запуск из каталога backend:
+    python -m benchmarks.check_mistral_client --requests 50 --max-in-flight 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from benchmarks.fake_mistral import serve
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--max-in-flight", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.2)
+    parser.add_argument("--error-status", type=int, default=429)
+    args = parser.parse_args()
+
+    with serve(latency=args.latency, error_rate=args.error_rate, error_status=args.error_status) as server:
+        # настройки клиента читаются при импорте model_utils
+        os.environ["MISTRAL_SERVER_URL"] = server.url
+        os.environ["MISTRAL_MAX_IN_FLIGHT"] = str(args.max_in_flight)
+        os.environ.setdefault("MISTRAL_BACKOFF", "0.05")
+        os.environ.setdefault("MISTRAL_RETRIES", "8")
+        import model_utils
+
+        async def run():
+            return await asyncio.gather(
+                *(model_utils.generate_once_mistral(f"Запрос {i}") for i in range(args.requests)),
+                return_exceptions=True,
+            )
+
+        start = time.perf_counter()
+        results = asyncio.run(run())
+        elapsed = time.perf_counter() - start
+
+    failures = [repr(r) for r in results if isinstance(r, Exception)]
+    report = {
+        "requests": args.requests,
+        "failures": len(failures),
+        "server_requests": server.requests,
+        "server_max_in_flight": server.max_in_flight,
+        "elapsed_sec": elapsed,
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if failures:
+        raise SystemExit(f"Запросы завершились ошибкой: {failures[:3]}")
+    if server.max_in_flight > args.max_in_flight:
+        raise SystemExit("Превышен лимит одновременных запросов")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Проверка кэша KV-префиксов: ответ model_utils.generate_with_prefix должен
+совпадать с генерацией по тем же токенам без кэша (полный прогон промпта).
+
+Используется крошечная Gemma из benchmarks.tiny_gemma со скользящим окном
+64 токена, декодирование жадное. Проверяются suffix внутри окна, suffix,
+с которым промпт выходит за окно, suffix в несколько окон и префикс длиннее
+окна; каждый запрос выполняется дважды — с построением префикса и с готовым
+префиксом из кэша.
+
+Запуск из каталога backend:
+    python -m benchmarks.check_prefix_cache --max-new-tokens 24
+"""
+import argparse
+import json
+import torch
+from benchmarks.tiny_gemma import build_tiny_gemma
+import model_utils
+
+
+PREFIX = "Ты выступаешь в роли цифрового преподавателя. Оцени работу студента."
+LONG_PREFIX = PREFIX + " Описание задания: реализовать сортировку массива и оценить сложность алгоритма." * 6
+REPORT = " Текст отчета: в работе реализована быстрая сортировка, приведены тесты и графики."
+CASES = {
+    "в пределах окна": (PREFIX, " Текст отчета: реализована сортировка."),
+    "за пределами окна": (PREFIX, REPORT * 6),
+    "suffix в несколько окон": (PREFIX, REPORT * 40),
+    "префикс длиннее окна": (LONG_PREFIX, REPORT * 6),
+}
+
+
+def full_prefill(tok, mdl, prefix: str, suffix: str) -> str:
+    """Те же токены, что в generate_with_prefix, но без кэша префикса"""
+    prefix_ids = tok(prefix, return_tensors="pt")["input_ids"]
+    suffix_ids = tok(suffix, add_special_tokens=False, return_tensors="pt")["input_ids"]
+    input_ids = torch.cat([prefix_ids, suffix_ids], dim=1)
+    with torch.no_grad():
+        out_ids = mdl.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=model_utils.MAX_NEW_TOKENS,
+            eos_token_id=tok.eos_token_id,
+        )
+    return tok.decode(out_ids[0][input_ids.shape[1]:], skip_special_tokens=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-new-tokens", type=int, default=24)
+    args = parser.parse_args()
+
+    tok, mdl = build_tiny_gemma()
+    mdl.generation_config.do_sample = False     # жадное декодирование: ответы сравнимы побайтно
+    model_utils.MAX_NEW_TOKENS = args.max_new_tokens
+    model_utils.load_model = lambda: (tok, mdl)
+    model_utils.prefix_cache = model_utils.PrefixCache(64 * 1024 * 1024)
+
+    report = {"sliding_window": mdl.config.sliding_window, "cases": {}}
+    mismatches = []
+    for name, (prefix, suffix) in CASES.items():
+        expected = full_prefill(tok, mdl, prefix, suffix)
+        # первый вызов строит префикс, второй берёт его из кэша
+        answers = [model_utils.generate_with_prefix(prefix, suffix, cache_key=f"check:{name}") for _ in range(2)]
+        prefix_len = len(tok(prefix)["input_ids"])
+        input_len = prefix_len + len(tok(suffix, add_special_tokens=False)["input_ids"])
+        report["cases"][name] = {
+            "prefix_tokens": prefix_len,
+            "input_tokens": input_len,
+            "equal": [answer == expected for answer in answers],
+        }
+        if any(answer != expected for answer in answers):
+            mismatches.append(name)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if mismatches:
+        raise SystemExit(f"Ответ с кэшем префикса отличается от полного прогона: {mismatches}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Локальный фейковый сервер, повторяющий /v1/chat/completions API Mistral.
+
+Нужен, чтобы проверять клиент Mistral из model_utils (пул соединений,
+семафор, таймауты, повторы) и гонять бенчмарки без сети и ключа API:
+
+    python -m benchmarks.fake_mistral --port 8089 --latency 0.5 --error-rate 0.2
+    MISTRAL_SERVER_URL=http://127.0.0.1:8089 python -m benchmarks.bench_inference ...
+
+Сервер отвечает фиксированным текстом (или JSON оценки работы), умеет
+потоковый режим (stream=true, SSE) и с заданной вероятностью отдаёт 429/503.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_REPLY = json.dumps({
+    "status": "ok",
+    "feedback": "Задание выполнено",
+    "missing": [],
+    "questions": [{"q": "Какова сложность алгоритма?", "a": "O(n log n)"}],
+}, ensure_ascii=False)
+
+
+class FakeMistralServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, token_latency=0.0, error_rate=0.0, error_status=503, reply=DEFAULT_REPLY):
+        super().__init__(address, _Handler)
+        self.latency = latency              # задержка до первого байта, сек
+        self.token_latency = token_latency  # задержка между фрагментами в потоке, сек
+        self.error_rate = error_rate        # доля ответов с ошибкой
+        self.error_status = error_status    # 429 или 5xx
+        self.reply = reply
+        self.requests = 0
+        self.max_in_flight = 0
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: FakeMistralServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"detail": "Not found"})
+            return
+
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        with self.server._lock:
+            self.server.requests += 1
+            self.server._in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server._in_flight)
+        try:
+            time.sleep(self.server.latency)
+            if random.random() < self.server.error_rate:
+                self._send_json(self.server.error_status, {"message": "Fake error", "type": "fake"})
+                return
+            if body.get("stream"):
+                self._send_stream(body)
+            else:
+                self._send_completion(body)
+        finally:
+            with self.server._lock:
+                self.server._in_flight -= 1
+
+    def _usage(self, body):
+        prompt = " ".join(str(m.get("content", "")) for m in body.get("messages", []))
+        prompt_tokens = len(prompt.split())
+        completion_tokens = len(self.server.reply.split())
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    def _send_completion(self, body):
+        self._send_json(200, {
+            "id": uuid.uuid4().hex,
+            "object": "chat.completion",
+            "model": body.get("model", "fake"),
+            "created": int(time.time()),
+            "usage": self._usage(body),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": self.server.reply},
+                "finish_reason": "stop",
+            }],
+        })
+
+    def _send_stream(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        chunk_id = uuid.uuid4().hex
+        words = self.server.reply.split(" ")
+        for index, word in enumerate(words):
+            delta = word if index == 0 else " " + word
+            last = index == len(words) - 1
+            chunk = {
+                "id": chunk_id,
+                "object": "chat.completion.chunk",
+                "model": body.get("model", "fake"),
+                "created": int(time.time()),
+                "choices": [{
+                    "index": 0,
+                    "delta": {"role": "assistant", "content": delta},
+                    "finish_reason": "stop" if last else None,
+                }],
+            }
+            if last:
+                chunk["usage"] = self._usage(body)
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            self.wfile.flush()
+            time.sleep(self.server.token_latency)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@contextmanager
+def serve(host="127.0.0.1", port=0, **options):
+    """Запускает сервер в фоновом потоке; port=0 — любой свободный порт"""
+    server = FakeMistralServer((host, port), **options)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--token-latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    args = parser.parse_args()
+
+    server = FakeMistralServer(
+        (args.host, args.port),
+        latency=args.latency,
+        token_latency=args.token_latency,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+    )
+    print(f"Фейковый Mistral слушает {server.url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Крошечная случайно инициализированная Gemma 3 для бенчмарков без сети.
+
+Веса и токенизатор строятся на лету, поэтому скрипты из benchmarks/
+можно запускать на CPU без доступа к HuggingFace.
+"""
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import Gemma3ForCausalLM, Gemma3TextConfig, PreTrainedTokenizerFast
+
+
+SPECIAL_TOKENS = ["<pad>", "<eos>", "<bos>", "<unk>"]
+
+# Небольшой корпус, похожий на промпты проверки работ
+CORPUS = [
+    "Ты выступаешь в роли цифрового преподавателя. Оцени работу студента.",
+    "Описание задания: реализовать сортировку массива и оценить сложность алгоритма.",
+    "Текст отчета: в работе реализована быстрая сортировка, приведены тесты и графики.",
+    "Верни объект JSON с ключами status, feedback, missing, questions.",
+    '{"status": "ok", "feedback": "Работа выполнена", "missing": [], "questions": [{"q": "Что?", "a": "Ответ"}]}',
+    '{"status": "needs_fix", "feedback": "Нет выводов", "missing": ["Выводы", "Тесты"]}',
+    "The quick brown fox jumps over the lazy dog 0123456789.",
+]
+
+
+def build_tiny_tokenizer(vocab_size: int = 512) -> PreTrainedTokenizerFast:
+    """BPE-токенизатор, обученный на маленьком встроенном корпусе"""
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=SPECIAL_TOKENS,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator(CORPUS, trainer=trainer)
+
+    tokenizer.decoder = decoders.ByteLevel()
+
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        pad_token="<pad>",
+        eos_token="<eos>",
+        bos_token="<bos>",
+        unk_token="<unk>",
+        model_input_names=["input_ids", "attention_mask"],   # как у токенизатора Gemma: без token_type_ids
+    )
+
+
+def build_tiny_config(tokenizer: PreTrainedTokenizerFast, **overrides) -> Gemma3TextConfig:
+    """Конфигурация Gemma 3 в несколько сотен тысяч параметров"""
+    params = dict(
+        vocab_size=len(tokenizer),
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        num_key_value_heads=1,
+        head_dim=32,
+        sliding_window=64,
+        sliding_window_pattern=2,
+        max_position_embeddings=4096,
+        pad_token_id=tokenizer.pad_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        bos_token_id=tokenizer.bos_token_id,
+    )
+    params.update(overrides)
+    return Gemma3TextConfig(**params)
+
+
+def build_tiny_gemma(seed: int = 0, dtype: torch.dtype = torch.float32, **overrides):
+    """
+    Возвращает (tokenizer, model) в том же виде, что и model_utils.load_model().
+    """
+    torch.manual_seed(seed)
+    tokenizer = build_tiny_tokenizer()
+    config = build_tiny_config(tokenizer, **overrides)
+    model = Gemma3ForCausalLM(config).to(dtype)
+    model.generation_config.do_sample = True
+    model.generation_config.pad_token_id = tokenizer.pad_token_id
+    model.eval()
+    return tokenizer, model
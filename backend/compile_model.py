@@ -0,0 +1,22 @@
+"""
+Однократная «компиляция» модели: вливает LoRA-адаптер fine-tuned-gemma
+в базовую Gemma и сохраняет слитый safetensors-снимок.
+
+    python compile_model.py [--output fine-tuned-gemma-merged]
+
+После этого load_model() отображает снимок в память вместо загрузки
+базовой модели и PeftModel на каждом старте.
+"""
+import argparse
+from model_utils import compile_merged_model, ADAPTER_PATH, BASE_MODEL_NAME, MERGED_MODEL_PATH
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default=MERGED_MODEL_PATH)
+    parser.add_argument("--base-model", default=BASE_MODEL_NAME)
+    parser.add_argument("--adapter", default=ADAPTER_PATH)
+    args = parser.parse_args()
+
+    path = compile_merged_model(args.output, args.base_model, args.adapter)
+    print(f"Слитая модель сохранена в {path}")
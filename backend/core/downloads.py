@@ -0,0 +1,87 @@
+"""
+Отдача файлов из storage.blob_store по HTTP: потоком, с ETag (хэш
+содержимого), If-None-Match / If-Range и одним диапазоном Range.
+Браузер может докачать прерванную загрузку и не скачивать файл заново,
+если он не изменился.
+"""
+import mimetypes
+import re
+from typing import Optional
+from urllib.parse import quote
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+from storage import blob_store
+
+
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def etag_for(sha256: str) -> str:
+    return f'"{sha256}"'
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    """Слабое сравнение из If-None-Match: список меток или *"""
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+def parse_range(header: str, size: int) -> Optional[tuple[int, int]]:
+    """
+    Диапазон [start, end] (включительно) из заголовка Range.
+    None — заголовок не понят или диапазонов несколько: отдаётся весь файл.
+    ValueError — диапазон вне файла (416).
+    """
+    match = _RANGE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:                       # bytes=-N: последние N байт
+        length = int(last)
+        if length == 0:
+            raise ValueError("пустой диапазон")
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError("диапазон вне файла")
+    return start, end
+
+
+def blob_response(request: Request, sha256: str, size: int, filename: str) -> Response:
+    """Ответ 200 / 206 / 304 / 416 для файла sha256 размером size"""
+    etag = etag_for(sha256)
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        # содержимое доступно только после авторизации — в общие кэши не попадает
+        "Cache-Control": "private, no-cache",
+        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}",
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={key: headers[key] for key in ("ETag", "Cache-Control")})
+
+    media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # If-Range: диапазон отдаётся, только если у клиента та же версия файла
+    if range_header is not None and (if_range is None or if_range.strip() == etag):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{size}", "ETag": etag})
+
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(blob_store.iter_chunks(sha256), media_type=media_type, headers=headers)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(blob_store.iter_chunks(sha256, start, end + 1), status_code=206, media_type=media_type, headers=headers)
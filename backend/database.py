@@ -1,6 +1,6 @@
 from config import data
 from sqlmodel import SQLModel, Session, create_engine
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, inspect, text
 import models
 
 DATABASE_SERVER_URL = f"mysql+pymysql://{data['user']}:{data['password']}@{data['host']}:{data['port']}"
@@ -17,6 +17,15 @@ def create_database_if_not_exists():
 
 def create_tables():
     SQLModel.metadata.create_all(engine)
+    # create_all не добавляет новые индексы в уже существующие таблицы.
+    # Индексы по столбцам, которых ещё нет (их добавляет migrate_blobs.py), пропускаются
+    inspector = inspect(engine)
+    for table in SQLModel.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for index in table.indexes:
+            if index.name not in existing and all(column.name in columns for column in index.columns):
+                index.create(engine)
 
 
 def get_session():
@@ -0,0 +1,257 @@
+"""
+Извлечение текста из PDF / DOCX / TXT в пуле процессов.
+
+Разбор PyPDF2 / python-docx идёт в отдельных процессах, чтобы не
+блокировать цикл событий веб-воркера. Большие PDF делятся на диапазоны
+страниц и разбираются параллельно. У каждого документа есть лимит
+времени (EXTRACT_TIMEOUT), у каждого процесса пула — лимит памяти
+(EXTRACT_MEMORY_MB). Результат совпадает с синхронным extract_text.
+
+Модуль не импортирует ничего тяжёлого: процессы пула стартуют через spawn
+и импортируют только его.
+"""
+import asyncio
+import multiprocessing as mp
+import os
+import re
+import resource
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+
+EXTRACT_WORKERS        = int(os.getenv("EXTRACT_WORKERS", "2"))           # процессов в пуле
+EXTRACT_TIMEOUT        = float(os.getenv("EXTRACT_TIMEOUT", "60"))        # на один документ, сек
+EXTRACT_MEMORY_MB      = int(os.getenv("EXTRACT_MEMORY_MB", "1024"))      # адресное пространство процесса пула; 0 — без лимита
+EXTRACT_PAGES_PER_TASK = int(os.getenv("EXTRACT_PAGES_PER_TASK", "16"))   # PDF длиннее делится на диапазоны страниц
+# Бюджет извлечения: дальше документ не читается; 0 — без ограничения.
+# При изменении поднять assistant_core.EXTRACTOR_VERSION
+EXTRACT_MAX_PAGES      = int(os.getenv("EXTRACT_MAX_PAGES", "300"))       # страниц PDF
+EXTRACT_MAX_CHARS      = int(os.getenv("EXTRACT_MAX_CHARS", "1000000"))   # символов нормализованного текста
+
+
+# ---------- синхронное извлечение (выполняется в процессах пула) ----------
+def normalize_text(raw: str) -> str:
+    """Схлопывание пробелов и пустых строк"""
+    cleaned = re.sub(r"[ \t]+", " ", raw)
+    cleaned = re.sub(r"\s*\n\s*", "\n", cleaned)
+    return cleaned.strip()
+
+
+def join_normalized(pieces: Iterable[str]) -> str:
+    """
+    Склеивает нормализованные части так же, как normalize_text склеил бы
+    их исходный текст через "\\n": пустые части пропускаются.
+    """
+    return "\n".join(piece for piece in pieces if piece)
+
+
+def take_chars(pieces: Iterable[str], max_chars: int) -> Iterator[str]:
+    """
+    Пропускает части, пока их склейка через "\n" не длиннее max_chars (0 — без ограничения).
+    Склейка результата — join_normalized(pieces)[:max_chars].rstrip(), как бы ни были нарезаны части.
+    """
+    used = 0
+    for piece in pieces:
+        if not piece:
+            continue
+        sep = 1 if used else 0
+        if max_chars and used + sep + len(piece) > max_chars:
+            rest = max_chars - used - sep
+            if rest > 0 and piece[:rest].rstrip():
+                yield piece[:rest].rstrip()
+            return
+        used += sep + len(piece)
+        yield piece
+
+
+def _iter_lines(text: str) -> Iterator[str]:
+    start = 0
+    while True:
+        end = text.find("\n", start)
+        if end < 0:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 1
+
+
+def _iter_raw(file_data: bytes, ext: str, max_pages: int) -> Iterator[str]:
+    """Сырые куски документа: страницы PDF, абзацы DOCX, строки TXT"""
+    # парсеры импортируются только когда нужны, чтобы не замедлять старт воркера
+    if ext == ".pdf":
+        import PyPDF2
+        pdf = PyPDF2.PdfReader(BytesIO(file_data), strict=False)
+        pages = len(pdf.pages) if not max_pages else min(max_pages, len(pdf.pages))
+        for i in range(pages):
+            yield pdf.pages[i].extract_text() or ""
+    elif ext in {".docx", ".doc"}:
+        import docx # python-docx
+        doc = docx.Document(BytesIO(file_data))
+        for p in doc.paragraphs:
+            yield p.text
+    elif ext in {".txt", ".md"}:
+        yield from _iter_lines(file_data.decode("utf-8", errors="ignore"))
+    else:
+        raise ValueError(f"Неподдерживаесый типа файла: {ext}")
+
+
+def iter_text(file_data: bytes, filename: str, max_pages: int = EXTRACT_MAX_PAGES, max_chars: int = EXTRACT_MAX_CHARS) -> Iterator[str]:
+    """
+    Нормализованный текст документа по частям (страница PDF, абзац DOCX, строка TXT),
+    без пустых частей. Нормализация идёт по каждой части отдельно, поэтому в памяти
+    нет ни всего сырого текста, ни его копий после регулярных выражений.
+    Чтение прекращается, как только исчерпан бюджет страниц или символов.
+    "\n".join(iter_text(...)) == extract_text(...).
+    """
+    ext = Path(filename).suffix.lower() # Приведение расширения к нижнему регистру
+    try:
+        yield from take_chars((normalize_text(raw) for raw in _iter_raw(file_data, ext, max_pages)), max_chars)
+    except (_Deadline, MemoryError):
+        raise       # лимиты времени и памяти разбирает _run_limited
+    except Exception as error:
+        raise RuntimeError(f"Произошла ошибка извлечения текста из файла {filename}: {error}")
+
+
+def extract_text(file_data: bytes, filename: str, max_pages: int = EXTRACT_MAX_PAGES, max_chars: int = EXTRACT_MAX_CHARS) -> str:
+    return "\n".join(iter_text(file_data, filename, max_pages, max_chars))
+
+
+def _pdf_page_count(file_data: bytes) -> int:
+    import PyPDF2
+    return len(PyPDF2.PdfReader(BytesIO(file_data), strict=False).pages)
+
+
+def _extract_pdf_pages(file_data: bytes, start: int, end: int) -> str:
+    import PyPDF2
+    pdf = PyPDF2.PdfReader(BytesIO(file_data), strict=False)
+    return join_normalized(normalize_text(pdf.pages[i].extract_text() or "") for i in range(start, end))
+
+
+# ---------- процессы пула ----------
+class _Deadline(Exception):
+    pass
+
+
+class ExtractionLimitError(RuntimeError):
+    """Документ превысил лимит времени или памяти"""
+
+
+def _on_alarm(signum, frame):
+    raise _Deadline()
+
+
+def _init_worker(memory_mb: int):
+    if memory_mb:
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    signal.signal(signal.SIGALRM, _on_alarm)
+
+
+def _run_limited(deadline: float, func, *args):
+    """Выполняет func в процессе пула, прерывая его по сигналу в момент deadline"""
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise ExtractionLimitError("превышено время извлечения текста")
+    signal.setitimer(signal.ITIMER_REAL, remaining)
+    try:
+        return func(*args)
+    except _Deadline:
+        raise ExtractionLimitError("превышено время извлечения текста") from None
+    except MemoryError:
+        raise ExtractionLimitError("превышен лимит памяти при извлечении текста") from None
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+class ExtractionPool:
+    """Ограниченный пул процессов; после падения или зависания процесса пул пересоздаётся"""
+    def __init__(self, workers: int = EXTRACT_WORKERS, memory_mb: int = EXTRACT_MEMORY_MB):
+        self.workers = workers
+        self.memory_mb = memory_mb
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=mp.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.memory_mb,),
+                )
+            return self._executor
+
+    def reset(self, executor: ProcessPoolExecutor):
+        """
+        Убивает процессы пула executor (например, зависшие в C-коде и не реагирующие на сигнал).
+        Если пул уже пересоздан другим запросом, новый пул не трогается.
+        """
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+        for process in list((executor._processes or {}).values()):
+            process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    async def run(executor: ProcessPoolExecutor, deadline: float, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, _run_limited, deadline, func, *args)
+
+    async def extract(self, file_data: bytes, filename: str, timeout: float = EXTRACT_TIMEOUT) -> str:
+        deadline = time.time() + timeout
+        # все части документа идут в один пул: сбросить можно только его
+        executor = self._get_executor()
+        try:
+            # запас сверху — на случай, если процесс не прервался сигналом сам
+            return await asyncio.wait_for(self._extract(executor, file_data, filename, deadline), timeout + 5)
+        except asyncio.TimeoutError:
+            self.reset(executor)
+            raise RuntimeError(f"Произошла ошибка извлечения текста из файла {filename}: превышено время извлечения текста")
+        except BrokenProcessPool:
+            self.reset(executor)
+            raise RuntimeError(f"Произошла ошибка извлечения текста из файла {filename}: процесс извлечения аварийно завершился")
+        except ExtractionLimitError as error:
+            raise RuntimeError(f"Произошла ошибка извлечения текста из файла {filename}: {error}")
+
+    async def _extract(self, executor: ProcessPoolExecutor, file_data: bytes, filename: str, deadline: float) -> str:
+        if Path(filename).suffix.lower() != ".pdf":
+            return await self.run(executor, deadline, extract_text, file_data, filename)
+
+        try:
+            pages = await self.run(executor, deadline, _pdf_page_count, file_data)
+        except (ExtractionLimitError, BrokenProcessPool):
+            raise
+        except Exception:
+            # ошибку разбора сформулирует extract_text
+            return await self.run(executor, deadline, extract_text, file_data, filename)
+        if EXTRACT_MAX_PAGES:
+            pages = min(pages, EXTRACT_MAX_PAGES)
+        if pages <= EXTRACT_PAGES_PER_TASK:
+            return await self.run(executor, deadline, extract_text, file_data, filename)
+
+        # большой PDF: диапазоны страниц параллельно
+        ranges = [(start, min(start + EXTRACT_PAGES_PER_TASK, pages)) for start in range(0, pages, EXTRACT_PAGES_PER_TASK)]
+        try:
+            pieces = await asyncio.gather(*(self.run(executor, deadline, _extract_pdf_pages, file_data, start, end) for start, end in ranges))
+        except (ExtractionLimitError, BrokenProcessPool):
+            raise
+        except Exception as error:
+            raise RuntimeError(f"Произошла ошибка извлечения текста из файла {filename}: {error}")
+        return "\n".join(take_chars(pieces, EXTRACT_MAX_CHARS))
+
+
+extraction_pool = ExtractionPool()
+
+
+async def extract_text_async(file_data: bytes, filename: str) -> str:
+    """extract_text в пуле процессов, не блокируя цикл событий"""
+    return await extraction_pool.extract(file_data, filename)
@@ -0,0 +1,157 @@
+"""
+Хеджирование запросов к LLM: запрос уходит основному бэкенду, и если
+ответа нет дольше, чем обычно (p95 его задержек), тот же запрос
+параллельно отправляется запасному. Берётся первый подходящий ответ,
+второй запрос отменяется.
+
+Модуль не зависит от конкретных моделей: бэкенды — это async-функции
+с одинаковой сигнатурой (см. model_utils.generate_answer и
+benchmarks/bench_hedging.py с фейковыми бэкендами).
+
+В телеметрии каждая попытка — отдельная запись с именем своего бэкенда
+(отменённая — с ошибкой CancelledError), а запись вызывающего (backend
+"hedged") описывает запрос целиком и получает токены и TTFT победителя.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional
+import telemetry
+
+
+# Настройки хеджирования
+LLM_HEDGE_QUANTILE     = float(os.getenv("LLM_HEDGE_QUANTILE", "95"))        # по какому перцентилю задержек основного бэкенда хеджировать
+LLM_HEDGE_INITIAL      = float(os.getenv("LLM_HEDGE_INITIAL", "10"))         # задержка хеджа, пока замеров мало, сек
+LLM_HEDGE_MIN_DELAY    = float(os.getenv("LLM_HEDGE_MIN_DELAY", "0.5"))      # нижняя граница задержки хеджа, сек
+LLM_HEDGE_MAX_DELAY    = float(os.getenv("LLM_HEDGE_MAX_DELAY", "60"))       # верхняя граница задержки хеджа, сек
+LLM_HEDGE_WINDOW       = int(os.getenv("LLM_HEDGE_WINDOW", "200"))           # сколько последних замеров хранить на бэкенд
+LLM_HEDGE_MIN_SAMPLES  = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))       # с какого числа замеров доверять перцентилю
+
+Backend = Callable[..., Awaitable[str]]
+
+
+class LatencyTracker:
+    """
+    Скользящее окно задержек одного бэкенда. Отменённые вызовы (проигравший хедж)
+    тоже записываются — прошедшим временем как нижней оценкой задержки: иначе
+    из окна выпадали бы как раз самые медленные вызовы, и p95 занижался бы.
+    """
+    def __init__(self, window: int = LLM_HEDGE_WINDOW):
+        self._samples: deque[float] = deque(maxlen=window)
+
+    def record(self, latency: float):
+        self._samples.append(latency)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+
+class HedgedRouter:
+    """
+    Маршрутизатор с хеджированием между двумя бэкендами.
+    backends — словарь имя -> async-функция; primary получает каждый запрос,
+    secondary — только те, на которые primary не ответил за hedge_delay()
+    или ответил ошибкой / неподходящим ответом (validate).
+    """
+    def __init__(
+        self,
+        backends: dict[str, Backend],
+        primary: str,
+        secondary: str,
+        quantile: float = LLM_HEDGE_QUANTILE,
+        initial_delay: float = LLM_HEDGE_INITIAL,
+        min_delay: float = LLM_HEDGE_MIN_DELAY,
+        max_delay: float = LLM_HEDGE_MAX_DELAY,
+        min_samples: int = LLM_HEDGE_MIN_SAMPLES,
+        validate: Callable[[str], bool] = lambda answer: bool(answer and answer.strip()),
+    ):
+        self.backends = backends
+        self.primary = primary
+        self.secondary = secondary
+        self.quantile = quantile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_samples = min_samples
+        self.validate = validate
+        self.latency = {name: LatencyTracker() for name in backends}
+        self.counters = {"requests": 0, "hedged": 0, "won_by_secondary": 0, "failed": 0}
+
+    def hedge_delay(self) -> float:
+        """Сколько ждать основной бэкенд, прежде чем отправить хедж"""
+        tracker = self.latency[self.primary]
+        if len(tracker) < self.min_samples:
+            return self.initial_delay
+        return min(self.max_delay, max(self.min_delay, tracker.percentile(self.quantile)))
+
+    async def _timed(self, name: str, *args, **kwargs) -> tuple[str, telemetry.LLMCall]:
+        # задача получила копию контекста, поэтому у попытки своя запись телеметрии
+        with telemetry.llm_call(name) as call:
+            call.cached = False
+            start = time.perf_counter()
+            try:
+                answer = await self.backends[name](*args, **kwargs)
+            except asyncio.CancelledError:
+                self.latency[name].record(time.perf_counter() - start)
+                raise
+            self.latency[name].record(time.perf_counter() - start)
+        return answer, call
+
+    def _outcome(self, task: asyncio.Task, name: str) -> tuple[Optional[str], Optional[BaseException]]:
+        """(ответ, None) для подходящего ответа, иначе (None, ошибка)"""
+        if task.exception() is not None:
+            return None, task.exception()
+        answer, call = task.result()
+        if not self.validate(answer):
+            return None, RuntimeError(f"Бэкенд {name} вернул неподходящий ответ")
+        return answer, None
+
+    async def generate(self, *args, **kwargs) -> str:
+        self.counters["requests"] += 1
+        primary = asyncio.ensure_future(self._timed(self.primary, *args, **kwargs))
+        tasks = {primary: self.primary}
+        hedge_sent = False
+        last_error: Optional[BaseException] = None
+
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=self.hedge_delay())
+            while True:
+                for task in done:
+                    name = tasks.pop(task)
+                    answer, error = self._outcome(task, name)
+                    if error is None:
+                        if name == self.secondary:
+                            self.counters["won_by_secondary"] += 1
+                        telemetry.adopt_call(task.result()[1])
+                        return answer
+                    last_error = error
+
+                # основной не ответил вовремя или ответил ошибкой — хеджируем (один раз)
+                if not hedge_sent:
+                    hedge_sent = True
+                    self.counters["hedged"] += 1
+                    tasks[asyncio.ensure_future(self._timed(self.secondary, *args, **kwargs))] = self.secondary
+                if not tasks:
+                    self.counters["failed"] += 1
+                    raise last_error
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # проигравший запрос больше не нужен
+            for task in tasks:
+                task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "hedge_delay": self.hedge_delay(),
+            "latency_p50": {name: tracker.percentile(50) for name, tracker in self.latency.items()},
+            "latency_p95": {name: tracker.percentile(95) for name, tracker in self.latency.items()},
+        }
@@ -0,0 +1,375 @@
+"""
+Отдельный процесс инференса: держит INFERENCE_REPLICAS копий локальной
+модели и обслуживает веб-воркеры через локальный сокет.
+
+    python inference_server.py
+
+Соединения проверяются ключом INFERENCE_AUTHKEY. Если он не задан, сервер
+при запуске создаёт случайный ключ в файле INFERENCE_SERVER_ADDRESS + ".key"
+(права 0600), а клиенты того же пользователя читают его оттуда.
+
+Веб-воркеры (gunicorn) модель не загружают: если задан INFERENCE_SERVER_ADDRESS,
+model_utils.generate_answer / stream_answer отправляют локальные запросы сюда.
+Число копий модели настраивается независимо от числа HTTP-воркеров.
+"""
+import asyncio
+import itertools
+import logging
+import multiprocessing as mp
+import os
+import queue
+import secrets
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import Client, Connection, Listener, wait
+from typing import AsyncIterator, Optional
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+
+
+INFERENCE_SERVER_ADDRESS = os.getenv("INFERENCE_SERVER_ADDRESS")                 # путь к unix-сокету
+INFERENCE_AUTHKEY        = os.getenv("INFERENCE_AUTHKEY")                        # не задан — случайный ключ в файле рядом с сокетом
+INFERENCE_REPLICAS       = int(os.getenv("INFERENCE_REPLICAS", "1"))              # процессов с моделью
+INFERENCE_THREADS        = int(os.getenv("INFERENCE_THREADS", "1"))               # одновременных запросов на копию
+INFERENCE_TIMEOUT        = float(os.getenv("INFERENCE_TIMEOUT", "300"))           # ожидание ответа (и каждого фрагмента потока), сек
+INFERENCE_RESPAWN_DELAY  = float(os.getenv("INFERENCE_RESPAWN_DELAY", "5"))       # пауза перед перезапуском реплики, упавшей при загрузке, сек
+
+logger = logging.getLogger(__name__)
+
+# Статусы сообщений от реплики
+OK, ERROR, CHUNK, DONE = "ok", "error", "chunk", "done"
+# Служебные сообщения реплики серверу: модель загружена / запрос взят в работу (значение — pid)
+READY, TAKEN = "ready", "taken"
+
+
+def authkey_path(address: str) -> str:
+    return address + ".key"
+
+
+def load_authkey(address: str) -> bytes:
+    """Ключ соединения для клиента: из INFERENCE_AUTHKEY или из файла, созданного сервером"""
+    if INFERENCE_AUTHKEY:
+        return INFERENCE_AUTHKEY.encode()
+    try:
+        with open(authkey_path(address), "rb") as file:
+            return file.read()
+    except FileNotFoundError:
+        raise RuntimeError("Не задан INFERENCE_AUTHKEY, а сервер инференса ещё не создал файл ключа") from None
+
+
+def create_authkey(address: str) -> bytes:
+    """Ключ соединения для сервера: INFERENCE_AUTHKEY или новый случайный, записанный в файл 0600"""
+    if INFERENCE_AUTHKEY:
+        return INFERENCE_AUTHKEY.encode()
+    key = secrets.token_hex(32).encode()
+    path = authkey_path(address)
+    if os.path.exists(path):
+        os.unlink(path)
+    # O_EXCL: файл не может оказаться чужим, заранее подложенным
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as file:
+        file.write(key)
+    return key
+
+
+# ---------- процесс-реплика ----------
+def _handle(kind: str, args: tuple, request_id: int, results: mp.Queue):
+    import model_utils
+
+    if kind == "generate":
+        results.put((request_id, OK, model_utils.generate_once(*args)))
+    elif kind == "generate_with_prefix":
+        results.put((request_id, OK, model_utils.generate_with_prefix(*args)))
+    elif kind == "stream":
+        for text in model_utils.stream_once(*args):
+            results.put((request_id, CHUNK, text))
+        results.put((request_id, DONE, None))
+    else:
+        raise ValueError(f"Неизвестный тип запроса: {kind}")
+
+
+def _batched_done(future: Future, request_id: int, results: mp.Queue, slots: threading.Semaphore):
+    try:
+        results.put((request_id, OK, future.result()))
+    except Exception as error:
+        results.put((request_id, ERROR, f"{type(error).__name__}: {error}"))
+    finally:
+        slots.release()
+
+
+def _replica_main(requests: mp.Queue, results: mp.Queue, threads: int):
+    """
+    Загружает модель один раз и обрабатывает запросы из общей очереди.
+    Запросы generate_batched не занимают поток до конца генерации: они сразу
+    передаются планировщику батчей (batching.py), а поток берёт следующий —
+    так в батч попадают одновременные запросы. Число запросов в работе
+    ограничено, чтобы одна реплика не забирала из очереди всё подряд.
+    """
+    import model_utils
+    model_utils.load_model()
+    results.put((None, READY, os.getpid()))
+
+    capacity = max(1, threads)
+    if model_utils.LOCAL_BATCHING:
+        from batching import BATCH_MAX_SIZE
+        capacity = max(capacity, BATCH_MAX_SIZE)
+    slots = threading.BoundedSemaphore(capacity)
+
+    def work():
+        while True:
+            slots.acquire()
+            request_id, kind, args = requests.get()
+            results.put((request_id, TAKEN, os.getpid()))
+            release = True
+            try:
+                if kind == "generate_batched":
+                    from batching import get_scheduler
+                    future = get_scheduler().submit(*args)
+                    # место освободится, когда планировщик закончит запрос
+                    future.add_done_callback(lambda done, request_id=request_id: _batched_done(done, request_id, results, slots))
+                    release = False
+                else:
+                    _handle(kind, args, request_id, results)
+            except Exception as error:
+                results.put((request_id, ERROR, f"{type(error).__name__}: {error}"))
+            finally:
+                if release:
+                    slots.release()
+
+    workers = [threading.Thread(target=work, daemon=True) for _ in range(max(1, threads))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+# ---------- сервер ----------
+def serve(address: str = INFERENCE_SERVER_ADDRESS, replicas: int = INFERENCE_REPLICAS, threads: int = INFERENCE_THREADS):
+    """
+    Запускает реплики и принимает соединения веб-воркеров.
+    Запросы всех соединений попадают в одну очередь, ответы
+    возвращаются в то соединение, из которого пришёл запрос.
+    Упавшая реплика (OOM, segfault в torch) перезапускается, а взятые ею
+    запросы сразу завершаются ошибкой, не дожидаясь INFERENCE_TIMEOUT.
+    """
+    if not address:
+        raise RuntimeError("Не задан INFERENCE_SERVER_ADDRESS")
+    if os.path.exists(address):
+        os.unlink(address)
+
+    ctx = mp.get_context("spawn")
+    requests, results = ctx.Queue(), ctx.Queue()
+
+    def start_replica(index: int):
+        process = ctx.Process(target=_replica_main, args=(requests, results, threads), daemon=True, name=f"inference-replica-{index}")
+        process.start()
+        return process
+
+    processes = [start_replica(i) for i in range(replicas)]
+
+    routes: dict[int, tuple[Connection, threading.Lock, int]] = {}   # внутренний id -> (соединение, его lock, id клиента)
+    owners: dict[int, int] = {}                                       # внутренний id -> pid реплики, взявшей запрос
+    ready: set[int] = set()                                           # pid реплик, загрузивших модель
+    dead: set[int] = set()                                            # pid упавших реплик
+    routes_lock = threading.Lock()
+    ids = itertools.count()
+
+    def reply(request_id: int, status: str, value):
+        with routes_lock:
+            route = routes.get(request_id)
+            if route and status != CHUNK:
+                del routes[request_id]
+                owners.pop(request_id, None)
+        if route is None:
+            return
+        conn, send_lock, client_id = route
+        try:
+            with send_lock:
+                conn.send((client_id, status, value))
+        except (OSError, EOFError):
+            pass
+
+    def dispatch_results():
+        while True:
+            request_id, status, value = results.get()
+            if status == READY:
+                with routes_lock:
+                    ready.add(value)
+            elif status == TAKEN:
+                with routes_lock:
+                    crashed = value in dead
+                    if not crashed and request_id in routes:
+                        owners[request_id] = value
+                # сообщение пришло уже после падения реплики
+                if crashed:
+                    reply(request_id, ERROR, "Реплика инференса упала, не закончив запрос")
+            else:
+                reply(request_id, status, value)
+
+    def supervise():
+        while True:
+            sentinels = {process.sentinel: index for index, process in enumerate(processes)}
+            for sentinel in wait(list(sentinels)):
+                index = sentinels[sentinel]
+                process = processes[index]
+                process.join()
+                with routes_lock:
+                    dead.add(process.pid)
+                    lost = [request_id for request_id, pid in owners.items() if pid == process.pid]
+                    loaded = process.pid in ready
+                logger.error(
+                    "Реплика %s (pid %d) завершилась с кодом %s, запросов в работе: %d",
+                    process.name, process.pid, process.exitcode, len(lost),
+                )
+                for request_id in lost:
+                    reply(request_id, ERROR, f"Реплика инференса упала (код {process.exitcode}), не закончив запрос")
+                # не загрузившаяся реплика скорее всего упадёт снова — не перезапускаем её в цикле
+                if not loaded:
+                    time.sleep(INFERENCE_RESPAWN_DELAY)
+                processes[index] = start_replica(index)
+
+    def serve_connection(conn: Connection):
+        send_lock = threading.Lock()
+        try:
+            while True:
+                client_id, kind, args = conn.recv()
+                request_id = next(ids)
+                with routes_lock:
+                    routes[request_id] = (conn, send_lock, client_id)
+                requests.put((request_id, kind, args))
+        except (OSError, EOFError):
+            conn.close()
+
+    threading.Thread(target=dispatch_results, daemon=True).start()
+    threading.Thread(target=supervise, daemon=True).start()
+
+    authkey = create_authkey(address)
+    with Listener(address, family="AF_UNIX", authkey=authkey) as listener:
+        logger.info("Сервер инференса слушает %s, реплик: %d", address, replicas)
+        while True:
+            conn = listener.accept()
+            threading.Thread(target=serve_connection, args=(conn,), daemon=True).start()
+
+
+# ---------- клиент ----------
+class InferenceClient:
+    """
+    Клиент веб-воркера: одно соединение на процесс, ответы разбирает
+    фоновый поток и раскладывает по Future / очередям потоковых запросов.
+    """
+    def __init__(self, address: str = INFERENCE_SERVER_ADDRESS):
+        self.address = address
+        self._conn: Optional[Connection] = None
+        self._send_lock = threading.Lock()
+        self._pending: dict[int, Future | queue.Queue] = {}
+        self._ids = itertools.count()
+
+    def _connect(self) -> Connection:
+        if self._conn is None:
+            self._conn = Client(self.address, family="AF_UNIX", authkey=load_authkey(self.address))
+            threading.Thread(target=self._read, args=(self._conn,), daemon=True).start()
+        return self._conn
+
+    def _read(self, conn: Connection):
+        try:
+            while True:
+                client_id, status, value = conn.recv()
+                target = self._pending.get(client_id)
+                if isinstance(target, queue.Queue):
+                    target.put((status, value))
+                    if status != CHUNK:
+                        self._pending.pop(client_id, None)
+                elif target is not None:
+                    self._pending.pop(client_id, None)
+                    # запрос отменили (таймаут, хеджирование), пока он считался
+                    if not target.set_running_or_notify_cancel():
+                        continue
+                    if status == OK:
+                        target.set_result(value)
+                    else:
+                        target.set_exception(RuntimeError(f"Ошибка сервера инференса: {value}"))
+        except (OSError, EOFError) as error:
+            # соединение потеряно — все ожидающие запросы завершаются ошибкой
+            with self._send_lock:
+                if self._conn is conn:
+                    self._conn = None
+            for client_id in list(self._pending):
+                target = self._pending.pop(client_id, None)
+                if isinstance(target, queue.Queue):
+                    target.put((ERROR, f"Соединение с сервером инференса потеряно: {error}"))
+                elif target is not None and not target.done():
+                    target.set_exception(RuntimeError(f"Соединение с сервером инференса потеряно: {error}"))
+
+    def _send(self, kind: str, args: tuple, target) -> int:
+        client_id = next(self._ids)
+        self._pending[client_id] = target
+        with self._send_lock:
+            try:
+                self._connect().send((client_id, kind, args))
+            except Exception:
+                self._pending.pop(client_id, None)
+                self._conn = None
+                raise
+        return client_id
+
+    def submit(self, kind: str, *args) -> Future:
+        future = Future()
+        client_id = self._send(kind, args, future)
+        # отменённый по таймауту запрос больше не ждёт ответа
+        future.add_done_callback(lambda _: self._pending.pop(client_id, None))
+        return future
+
+    def stream(self, *args):
+        """Синхронный генератор фрагментов ответа"""
+        chunks = queue.Queue()
+        client_id = self._send("stream", args, chunks)
+        while True:
+            try:
+                status, value = chunks.get(timeout=INFERENCE_TIMEOUT)
+            except queue.Empty:
+                self._pending.pop(client_id, None)
+                raise RuntimeError(f"Сервер инференса не прислал фрагмент ответа за {INFERENCE_TIMEOUT:g} с") from None
+            if status == CHUNK:
+                yield value
+            elif status == DONE:
+                return
+            else:
+                raise RuntimeError(f"Ошибка сервера инференса: {value}")
+
+
+_client: Optional[InferenceClient] = None
+
+
+def get_client() -> InferenceClient:
+    global _client
+    if _client is None:
+        _client = InferenceClient()
+    return _client
+
+
+async def remote_generate(kind: str, *args) -> str:
+    """
+    Выполняет запрос на сервере инференса, не блокируя цикл событий.
+    Если реплика упала посреди запроса, ответа не будет: через INFERENCE_TIMEOUT
+    запрос завершается ошибкой, а не ждёт вечно (и не продлевает аренду задачи).
+    Подключение (с проверкой ключа) и отправка блокирующие, поэтому идут в пуле потоков.
+    """
+    async def call() -> str:
+        future = await run_in_threadpool(get_client().submit, kind, *args)
+        return await asyncio.wrap_future(future)
+
+    try:
+        # при таймауте wait_for отменяет и future
+        return await asyncio.wait_for(call(), INFERENCE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise RuntimeError(f"Сервер инференса не ответил за {INFERENCE_TIMEOUT:g} с") from None
+
+
+async def remote_stream(prompt: str) -> AsyncIterator[str]:
+    async for text in iterate_in_threadpool(get_client().stream(prompt)):
+        yield text
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+    serve()
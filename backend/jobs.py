@@ -0,0 +1,248 @@
+"""
+Фоновые задачи: проверка загруженной работы выполняется вне HTTP-запроса.
+
+Состояние задач хранится в таблице job, поэтому после перезапуска ничего
+не теряется: очередь — это строки со статусом queued, а задачи, у которых
+перестал обновляться updated_at (воркер упал), возвращаются в очередь.
+Задачу забирает ровно один исполнитель (SELECT ... FOR UPDATE SKIP LOCKED),
+так что несколько процессов gunicorn могут работать с одной таблицей.
+"""
+import asyncio
+import json
+import os
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Optional
+from sqlalchemy import update
+from sqlmodel import Session, select
+from starlette.concurrency import run_in_threadpool
+from database import engine
+from models import Chat as ChatModel, ChatStage, Job as JobModel, JobStatus, Message as MessageModel
+from assistant_core import handle_checking_the_work_stage, handle_checking_the_corrected_work_stage, extract_text_cached
+from similarity import index_submission
+import telemetry
+
+
+JOB_WORKERS       = int(os.getenv("JOB_WORKERS", "2"))            # одновременно выполняемых задач на процесс
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "5"))    # как часто смотреть в таблицу без уведомления, сек
+JOB_LEASE         = float(os.getenv("JOB_LEASE", "120"))          # задача без обновления дольше — считается брошенной, сек
+JOB_MAX_ATTEMPTS  = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))       # запусков после падений воркера
+
+FINISHED_STATUSES = (JobStatus.DONE, JobStatus.FAILED)
+
+# Откуда вернуть чат, если проверка не удалась: пусть студент загрузит файл ещё раз
+_STAGE_ON_FAILURE = {
+    ChatStage.CHECKING_THE_WORK: ChatStage.NEW,
+    ChatStage.CHECKING_CORRECTED_WORK: ChatStage.RETURNED_FOR_REVISION,
+}
+
+JobHandler = Callable[[JobModel, ChatModel, Session], Awaitable[dict]]
+JOB_HANDLERS: dict[str, JobHandler] = {}
+
+
+def job_handler(kind: str):
+    """Регистрирует обработчик задач вида kind"""
+    def register(handler: JobHandler) -> JobHandler:
+        JOB_HANDLERS[kind] = handler
+        return handler
+    return register
+
+
+# Проверка загруженной (или исправленной) работы
+@job_handler("check_upload")
+async def check_upload(job: JobModel, chat: ChatModel, session: Session) -> dict:
+    if chat.stage == ChatStage.CHECKING_THE_WORK:
+        assistant_reply = await handle_checking_the_work_stage(chat, session)
+    elif chat.stage == ChatStage.CHECKING_CORRECTED_WORK:
+        assistant_reply = await handle_checking_the_corrected_work_stage(chat, session)
+    else:
+        raise RuntimeError(f"Чат не ожидает проверки (этап {chat.stage.value})")
+
+    # новая версия отчёта заменяет прежнюю в индексе почти-дубликатов; текст уже в кэше после проверки
+    if chat.work_id is not None:
+        with telemetry.span("similarity_index"):
+            text = await extract_text_cached(chat.document_sha256, chat.document_name)
+            await index_submission(session, chat, text)
+
+    # этап чата (его меняет обработчик, не фиксируя), индекс и сообщение сохраняются
+    # в одной транзакции с отметкой о завершении задачи
+    ai_message = MessageModel(chat_id=chat.id, sender="ai", text=assistant_reply)
+    session.add(ai_message)
+    session.flush()
+    return {"ai_message_id": ai_message.id}
+
+
+class JobRunner:
+    """
+    Пул из workers исполнителей в цикле событий приложения.
+    Новые задачи будят исполнителей через wake(); задачи, добавленные
+    другими процессами, подхватываются опросом раз в JOB_POLL_INTERVAL.
+    """
+    def __init__(self, workers: int = JOB_WORKERS):
+        self.workers = workers
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: list[asyncio.Task] = []
+        self._watchers: dict[int, set[asyncio.Event]] = {}
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._requeue_stale_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def wake(self):
+        """Сообщает исполнителям, что в очереди появилась задача"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def wait(self, job_id: int, timeout: float):
+        """Ждёт завершения задачи в этом процессе, но не дольше timeout"""
+        event = asyncio.Event()
+        self._watchers.setdefault(job_id, set()).add(event)
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            watchers = self._watchers.get(job_id)
+            if watchers is not None:
+                watchers.discard(event)
+                if not watchers:
+                    del self._watchers[job_id]
+
+    def _notify(self, job_id: int):
+        for event in self._watchers.get(job_id, ()):
+            event.set()
+
+    # ---------- исполнители ----------
+    async def _work(self):
+        while True:
+            self._wakeup.clear()
+            job_id = await run_in_threadpool(self._claim)
+            if job_id is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job_id)
+
+    @staticmethod
+    def _claim() -> Optional[int]:
+        """Забирает самую старую задачу из очереди"""
+        with Session(engine) as session:
+            job = session.exec(
+                select(JobModel)
+                .where(JobModel.status == JobStatus.QUEUED)
+                .order_by(JobModel.id)
+                .limit(1)
+                .with_for_update(skip_locked=True)
+            ).first()
+            if job is None:
+                return None
+            job.status = JobStatus.RUNNING
+            job.attempts += 1
+            job.updated_at = datetime.utcnow()
+            session.add(job)
+            session.commit()
+            return job.id
+
+    async def _run(self, job_id: int):
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            with Session(engine) as session:
+                job = session.get(JobModel, job_id)
+                if job is None:        # чат удалён вместе с задачей
+                    return
+                chat = session.get(ChatModel, job.chat_id)
+                if job.attempts == 1:
+                    queued = (datetime.utcnow() - job.created_at).total_seconds()
+                    telemetry.registry.record_span(chat.stage.value, "job_queue", queued)
+                try:
+                    # вызовы LLM внутри обработчика помечаются этапом чата
+                    with telemetry.stage(chat.stage), telemetry.span("job_total"):
+                        result = await JOB_HANDLERS[job.kind](job, chat, session)
+                except Exception as error:
+                    session.rollback()
+                    _fail(session, session.get(JobModel, job_id), f"{type(error).__name__}: {error}")
+                    return
+                job.status = JobStatus.DONE
+                job.result = json.dumps(result, ensure_ascii=False)
+                job.updated_at = datetime.utcnow()
+                session.add(job)
+                session.commit()
+        finally:
+            heartbeat.cancel()
+            self._notify(job_id)
+
+    @staticmethod
+    async def _heartbeat(job_id: int):
+        """Продлевает аренду задачи, пока она выполняется"""
+        def touch():
+            with Session(engine) as session:
+                session.exec(
+                    update(JobModel)
+                    .where(JobModel.id == job_id, JobModel.status == JobStatus.RUNNING)
+                    .values(updated_at=datetime.utcnow())
+                )
+                session.commit()
+
+        while True:
+            await asyncio.sleep(JOB_LEASE / 3)
+            await run_in_threadpool(touch)
+
+    # ---------- восстановление после падений ----------
+    async def _requeue_stale_loop(self):
+        while True:
+            if await run_in_threadpool(self._requeue_stale):
+                self.wake()
+            await asyncio.sleep(JOB_LEASE / 2)
+
+    @staticmethod
+    def _requeue_stale() -> int:
+        """Возвращает в очередь брошенные задачи; исчерпавшие попытки — завершает ошибкой"""
+        deadline = datetime.utcnow() - timedelta(seconds=JOB_LEASE)
+        requeued = 0
+        with Session(engine) as session:
+            stale = session.exec(
+                select(JobModel)
+                .where(JobModel.status == JobStatus.RUNNING, JobModel.updated_at < deadline)
+                .with_for_update(skip_locked=True)
+            ).all()
+            for job in stale:
+                if job.attempts >= JOB_MAX_ATTEMPTS:
+                    _fail(session, job, "Задача прерывалась слишком много раз", commit=False)
+                    continue
+                job.status = JobStatus.QUEUED
+                job.updated_at = datetime.utcnow()
+                session.add(job)
+                requeued += 1
+            session.commit()
+        return requeued
+
+
+def _fail(session: Session, job: JobModel, error: str, commit: bool = True):
+    """Помечает задачу ошибочной и возвращает чат на этап загрузки файла"""
+    job.status = JobStatus.FAILED
+    job.error = error
+    job.updated_at = datetime.utcnow()
+    session.add(job)
+
+    chat = session.get(ChatModel, job.chat_id)
+    if chat is not None and chat.stage in _STAGE_ON_FAILURE:
+        chat.stage = _STAGE_ON_FAILURE[chat.stage]
+        session.add(chat)
+        session.add(MessageModel(
+            chat_id=chat.id,
+            sender="ai",
+            text=f"⚠️ Не удалось проверить работу: {error}\n\nПопробуйте загрузить файл ещё раз.",
+        ))
+    if commit:
+        session.commit()
+
+
+job_runner = JobRunner()
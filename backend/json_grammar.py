@@ -0,0 +1,298 @@
+"""
+Ограниченная схемой генерация JSON для локальной модели.
+
+Автомат с магазинной памятью принимает посимвольно только те префиксы,
+которые могут продолжиться в JSON-объект заданной схемы (объекты с
+известными ключами, массивы, строки с необязательным enum, true/false).
+JsonConstraint по автомату маскирует логиты недопустимых токенов и
+останавливает генерацию, как только закрылся объект верхнего уровня.
+"""
+import json
+import os
+import re
+from typing import Any, Optional
+
+
+# Сколько лучших токенов проверять на каждом шаге (дальше — следующими порциями)
+CONSTRAINED_TOP_K = int(os.getenv("CONSTRAINED_TOP_K", "64"))
+# Сколько порций по CONSTRAINED_TOP_K просматривать, прежде чем снять ограничение
+CONSTRAINED_MAX_CHUNKS = int(os.getenv("CONSTRAINED_MAX_CHUNKS", "32"))
+
+WHITESPACE = " \t\n\r"
+ESCAPES = '"\\/bfnrt'
+
+
+# ---------- автомат ----------
+# Состояние — кортеж кадров стека; пустой кортеж — объект верхнего уровня закрыт.
+# Кадры:
+#   ("val", schema)                              ждём начало значения
+#   ("obj", schema, phase, seen, pending)        phase: first | key | colon | next
+#   ("key", buf)                                 читаем имя ключа
+#   ("arr", schema, phase)                       phase: first | next
+#   ("str", enum, buf, escape)                   читаем строку (buf нужен только для enum)
+#   ("lit", rest)                                оставшиеся буквы true / false
+
+def initial_state(schema: dict) -> tuple:
+    return (("val", schema),)
+
+
+def is_complete(state: Optional[tuple]) -> bool:
+    return state == ()
+
+
+def feed_text(state: Optional[tuple], text: str) -> Optional[tuple]:
+    """Подаёт строку посимвольно; None — префикс недопустим"""
+    for ch in text:
+        if state is None:
+            return None
+        state = feed_char(state, ch)
+    return state
+
+
+def feed_char(state: tuple, ch: str) -> Optional[tuple]:
+    if not state:
+        return None      # после закрытия объекта ничего не принимаем
+    frame, rest = state[-1], state[:-1]
+    kind = frame[0]
+
+    if kind == "val":
+        if ch in WHITESPACE:
+            return state
+        return _start_value(rest, frame[1], ch)
+
+    if kind == "str":
+        _, enum, buf, escape = frame
+        if escape:
+            if ch not in ESCAPES:
+                return None
+            return rest + (("str", enum, buf, False),)
+        if ch == "\\":
+            return None if enum is not None else rest + (("str", enum, buf, True),)
+        if ch == '"':
+            if enum is not None and buf not in enum:
+                return None
+            return rest
+        if ord(ch) < 0x20:
+            return None
+        if enum is not None:
+            buf = buf + ch
+            if not any(value.startswith(buf) for value in enum):
+                return None
+        return rest + (("str", enum, buf, False),)
+
+    if kind == "lit":
+        if ch != frame[1][0]:
+            return None
+        return rest if len(frame[1]) == 1 else rest + (("lit", frame[1][1:]),)
+
+    if kind == "key":
+        parent = rest[-1]
+        allowed = _unseen_keys(parent)
+        if ch == '"':
+            if frame[1] not in allowed:
+                return None
+            _, schema, _, seen, _ = parent
+            return rest[:-1] + (("obj", schema, "colon", seen | {frame[1]}, frame[1]),)
+        buf = frame[1] + ch
+        if not any(key.startswith(buf) for key in allowed):
+            return None
+        return rest + (("key", buf),)
+
+    if kind == "obj":
+        _, schema, phase, seen, pending = frame
+        if ch in WHITESPACE:
+            return state
+        if phase in ("first", "key") and ch == '"':
+            return state + (("key", ""),)
+        if phase == "colon" and ch == ":":
+            return rest + (("obj", schema, "next", seen, None), ("val", schema["properties"][pending]))
+        if phase == "next" and ch == "," and _unseen_keys(frame):
+            return rest + (("obj", schema, "key", seen, None),)
+        if phase in ("first", "next") and ch == "}":
+            return rest if set(schema.get("required", [])) <= seen else None
+        return None
+
+    if kind == "arr":
+        _, schema, phase = frame
+        if ch in WHITESPACE:
+            return state
+        if ch == "]":
+            return rest
+        if phase == "next":
+            return rest + (("arr", schema, "next"), ("val", schema["items"])) if ch == "," else None
+        # первый элемент массива
+        return _start_value(rest + (("arr", schema, "next"),), schema["items"], ch)
+
+    return None
+
+
+def _start_value(rest: tuple, schema: dict, ch: str) -> Optional[tuple]:
+    kind = schema["type"]
+    if kind == "object" and ch == "{":
+        return rest + (("obj", schema, "first", frozenset(), None),)
+    if kind == "array" and ch == "[":
+        return rest + (("arr", schema, "first"),)
+    if kind == "string" and ch == '"':
+        enum = schema.get("enum")
+        return rest + (("str", tuple(enum) if enum else None, "", False),)
+    if kind == "boolean" and ch in "tf":
+        return rest + (("lit", "rue" if ch == "t" else "alse"),)
+    return None
+
+
+def _unseen_keys(obj_frame: tuple) -> set:
+    return set(obj_frame[1]["properties"]) - obj_frame[3]
+
+
+# ---------- проверка готового ответа ----------
+def extract_json(reply: str) -> str:
+    """Текст JSON из ответа модели: без обёрток markdown (```json ... ```) и префикса json"""
+    text = reply.strip()
+    if match := re.search(r"```(?:json)?\n([\s\S]*?)```", text):
+        text = match.group(1).strip()
+    return re.sub(r"^json\s*", "", text, flags=re.IGNORECASE).strip()
+
+
+def validate(value: Any, schema: dict) -> bool:
+    """Соответствует ли разобранное значение схеме; лишние ключи объекта допускаются"""
+    kind = schema["type"]
+    if kind == "object":
+        if not isinstance(value, dict) or not set(schema.get("required", [])) <= value.keys():
+            return False
+        return all(validate(value[key], sub) for key, sub in schema["properties"].items() if key in value)
+    if kind == "array":
+        return isinstance(value, list) and all(validate(item, schema["items"]) for item in value)
+    if kind == "string":
+        return isinstance(value, str) and ("enum" not in schema or value in schema["enum"])
+    if kind == "boolean":
+        return isinstance(value, bool)
+    return False
+
+
+def reply_matches_schema(reply: str, schema: dict) -> bool:
+    """Разбирается ли ответ модели в JSON-объект схемы (так же, как его разбирает assistant_core)"""
+    try:
+        return validate(json.loads(extract_json(reply)), schema)
+    except ValueError:
+        return False
+
+
+# ---------- интеграция с generate ----------
+class JsonConstraint:
+    """
+    Общее состояние автомата для LogitsProcessor и StoppingCriteria одного вызова generate.
+    prompt_len — длина промпта в токенах: всё, что после неё, — сгенерированный ответ.
+    """
+    def __init__(self, tokenizer, schema: dict, prompt_len: int, top_k: int = CONSTRAINED_TOP_K):
+        self.tokenizer = tokenizer
+        self.schema = schema
+        self.prompt_len = prompt_len
+        self.top_k = top_k
+        self.states: list = []
+        self.consumed: list = []
+        self._texts: dict[int, str] = {}
+
+        # текст токена в контексте: декодируем пару (опорный токен, токен) и отрезаем опорный,
+        # иначе SentencePiece теряет ведущий пробел
+        self._anchor = tokenizer.encode("a", add_special_tokens=False)[-1]
+        self._anchor_text = tokenizer.decode([self._anchor])
+        self._special = set(tokenizer.all_special_ids)
+
+    def token_text(self, token_id: int) -> str:
+        text = self._texts.get(token_id)
+        if text is None:
+            if token_id in self._special:
+                text = ""
+            else:
+                full = self.tokenizer.decode([self._anchor, token_id])
+                text = full[len(self._anchor_text):]
+                # недекодируемые куски байтов не пускаем
+                if "�" in text:
+                    text = ""
+            self._texts[token_id] = text
+        return text
+
+    def sync(self, input_ids):
+        """Продвигает автоматы строк по токенам, появившимся с прошлого вызова"""
+        if not self.states:
+            self.states = [initial_state(self.schema) for _ in range(input_ids.shape[0])]
+            self.consumed = [0] * input_ids.shape[0]
+        for row in range(input_ids.shape[0]):
+            new_ids = input_ids[row, self.prompt_len + self.consumed[row]:].tolist()
+            self.consumed[row] += len(new_ids)
+            for token_id in new_ids:
+                if self.states[row] is None or is_complete(self.states[row]):
+                    break
+                self.states[row] = feed_text(self.states[row], self.token_text(token_id))
+
+    def mask(self, input_ids, scores):
+        import torch
+
+        self.sync(input_ids)
+        eos_ids = self.tokenizer.eos_token_id
+        eos_ids = set(eos_ids if isinstance(eos_ids, list) else [eos_ids])
+
+        for row in range(scores.shape[0]):
+            state = self.states[row]
+            if state is None:
+                continue        # ограничение снято — генерируем как есть
+            allowed = []
+            if is_complete(state):
+                allowed = list(eos_ids)
+            else:
+                order = torch.argsort(scores[row], descending=True)
+                for chunk in range(CONSTRAINED_MAX_CHUNKS):
+                    for token_id in order[chunk * self.top_k:(chunk + 1) * self.top_k].tolist():
+                        text = self.token_text(token_id)
+                        if text and feed_text(state, text) is not None:
+                            allowed.append(token_id)
+                    if allowed:
+                        break
+            if not allowed:
+                self.states[row] = None
+                continue
+            keep = scores[row, allowed].clone()
+            scores[row] = float("-inf")
+            scores[row, allowed] = keep
+        return scores
+
+    def done(self, input_ids):
+        import torch
+
+        self.sync(input_ids)
+        return torch.tensor([is_complete(state) for state in self.states], device=input_ids.device)
+
+    def logits_processor(self):
+        from transformers import LogitsProcessor
+
+        constraint = self
+
+        class _Processor(LogitsProcessor):
+            def __call__(self, input_ids, scores):
+                return constraint.mask(input_ids, scores)
+
+        return _Processor()
+
+    def stopping_criteria(self):
+        from transformers import StoppingCriteria
+
+        constraint = self
+
+        class _Stop(StoppingCriteria):
+            def __call__(self, input_ids, scores, **kwargs):
+                return constraint.done(input_ids)
+
+        return _Stop()
+
+
+def constrained_generate_kwargs(tokenizer, schema: Optional[dict], prompt_len: int) -> dict:
+    """Дополнительные аргументы mdl.generate для ограниченной генерации (пусто без схемы)"""
+    if schema is None:
+        return {}
+    from transformers import LogitsProcessorList, StoppingCriteriaList
+
+    constraint = JsonConstraint(tokenizer, schema, prompt_len)
+    return {
+        "logits_processor": LogitsProcessorList([constraint.logits_processor()]),
+        "stopping_criteria": StoppingCriteriaList([constraint.stopping_criteria()]),
+    }
@@ -0,0 +1,120 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+import unicodedata
+from collections import OrderedDict
+from threading import Lock
+from typing import Awaitable, Callable, Optional
+
+
+# Настройки кэша ответов LLM
+LLM_CACHE_ENABLED     = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1024"))
+LLM_CACHE_TTL         = float(os.getenv("LLM_CACHE_TTL", str(24 * 60 * 60)))   # сек
+LLM_CACHE_PATH        = os.getenv("LLM_CACHE_PATH")                             # SQLite-файл; не задан — только память
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Нормализация промпта перед хэшированием: NFC и схлопывание пробелов"""
+    text = unicodedata.normalize("NFC", prompt)
+    text = re.sub(r"[ \t]+", " ", text)
+    text = re.sub(r"\s*\n\s*", "\n", text)
+    return text.strip()
+
+
+def make_key(prompt: str, **params) -> str:
+    """SHA-256 от нормализованного промпта и параметров генерации"""
+    payload = json.dumps({"prompt": normalize_prompt(prompt), **params}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Кэш ответов LLM по хэшу содержимого: LRU + TTL в памяти и, по желанию,
+    SQLite-файл на диске (общий для воркеров и переживающий перезапуск).
+
+    Одинаковые запросы, которые уже генерируются, не запускают вторую
+    генерацию, а ждут результата первой.
+    """
+    def __init__(self, max_entries: int = LLM_CACHE_MAX_ENTRIES, ttl: float = LLM_CACHE_TTL, path: Optional[str] = LLM_CACHE_PATH):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()   # key -> (created_at, value)
+        self._pending: dict[str, asyncio.Task] = {}
+        self._lock = Lock()
+
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)")
+            self._db.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[0] <= self.ttl:
+                    self._entries.move_to_end(key)
+                    return entry[1]
+                del self._entries[key]
+
+            if self._db is None:
+                return None
+            row = self._db.execute("SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if now - created_at > self.ttl:
+                self._db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+            self._remember(key, created_at, value)
+            return value
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, value)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO llm_cache (key, value, created_at) VALUES (?, ?, ?)", (key, value, now))
+                self._db.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl,))
+                self._db.commit()
+
+    def _remember(self, key: str, created_at: float, value: str):
+        self._entries[key] = (created_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_generate(self, key: str, generate: Callable[[], Awaitable[str]], validate: Optional[Callable[[str], bool]] = None) -> str:
+        """
+        Возвращает ответ из кэша, ждёт уже идущую генерацию с тем же ключом
+        или запускает новую. Генерация идёт отдельной задачей, поэтому отмена
+        одного из ждущих запросов не отменяет её для остальных.
+        Ответ, не прошедший validate, возвращается, но не кэшируется:
+        повторный запрос сгенерирует его заново.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._generate(key, generate, validate))
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _generate(self, key: str, generate: Callable[[], Awaitable[str]], validate: Optional[Callable[[str], bool]]) -> str:
+        value = await generate()
+        if validate is None or validate(value):
+            self.set(key, value)
+        return value
+
+
+response_cache = ResponseCache()
@@ -1,9 +1,19 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from routers import users, disciplines, works, students, chats
+from routers import users, disciplines, works, students, chats, metrics
+from jobs import job_runner
 
 
-app = FastAPI(title="API NeuroTutor", description="API для цифрового помощника", version="1.0.0", docs_url="/docs", openapi_url="/openapi.json", redoc_url=None)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # исполнители фоновых задач (проверка загруженных работ)
+    job_runner.start()
+    yield
+    await job_runner.stop()
+
+
+app = FastAPI(title="API NeuroTutor", description="API для цифрового помощника", version="1.0.0", docs_url="/docs", openapi_url="/openapi.json", redoc_url=None, lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -18,6 +28,7 @@ app.include_router(disciplines.router)
 app.include_router(works.router)
 app.include_router(students.router)
 app.include_router(chats.router)
+app.include_router(metrics.router)
 
 
 # Получить чат в режиме Помощь
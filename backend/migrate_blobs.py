@@ -0,0 +1,100 @@
+"""
+Перенос файлов из LONGBLOB-столбцов chat.document_data и document.data
+в хранилище файлов (storage.py).
+
+    python migrate_blobs.py                  # добавить столбцы хэша и размера, перенести файлы
+    python migrate_blobs.py --drop-columns   # затем удалить старые столбцы
+    python migrate_blobs.py --gc             # удалить из хранилища файлы, на которые нет ссылок
+
+Перенос можно прерывать и запускать снова: строки, у которых хэш уже
+записан, пропускаются. Старые столбцы удаляются, только если все файлы
+перенесены.
+"""
+import argparse
+from sqlalchemy import inspect, text
+from database import engine
+from storage import blob_store
+
+
+# (таблица, старый столбец, столбец хэша, столбец размера)
+TABLES = [
+    ("chat", "document_data", "document_sha256", "document_size"),
+    ("document", "data", "sha256", "size"),
+]
+
+
+def columns(table: str) -> set[str]:
+    return {column["name"] for column in inspect(engine).get_columns(table)}
+
+
+def add_columns():
+    for table, _, sha_column, size_column in TABLES:
+        existing = columns(table)
+        with engine.begin() as connection:
+            if sha_column not in existing:
+                connection.execute(text(f"ALTER TABLE `{table}` ADD COLUMN `{sha_column}` VARCHAR(64) NULL"))
+                connection.execute(text(f"CREATE INDEX `ix_{table}_{sha_column}` ON `{table}` (`{sha_column}`)"))
+            if size_column not in existing:
+                connection.execute(text(f"ALTER TABLE `{table}` ADD COLUMN `{size_column}` INT NULL"))
+
+
+def move_blobs():
+    for table, data_column, sha_column, size_column in TABLES:
+        if data_column not in columns(table):
+            print(f"{table}: столбца {data_column} уже нет")
+            continue
+        with engine.connect() as connection:
+            ids = connection.execute(text(f"SELECT id FROM `{table}` WHERE `{sha_column}` IS NULL")).scalars().all()
+        moved = 0
+        # по одной строке: в памяти не больше одного файла
+        for row_id in ids:
+            with engine.begin() as connection:
+                data = connection.execute(text(f"SELECT `{data_column}` FROM `{table}` WHERE id = :id"), {"id": row_id}).scalar()
+                if data is None and table == "chat":     # работа ещё не загружена
+                    continue
+                blob = blob_store.put(data or b"")
+                connection.execute(
+                    text(f"UPDATE `{table}` SET `{sha_column}` = :sha, `{size_column}` = :size WHERE id = :id"),
+                    {"sha": blob.sha256, "size": blob.size, "id": row_id},
+                )
+            moved += 1
+        print(f"{table}: перенесено файлов: {moved}")
+
+
+def drop_columns():
+    for table, data_column, sha_column, size_column in TABLES:
+        if data_column not in columns(table):
+            continue
+        with engine.begin() as connection:
+            left = connection.execute(text(
+                f"SELECT COUNT(*) FROM `{table}` WHERE `{data_column}` IS NOT NULL AND `{sha_column}` IS NULL"
+            )).scalar()
+            if left:
+                raise SystemExit(f"{table}: не перенесено файлов: {left}; сначала запустите перенос")
+            connection.execute(text(f"ALTER TABLE `{table}` DROP COLUMN `{data_column}`"))
+            if table == "document":
+                connection.execute(text(f"ALTER TABLE `{table}` MODIFY `{sha_column}` VARCHAR(64) NOT NULL, MODIFY `{size_column}` INT NOT NULL DEFAULT 0"))
+        print(f"{table}: столбец {data_column} удалён")
+
+
+def collect_garbage():
+    referenced = set()
+    with engine.connect() as connection:
+        for table, _, sha_column, _ in TABLES:
+            referenced.update(connection.execute(text(f"SELECT DISTINCT `{sha_column}` FROM `{table}` WHERE `{sha_column}` IS NOT NULL")).scalars())
+    print(f"удалено файлов без ссылок: {blob_store.collect_garbage(referenced)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--drop-columns", action="store_true", help="удалить старые LONGBLOB-столбцы")
+    parser.add_argument("--gc", action="store_true", help="удалить файлы, на которые нет ссылок")
+    args = parser.parse_args()
+
+    if args.gc:
+        collect_garbage()
+    else:
+        add_columns()
+        move_blobs()
+        if args.drop_columns:
+            drop_columns()
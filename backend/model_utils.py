@@ -1,73 +1,324 @@
+"""
+Работа с моделями: локальная Gemma и Mistral по API.
+
+torch, transformers, peft, huggingface_hub и mistralai здесь импортируются
+только внутри функций — при первом запросе к модели, а не при импорте модуля.
+Поэтому веб-воркер, который обслуживает только /users/login и т.п.,
+стартует без них и без обращения к сети.
+"""
+from __future__ import annotations
+import asyncio
+import copy
+import hashlib
+import json
+import mmap
 import os
+import random
+import struct
+from collections import OrderedDict
 from functools import lru_cache
-import torch
-from huggingface_hub import login
-from peft import PeftModel
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from threading import Lock, Thread
+from typing import TYPE_CHECKING, AsyncIterator, Iterator
+import telemetry
+from hedging import HedgedRouter
+from inference_server import INFERENCE_SERVER_ADDRESS, remote_generate, remote_stream
+from json_grammar import constrained_generate_kwargs, reply_matches_schema
+from llm_cache import LLM_CACHE_ENABLED, make_key, response_cache
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+
+if TYPE_CHECKING:
+    import torch
+    from mistralai import Mistral
 
 
-# Авторизация в HuggingFace
-# HF_TOKEN = os.getenv("HF_TOKEN")
-# if HF_TOKEN:
-login("...")
+# Авторизация в HuggingFace — только перед первой загрузкой с хаба
+HF_TOKEN = os.getenv("HF_TOKEN")
+
+
+@lru_cache
+def hf_login():
+    if HF_TOKEN:
+        from huggingface_hub import login
+        login(HF_TOKEN)
 
 
 BASE_MODEL_NAME = "google/gemma-3-1b-it"
 ADAPTER_PATH    = "fine-tuned-gemma"
+# Слитая с LoRA модель (см. compile_merged_model)
+MERGED_MODEL_PATH = os.getenv("MERGED_MODEL_PATH", "fine-tuned-gemma-merged")
 
 MAX_NEW_TOKENS  = 512
 TEMPERATURE     = 0.5
 TOP_P           = 0.9
 
+# Квантование локальной модели: "none" (bfloat16) или "int8" (динамическое, для CPU без быстрого bf16)
+MODEL_QUANTIZATION = os.getenv("MODEL_QUANTIZATION", "none")
 
-# Однократная (кэшированная) загрузка
-@lru_cache
-def load_model():
+# Какой бэкенд отвечает в чате: "mistral" (API) или "local" (Gemma)
+LLM_BACKEND     = os.getenv("LLM_BACKEND", "mistral")
+# Хеджирование: медленные запросы к LLM_BACKEND дублируются второму бэкенду (hedging.py)
+LLM_HEDGE       = os.getenv("LLM_HEDGE", "0") == "1"
+# Локальные запросы идут через планировщик батчей (batching.py)
+LOCAL_BATCHING  = os.getenv("LOCAL_BATCHING", "0") == "1"
+
+# Кэш KV-префиксов: бюджет памяти и длина HybridCache
+PREFIX_CACHE_BUDGET_MB = int(os.getenv("PREFIX_CACHE_BUDGET_MB", "512"))
+PREFIX_CACHE_MAX_LEN   = int(os.getenv("PREFIX_CACHE_MAX_LEN", "8192"))
+
+# Типы safetensors -> имена типов torch
+_SAFETENSORS_DTYPES = {
+    "F64": "float64", "F32": "float32", "F16": "float16", "BF16": "bfloat16",
+    "I64": "int64", "I32": "int32", "I16": "int16", "I8": "int8",
+    "U8": "uint8", "BOOL": "bool",
+}
+
+
+# Слияние LoRA с базовыми весами («компиляция» модели)
+def compile_merged_model(
+    output_dir: str = MERGED_MODEL_PATH,
+    base_model_name: str = BASE_MODEL_NAME,
+    adapter_path: str = ADAPTER_PATH,
+    dtype: torch.dtype | None = None,
+) -> str:
     """
-    Возвращает (tokenizer, model). Загружается один раз на процесс.
-    Если запущено через gunicorn --preload, память не копируется.
+    Вливает LoRA-адаптер в базовые веса и сохраняет результат одним
+    safetensors-файлом вместе с токенизатором. Запускается один раз
+    (python compile_model.py), после чего load_model() грузит снимок через mmap.
     """
-    # токенизатор
+    import torch
+    from peft import PeftModel
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    hf_login()
     tokenizer = AutoTokenizer.from_pretrained(
-        ADAPTER_PATH,
+        adapter_path,
         use_fast=True,
         trust_remote_code=True,
     )
-    tokenizer.pad_token = tokenizer.pad_token or tokenizer.eos_token
-
-    # базовая Gemma
-    dtype  = torch.bfloat16          # экономит ×2 RAM на CPU
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-
     base = AutoModelForCausalLM.from_pretrained(
-        BASE_MODEL_NAME,
-        torch_dtype=dtype,
-        device_map="auto",            # на CPU – просто «cpu»
-        low_cpu_mem_usage=True,       # загружает блоками → меньше пик RAM
+        base_model_name,
+        torch_dtype=dtype or torch.bfloat16,
+        low_cpu_mem_usage=True,
         trust_remote_code=True,
     )
-    base.eval()
-
-    # LoRA-адаптер
-    model = PeftModel.from_pretrained(
-        base,
-        ADAPTER_PATH,
-        torch_dtype=dtype,
-        device_map="auto",
-    )
+    model = PeftModel.from_pretrained(base, adapter_path).merge_and_unload()
+
+    # один файл без шардов — его удобнее целиком отображать в память
+    model.save_pretrained(output_dir, safe_serialization=True, max_shard_size="100GB")
+    tokenizer.save_pretrained(output_dir)
+    return output_dir
+
+
+def mmap_safetensors(path: str) -> dict:
+    """
+    Отображает safetensors-файл в память и возвращает тензоры без копирования.
+    Страницы открыты как copy-on-write, поэтому воркеры gunicorn делят
+    одни и те же страницы page cache, пока никто не пишет в веса.
+    """
+    import torch
+
+    with open(path, "rb") as file:
+        mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    header_len = struct.unpack("<Q", mm[:8])[0]
+    header = json.loads(mm[8:8 + header_len])
+    data_start = 8 + header_len
+
+    state = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = getattr(torch, _SAFETENSORS_DTYPES[info["dtype"]])
+        begin, end = info["data_offsets"]
+        count = (end - begin) // dtype.itemsize
+        if count == 0:
+            state[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        tensor = torch.frombuffer(mm, dtype=dtype, count=count, offset=data_start + begin)
+        state[name] = tensor.reshape(info["shape"])
+    return state
+
+
+class SnapshotMismatchError(RuntimeError):
+    """Слитый снимок не подходит к модели: устарел или собран для другой версии"""
+
+
+def load_merged_snapshot(path: str = MERGED_MODEL_PATH):
+    """
+    Собирает модель из слитого снимка: параметры не инициализируются,
+    а сразу подменяются тензорами из mmap (load_state_dict(assign=True)).
+    SnapshotMismatchError — если в снимке не хватает весов или есть лишние.
+    """
+    from transformers import AutoConfig, AutoModelForCausalLM
+    from transformers.modeling_utils import no_init_weights
+
+    config = AutoConfig.from_pretrained(path)
+    with no_init_weights():
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=config.torch_dtype)
+
+    index_path = os.path.join(path, "model.safetensors.index.json")
+    if os.path.isfile(index_path):
+        with open(index_path, encoding="utf-8") as file:
+            shards = sorted(set(json.load(file)["weight_map"].values()))
+    else:
+        shards = ["model.safetensors"]
+
+    state = {}
+    for shard in shards:
+        state.update(mmap_safetensors(os.path.join(path, shard)))
+    loaded = model.load_state_dict(state, strict=False, assign=True)
+    # отсутствовать может только lm_head при связанных весах; иначе параметры
+    # остались бы неинициализированными, и модель молча отвечала бы мусором
+    allowed_missing = {"lm_head.weight"} if getattr(config, "tie_word_embeddings", False) else set()
+    missing = sorted(set(loaded.missing_keys) - allowed_missing)
+    if missing or loaded.unexpected_keys:
+        raise SnapshotMismatchError(
+            f"Снимок {path} не совпадает с моделью (нет: {missing[:5]}, лишние: {sorted(loaded.unexpected_keys)[:5]}); "
+            "пересоберите его: python compile_model.py"
+        )
+    model.tie_weights()   # lm_head разделяет веса с embed_tokens
     model.eval()
+    return model
+
+
+def has_merged_snapshot(path: str = MERGED_MODEL_PATH) -> bool:
+    return (os.path.isfile(os.path.join(path, "model.safetensors"))
+            or os.path.isfile(os.path.join(path, "model.safetensors.index.json")))
+
+
+# Подсчёт токенов
+CHARS_PER_TOKEN = float(os.getenv("CHARS_PER_TOKEN", "3.5"))   # оценка для Mistral (токенизатора нет под рукой)
+
+
+@lru_cache
+def load_tokenizer():
+    """Только токенизатор локальной модели — без загрузки весов"""
+    from transformers import AutoTokenizer
+
+    path = MERGED_MODEL_PATH if has_merged_snapshot() else ADAPTER_PATH
+    return AutoTokenizer.from_pretrained(path, use_fast=True, trust_remote_code=True)
+
+
+def count_tokens(text: str) -> int:
+    """
+    Число токенов текста для выбранного бэкенда: точное для локальной модели,
+    приблизительное (по CHARS_PER_TOKEN) для Mistral.
+    """
+    if LLM_BACKEND == "local":
+        return len(load_tokenizer()(text, add_special_tokens=False)["input_ids"])
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+
+# Квантование для CPU
+def quantize_int8(model):
+    """
+    Динамическое int8-квантование всех nn.Linear (веса в int8, активации
+    квантуются на лету). LoRA должна быть уже влита: слои peft квантовать нельзя.
+    quantize_dynamic работает с float32, поэтому модель сначала приводится к нему.
+    """
+    import torch
+
+    if hasattr(model, "merge_and_unload"):
+        model = model.merge_and_unload()
+    model = model.float()
+    model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    model.eval()
+    return model
+
+
+# Загрузка без кэширования — нужна бенчмаркам, чтобы сравнить варианты
+def load_model_variant(quantization: str = MODEL_QUANTIZATION):
+    """
+    Возвращает (tokenizer, model) для заданного режима квантования:
+    "none" — bfloat16 как есть, "int8" — динамическое int8 после слияния LoRA (только CPU).
+    """
+    import torch
+    from peft import PeftModel
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    if quantization not in {"none", "int8"}:
+        raise ValueError(f"Неизвестный режим квантования: {quantization}")
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    if has_merged_snapshot():
+        tokenizer = AutoTokenizer.from_pretrained(MERGED_MODEL_PATH, use_fast=True)
+        tokenizer.pad_token = tokenizer.pad_token or tokenizer.eos_token
+        try:
+            model = load_merged_snapshot(MERGED_MODEL_PATH)
+        except SnapshotMismatchError:
+            # снимок от другой версии модели или transformers — собираем заново из базовой модели и LoRA
+            compile_merged_model(MERGED_MODEL_PATH)
+            model = load_merged_snapshot(MERGED_MODEL_PATH)
+    else:
+        hf_login()
+
+        # токенизатор
+        tokenizer = AutoTokenizer.from_pretrained(
+            ADAPTER_PATH,
+            use_fast=True,
+            trust_remote_code=True,
+        )
+        tokenizer.pad_token = tokenizer.pad_token or tokenizer.eos_token
+
+        # базовая Gemma
+        dtype  = torch.bfloat16          # экономит ×2 RAM на CPU
+
+        base = AutoModelForCausalLM.from_pretrained(
+            BASE_MODEL_NAME,
+            torch_dtype=dtype,
+            device_map="auto",            # на CPU – просто «cpu»
+            low_cpu_mem_usage=True,       # загружает блоками → меньше пик RAM
+            trust_remote_code=True,
+        )
+        base.eval()
+
+        # LoRA-адаптер
+        model = PeftModel.from_pretrained(
+            base,
+            ADAPTER_PATH,
+            torch_dtype=dtype,
+            device_map="auto",
+        )
+        model.eval()
+
+    # квантованные int8-ядра есть только для CPU
+    if quantization == "int8" and device == "cpu":
+        model = quantize_int8(model)
+    elif device != "cpu" and model.device.type == "cpu":
+        model = model.to(device)
 
     return tokenizer, model
 
 
+# Однократная (кэшированная) загрузка
+@lru_cache
+def load_model():
+    """
+    Возвращает (tokenizer, model). Загружается один раз на процесс.
+    Если есть слитый снимок (compile_merged_model), веса берутся из него через mmap;
+    иначе — базовая Gemma + LoRA-адаптер, как раньше.
+    Режим квантования задаётся MODEL_QUANTIZATION.
+    Если запущено через gunicorn --preload, память не копируется.
+    """
+    return load_model_variant(MODEL_QUANTIZATION)
+
+
 # Функция генерации
-def generate_once(prompt: str) -> str:
+def generate_once(prompt: str, schema: dict | None = None) -> str:
     """
     Генерирует полный ответ модели (без стриминга).
+    Возвращает только продолжение, без текста промпта.
+    Со schema ответ ограничен JSON-объектом этой схемы (json_grammar),
+    а генерация останавливается, как только объект закрыт.
     """
+    import torch
+
+    telemetry.mark_dequeued()
     tok, mdl = load_model()
 
     inputs = tok(prompt, return_tensors="pt").to(mdl.device)
+    prompt_len = inputs["input_ids"].shape[1]
 
     with torch.no_grad():
         out_ids = mdl.generate(
@@ -76,15 +327,271 @@ def generate_once(prompt: str) -> str:
             temperature=TEMPERATURE,
             top_p=TOP_P,
             eos_token_id=tok.eos_token_id,
+            streamer=telemetry.FirstTokenTimer(),
+            **constrained_generate_kwargs(tok, schema, prompt_len),
+        )
+
+    telemetry.set_tokens(prompt_len, out_ids.shape[1] - prompt_len)
+    return tok.decode(out_ids[0][prompt_len:], skip_special_tokens=True)
+
+
+# Потоковая генерация
+def stream_once(prompt: str) -> Iterator[str]:
+    """
+    Генерирует ответ модели по кусочкам текста.
+    Сама генерация идёт в фоновом потоке, а TextIteratorStreamer
+    отдаёт декодированные фрагменты по мере появления токенов.
+    """
+    import torch
+    from transformers import TextIteratorStreamer
+
+    telemetry.mark_dequeued()
+    tok, mdl = load_model()
+
+    inputs = tok(prompt, return_tensors="pt").to(mdl.device)
+    streamer = TextIteratorStreamer(tok, skip_prompt=True, skip_special_tokens=True)
+    errors: list[BaseException] = []
+
+    def _generate():
+        try:
+            with torch.no_grad():
+                mdl.generate(
+                    **inputs,
+                    max_new_tokens=MAX_NEW_TOKENS,
+                    temperature=TEMPERATURE,
+                    top_p=TOP_P,
+                    eos_token_id=tok.eos_token_id,
+                    streamer=streamer,
+                )
+        except BaseException as error:
+            # без сигнала конца потребитель streamer ждал бы вечно
+            errors.append(error)
+            streamer.end()
+
+    thread = Thread(target=_generate, daemon=True)
+    thread.start()
+    for text in streamer:
+        if text:
+            yield text
+    thread.join()
+    if errors:
+        raise errors[0]
+
+
+# Кэш KV-префиксов
+class PrefixCache:
+    """
+    LRU-кэш past-key-values для постоянных префиксов промптов.
+    Ключ — строка вроде "work:12:check"; для каждого ключа хранится один
+    префикс (по хэшу его токенов). Если суммарный размер тензоров превышает
+    бюджет, вытесняются давно не использованные записи.
+    """
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self._entries: OrderedDict[str, tuple] = OrderedDict()   # key -> (digest, cache, n_tokens, nbytes)
+        self._size = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def digest(prefix_ids: torch.Tensor) -> str:
+        return hashlib.sha256(prefix_ids.cpu().numpy().tobytes()).hexdigest()
+
+    @staticmethod
+    def _nbytes(cache) -> int:
+        return sum(t.numel() * t.element_size() for t in (*cache.key_cache, *cache.value_cache))
+
+    def get(self, key: str, digest: str):
+        """Возвращает копию закэшированного префикса или None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != digest:
+                return None
+            self._entries.move_to_end(key)
+            cache = entry[1]
+        # генерация дописывает в кэш, поэтому отдаём копию
+        return copy.deepcopy(cache)
+
+    def put(self, key: str, digest: str, cache, n_tokens: int):
+        nbytes = self._nbytes(cache)
+        if nbytes > self.budget_bytes:
+            return
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (digest, cache, n_tokens, nbytes)
+            self._size += nbytes
+            while self._size > self.budget_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._pop(key)
+
+    def _pop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[3]
+
+
+prefix_cache = PrefixCache(PREFIX_CACHE_BUDGET_MB * 1024 * 1024)
+
+
+@lru_cache
+def _window_cache_class():
+    """
+    HybridCache, который умеет дописывать несколько токенов после кэшированного префикса.
+
+    Штатный HybridCache в transformers 4.51 кладёт в скользящие слои порцию токенов
+    как в пустой кэш, а Gemma3DecoderLayer строит маску окна, считая, что промпт
+    начинается с нулевой позиции. Здесь скользящий слой возвращает ключи окна перед
+    порцией и саму порцию, а маску для них подставляет _window_prefill_hook.
+    После дописывания в слое лежат последние токены окна по порядку — так же, как
+    после полного прогона промпта, поэтому дальше декодирование идёт штатно.
+    """
+    import torch
+    from transformers import HybridCache
+
+    class WindowHybridCache(HybridCache):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.filled = 0
+
+        def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+            cache_position = (cache_kwargs or {}).get("cache_position")
+            if layer_idx == 0 and cache_position is not None:
+                self.filled = max(self.filled, int(cache_position[-1]) + 1)
+            return super().update(key_states, value_states, layer_idx, cache_kwargs)
+
+        def get_seq_length(self, layer_idx: int | None = 0) -> int:
+            # штатный подсчёт занятых ячеек первого (скользящего) слоя не больше окна
+            return self.filled
+
+        def _sliding_update(self, cache_position, layer_idx, key_states, value_states, k_out, v_out, max_cache_len):
+            start = int(cache_position[0])
+            if start == 0 or key_states.shape[2] == 1:
+                return super()._sliding_update(
+                    cache_position, layer_idx, key_states, value_states, k_out, v_out, max_cache_len
+                )
+            window = min(start, max_cache_len)
+            full_keys = torch.cat((k_out[:, :, :window], key_states), dim=2)
+            full_values = torch.cat((v_out[:, :, :window], value_states), dim=2)
+            keep = min(full_keys.shape[2], max_cache_len)
+            self.key_cache[layer_idx].zero_()
+            self.value_cache[layer_idx].zero_()
+            self.key_cache[layer_idx][:, :, :keep].copy_(full_keys[:, :, -keep:])
+            self.value_cache[layer_idx][:, :, :keep].copy_(full_values[:, :, -keep:])
+            return full_keys, full_values
+
+    return WindowHybridCache
+
+
+def _window_prefill_hook(module, args, kwargs):
+    """
+    Маска скользящего слоя для порции токенов после префикса: ключи — окно перед
+    порцией и сама порция (см. _window_cache_class), каждый токен видит не больше
+    sliding_window последних позиций, включая себя.
+    """
+    import torch
+
+    cache = kwargs.get("past_key_value")
+    cache_position = kwargs.get("cache_position")
+    hidden_states = kwargs.get("hidden_states", args[0] if args else None)
+    if (
+        not isinstance(cache, _window_cache_class())
+        or cache_position is None
+        or hidden_states.shape[1] == 1
+        or int(cache_position[0]) == 0
+    ):
+        return None
+
+    n_queries = hidden_states.shape[1]
+    window = min(int(cache_position[0]), cache.key_cache[module.layer_idx].shape[2])
+    rows = torch.arange(n_queries, device=hidden_states.device)[:, None] + window
+    cols = torch.arange(window + n_queries, device=hidden_states.device)[None, :]
+    allowed = (cols <= rows) & (cols > rows - module.sliding_window)
+    mask = torch.zeros(allowed.shape, dtype=hidden_states.dtype, device=hidden_states.device)
+    mask = mask.masked_fill(~allowed, torch.finfo(hidden_states.dtype).min)
+    return args, {**kwargs, "attention_mask": mask[None, None]}
+
+
+def _enable_window_prefill(mdl):
+    """Один раз на модель вешает _window_prefill_hook на слои внимания со скользящим окном"""
+    if getattr(mdl, "_window_prefill_enabled", False):
+        return
+    for module in mdl.modules():
+        if getattr(module, "is_sliding", False) and hasattr(module, "o_proj"):
+            module.register_forward_pre_hook(_window_prefill_hook, with_kwargs=True)
+    mdl._window_prefill_enabled = True
+
+
+def _build_prefix_cache(mdl, prefix_ids: torch.Tensor):
+    """Прогоняет префикс через модель и возвращает заполненный кэш (см. _window_cache_class)"""
+    import torch
+
+    cache = _window_cache_class()(
+        config=mdl.config,
+        max_batch_size=1,
+        max_cache_len=PREFIX_CACHE_MAX_LEN,
+        device=mdl.device,
+        dtype=mdl.dtype,
+    )
+    with torch.no_grad():
+        mdl(
+            input_ids=prefix_ids,
+            past_key_values=cache,
+            use_cache=True,
+            cache_position=torch.arange(prefix_ids.shape[1], device=mdl.device),
         )
+    return cache
+
+
+def generate_with_prefix(prefix: str, suffix: str, cache_key: str, schema: dict | None = None) -> str:
+    """
+    Генерирует ответ на prefix + suffix, переиспользуя KV-кэш префикса.
+    На каждом запросе заново считается только suffix (часть, зависящая от студента).
+    """
+    import torch
+
+    telemetry.mark_dequeued()
+    tok, mdl = load_model()
+
+    prefix_ids = tok(prefix, return_tensors="pt")["input_ids"].to(mdl.device)
+    suffix_ids = tok(suffix, add_special_tokens=False, return_tensors="pt")["input_ids"].to(mdl.device)
+    input_ids = torch.cat([prefix_ids, suffix_ids], dim=1)
+    input_len = input_ids.shape[1]
+
+    # глобальные слои кэша рассчитаны на PREFIX_CACHE_MAX_LEN позиций
+    if input_len + MAX_NEW_TOKENS > PREFIX_CACHE_MAX_LEN:
+        return generate_once(prefix + suffix, schema)
+    # suffix дописывается к префиксу одной порцией и при выходе за скользящее окно
+    # (проверка: python -m benchmarks.check_prefix_cache)
+    _enable_window_prefill(mdl)
 
-    return tok.decode(out_ids[0], skip_special_tokens=True)
+    digest = PrefixCache.digest(prefix_ids)
+    cache = prefix_cache.get(cache_key, digest)
+    if cache is None:
+        cache = _build_prefix_cache(mdl, prefix_ids)
+        prefix_cache.put(cache_key, digest, cache, prefix_ids.shape[1])
+        cache = copy.deepcopy(cache)
 
+    with torch.no_grad():
+        out_ids = mdl.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=cache,
+            cache_implementation=None,
+            max_new_tokens=MAX_NEW_TOKENS,
+            temperature=TEMPERATURE,
+            top_p=TOP_P,
+            eos_token_id=tok.eos_token_id,
+            streamer=telemetry.FirstTokenTimer(),
+            **constrained_generate_kwargs(tok, schema, input_len),
+        )
 
+    telemetry.set_tokens(input_len, out_ids.shape[1] - input_len)
+    return tok.decode(out_ids[0][input_len:], skip_special_tokens=True)
 
 
 # Обращение к модели Mistral по API
-from mistralai import Mistral
 
 
 MISTRAL_MODEL   = "mistral-small-latest"
@@ -92,16 +599,264 @@ MAX_NEW_TOKENS  = 512
 TEMPERATURE     = 0.5
 TOP_P           = 0.9
 
+# Пул соединений и ограничения для Mistral (на один воркер)
+MISTRAL_SERVER_URL    = os.getenv("MISTRAL_SERVER_URL")                  # например, локальный фейковый сервер
+MISTRAL_MAX_IN_FLIGHT = int(os.getenv("MISTRAL_MAX_IN_FLIGHT", "8"))    # одновременных запросов
+MISTRAL_TIMEOUT       = float(os.getenv("MISTRAL_TIMEOUT", "60"))       # на одну попытку, сек
+MISTRAL_RETRIES       = int(os.getenv("MISTRAL_RETRIES", "3"))          # повторов на 429/5xx/таймаут
+MISTRAL_BACKOFF       = float(os.getenv("MISTRAL_BACKOFF", "0.5"))      # базовая пауза между повторами, сек
+
+_mistral_client: Mistral | None = None
+_mistral_semaphore = asyncio.Semaphore(MISTRAL_MAX_IN_FLIGHT)
 
-async def generate_once_mistral(prompt: str) -> str:
-    api_key = os.getenv("MISTRAL_API_KEY", "...")
-    client  = Mistral(api_key=api_key)
 
-    response = client.chat.complete(
-        model="mistral-small-latest",
+def get_mistral_client() -> Mistral:
+    """
+    Один долгоживущий клиент на процесс: httpx.AsyncClient держит
+    keep-alive соединения, поэтому TLS не поднимается на каждый запрос.
+    """
+    global _mistral_client
+    if _mistral_client is None:
+        import httpx
+        from mistralai import Mistral
+
+        async_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=MISTRAL_MAX_IN_FLIGHT,
+                max_keepalive_connections=MISTRAL_MAX_IN_FLIGHT,
+            ),
+            timeout=MISTRAL_TIMEOUT,
+        )
+        _mistral_client = Mistral(
+            api_key=os.getenv("MISTRAL_API_KEY", "..."),
+            server_url=MISTRAL_SERVER_URL,
+            async_client=async_client,
+            timeout_ms=int(MISTRAL_TIMEOUT * 1000),
+        )
+    return _mistral_client
+
+
+def _is_retryable(error: Exception) -> bool:
+    import httpx
+
+    if isinstance(error, (asyncio.TimeoutError, httpx.TimeoutException, httpx.TransportError)):
+        return True
+    status_code = getattr(error, "status_code", None)
+    return status_code == 429 or (status_code is not None and status_code >= 500)
+
+
+def _retry_delay(error: Exception, attempt: int) -> float:
+    """Экспоненциальная пауза с полным джиттером; Retry-After от сервера важнее"""
+    raw_response = getattr(error, "raw_response", None)
+    retry_after = raw_response.headers.get("retry-after") if raw_response is not None else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return random.uniform(0, MISTRAL_BACKOFF * 2 ** attempt)
+
+
+async def _call_mistral(make_request):
+    """
+    Выполняет запрос к Mistral с ограничением числа одновременных запросов,
+    таймаутом на попытку и повторами на 429/5xx. На время паузы между
+    повторами место в семафоре освобождается.
+    """
+    for attempt in range(MISTRAL_RETRIES + 1):
+        try:
+            async with _mistral_semaphore:
+                telemetry.mark_dequeued()
+                return await asyncio.wait_for(make_request(get_mistral_client()), MISTRAL_TIMEOUT)
+        except Exception as error:
+            if attempt == MISTRAL_RETRIES or not _is_retryable(error):
+                raise
+            await asyncio.sleep(_retry_delay(error, attempt))
+
+
+async def generate_once_mistral(prompt: str, json_mode: bool = False) -> str:
+    # грамматику Mistral не принимает, но JSON-режим гарантирует синтаксически верный объект
+    response = await _call_mistral(lambda client: client.chat.complete_async(
+        model=MISTRAL_MODEL,
         messages=[
             {"role": "user", "content": prompt}
-        ]
-    )
+        ],
+        response_format={"type": "json_object"} if json_mode else None,
+    ))
+    if response.usage is not None:
+        telemetry.set_tokens(response.usage.prompt_tokens, response.usage.completion_tokens)
     # Mistral возвращает сразу один choice
     return response.choices[0].message.content.strip()
+
+
+async def stream_once_mistral(prompt: str) -> AsyncIterator[str]:
+    """
+    Потоковый ответ Mistral: отдаёт фрагменты текста по мере их прихода.
+    Повторы возможны только до начала потока; место в семафоре занято, пока поток читается.
+    """
+    await _mistral_semaphore.acquire()
+    try:
+        for attempt in range(MISTRAL_RETRIES + 1):
+            try:
+                response = await asyncio.wait_for(get_mistral_client().chat.stream_async(
+                    model=MISTRAL_MODEL,
+                    messages=[
+                        {"role": "user", "content": prompt}
+                    ]
+                ), MISTRAL_TIMEOUT)
+                break
+            except Exception as error:
+                if attempt == MISTRAL_RETRIES or not _is_retryable(error):
+                    raise
+                await asyncio.sleep(_retry_delay(error, attempt))
+
+        async for event in response:
+            delta = event.data.choices[0].delta.content
+            if delta:
+                yield delta
+    finally:
+        _mistral_semaphore.release()
+
+
+async def stream_answer(prompt: str, stage: str | None = None) -> AsyncIterator[str]:
+    """
+    Потоковый ответ выбранного в LLM_BACKEND бэкенда.
+    Синхронный генератор локальной модели обходится в пуле потоков,
+    чтобы не блокировать цикл событий.
+    stage — этап чата для телеметрии (генератор читается вне контекста вызывающего).
+    """
+    # контекстные переменные в асинхронном генераторе ненадёжны — замер ведём явно
+    call = telemetry.LLMCall(stage or telemetry.current_stage(), LLM_BACKEND)
+    call.cached = False
+    parts = []
+    error = None
+    try:
+        if LLM_BACKEND == "local":
+            chunks = remote_stream(prompt) if INFERENCE_SERVER_ADDRESS else iterate_in_threadpool(stream_once(prompt))
+        else:
+            chunks = stream_once_mistral(prompt)
+        async for text in chunks:
+            call.mark_first_token()
+            parts.append(text)
+            yield text
+    except BaseException as exc:
+        error = exc
+        raise
+    finally:
+        call.prompt_tokens = count_tokens(prompt)
+        call.completion_tokens = count_tokens("".join(parts))
+        telemetry.finish_call(call, error)
+
+
+
+async def _generate_local(prompt: str, prefix: str, cache_key: str | None, schema: dict | None) -> str:
+    # планировщик батчей ограниченную генерацию не поддерживает
+    batching = LOCAL_BATCHING and schema is None
+    # модель живёт в отдельном процессе (inference_server.py)
+    if INFERENCE_SERVER_ADDRESS:
+        if prefix and cache_key:
+            answer = await remote_generate("generate_with_prefix", prefix, prompt, cache_key, schema)
+        elif batching:
+            answer = await remote_generate("generate_batched", prefix + prompt)
+        else:
+            answer = await remote_generate("generate", prefix + prompt, schema)
+    elif prefix and cache_key:
+        answer = await run_in_threadpool(generate_with_prefix, prefix, prompt, cache_key, schema)
+    elif batching:
+        from batching import generate_batched
+        answer = await generate_batched(prefix + prompt)
+    else:
+        answer = await run_in_threadpool(generate_once, prefix + prompt, schema)
+    telemetry.set_backend("local")
+    return answer
+
+
+async def _generate_mistral(prompt: str, prefix: str, cache_key: str | None, schema: dict | None) -> str:
+    answer = await generate_once_mistral(prefix + prompt, json_mode=schema is not None)
+    telemetry.set_backend("mistral")
+    return answer
+
+
+async def _generate_measured(prompt: str, prefix: str, cache_key: str | None, schema: dict | None) -> str:
+    """Генерация с дополнением замеров: токены, которые бэкенд не сообщил, оцениваются"""
+    call = telemetry.current_call()
+    if call is not None:
+        call.cached = False
+    answer = await _generate_answer(prompt, prefix, cache_key, schema)
+    if call is not None:
+        if call.prompt_tokens is None:
+            call.prompt_tokens = count_tokens(prefix + prompt)
+        if call.completion_tokens is None:
+            call.completion_tokens = count_tokens(answer)
+    return answer
+
+
+_hedged_router: HedgedRouter | None = None
+
+
+def get_hedged_router() -> HedgedRouter:
+    """
+    Основной бэкенд — LLM_BACKEND, запасной — другой. Отменённый локальный
+    запрос дорабатывает в своём потоке (generate нельзя прервать), но его
+    результат уже никто не ждёт.
+    """
+    global _hedged_router
+    if _hedged_router is None:
+        primary = "local" if LLM_BACKEND == "local" else "mistral"
+        _hedged_router = HedgedRouter(
+            {"local": _generate_local, "mistral": _generate_mistral},
+            primary=primary,
+            secondary="mistral" if primary == "local" else "local",
+        )
+    return _hedged_router
+
+
+async def _generate_answer(prompt: str, prefix: str, cache_key: str | None, schema: dict | None) -> str:
+    if LLM_HEDGE:
+        return await get_hedged_router().generate(prompt, prefix, cache_key, schema)
+    if LLM_BACKEND == "local":
+        return await _generate_local(prompt, prefix, cache_key, schema)
+    return await _generate_mistral(prompt, prefix, cache_key, schema)
+
+
+async def generate_answer(
+    prompt: str,
+    prefix: str = "",
+    cache_key: str | None = None,
+    use_cache: bool = False,
+    schema: dict | None = None,
+) -> str:
+    """
+    Ответ выбранного в LLM_BACKEND бэкенда на prefix + prompt.
+    Для локальной модели постоянный prefix с ключом cache_key берётся из кэша KV-префиксов.
+    С use_cache=True ответ берётся из кэша ответов (llm_cache), а одинаковые
+    запросы в полёте ждут одну генерацию.
+    schema (см. json_grammar) ограничивает локальную генерацию JSON-объектом
+    этой схемы; Mistral в этом случае отвечает в JSON-режиме.
+    """
+    with telemetry.llm_call("hedged" if LLM_HEDGE else LLM_BACKEND):
+        if not (use_cache and LLM_CACHE_ENABLED):
+            return await _generate_measured(prompt, prefix, cache_key, schema)
+        return await _cached_answer(prompt, prefix, cache_key, schema)
+
+
+async def _cached_answer(prompt: str, prefix: str, cache_key: str | None, schema: dict | None) -> str:
+    """Ответ через кэш ответов: ключ — промпт и всё, что влияет на генерацию"""
+    local_model = (MERGED_MODEL_PATH if has_merged_snapshot() else f"{BASE_MODEL_NAME}+{ADAPTER_PATH}") + f":{MODEL_QUANTIZATION}"
+    if LLM_HEDGE:
+        # ответ может прийти от любого из бэкендов
+        model = f"{MISTRAL_MODEL}|{local_model}"
+    else:
+        model = local_model if LLM_BACKEND == "local" else MISTRAL_MODEL
+    key = make_key(
+        prefix + prompt,
+        backend="hedged" if LLM_HEDGE else LLM_BACKEND,
+        model=model,
+        max_new_tokens=MAX_NEW_TOKENS,
+        temperature=TEMPERATURE,
+        top_p=TOP_P,
+        schema=schema,
+    )
+    # ответ, который не разбирается по схеме, не кэшируется: повтор проверки сгенерирует его заново
+    validate = (lambda reply: reply_matches_schema(reply, schema)) if schema else None
+    return await response_cache.get_or_generate(key, lambda: _generate_measured(prompt, prefix, cache_key, schema), validate)
@@ -1,9 +1,10 @@
 from sqlmodel import SQLModel, Field, Relationship, Column, ForeignKey, Text
 from typing import Optional, List
 from datetime import datetime
-from sqlalchemy.dialects.mysql import LONGBLOB
+from sqlalchemy.dialects.mysql import LONGTEXT
 from enum import Enum
-from sqlalchemy import Enum as SQLEnum
+from sqlalchemy import Enum as SQLEnum, BigInteger, LargeBinary, Index
+from sqlalchemy.orm import deferred
 
 
 class UserRole(str, Enum):
@@ -28,6 +29,14 @@ class ChatStage(str, Enum):
     FINISHED                = "finished"                  # работа зачтена / не зачтена
 
 
+# Статусы фоновой задачи (jobs.py)
+class JobStatus(str, Enum):
+    QUEUED  = "queued"     # ждёт свободного исполнителя
+    RUNNING = "running"    # выполняется
+    DONE    = "done"       # выполнена, результат в result
+    FAILED  = "failed"     # завершилась ошибкой, текст в error
+
+
 # Статусы попытки сдачи работы студентом
 class WorkStatus(str, Enum):
     NOT_STARTED = "Не начата"
@@ -98,16 +107,25 @@ class User(SQLModel, table=True):
     chats: List["Chat"] = Relationship(back_populates="user", sa_relationship_kwargs={"cascade": "all, delete"})
     
 
+# Большие текстовые столбцы не загружаются вместе со строкой (deferred): их читает
+# отдельный запрос при первом обращении к атрибуту, а списки и проверки доступа
+# обходятся без них. Загрузить сразу: select(...).options(undefer(Chat.meta))
+_chat_meta = Column("meta", Text())
+_work_task = Column("task", Text())
+
+
 class Chat(SQLModel, table=True):
     __tablename__ = "chat"
+    __mapper_args__ = {"properties": {"meta": deferred(_chat_meta)}}
     id: Optional[int] = Field(primary_key=True)
     mode: str = Field(max_length=45)
-    document_data: Optional[bytes] = Field(sa_column=Column(LONGBLOB()))
+    document_sha256: Optional[str] = Field(default=None, max_length=64, index=True)   # файл работы в storage.blob_store
+    document_size: Optional[int] = Field(default=None)
     document_name: Optional[str] = Field(default=None, max_length=255)  # имя файла для определения расширения
     user_id: int = Field(sa_column=Column(ForeignKey("user.id", ondelete="CASCADE")))
     work_id: Optional[int] = Field(sa_column=Column(ForeignKey("work.id", ondelete="CASCADE")))
     stage: ChatStage = Field(default=ChatStage.NEW, sa_column=Column(SQLEnum(ChatStage, name="chat_stage")))
-    meta: Optional[str] = Field(sa_column=Column(Text())) # JSON: qs, stats
+    meta: Optional[str] = Field(sa_column=_chat_meta) # JSON: qs, stats
     current_q: int = Field(default=0)
     score: float = Field(default=0.0)
 
@@ -118,6 +136,8 @@ class Chat(SQLModel, table=True):
 
 class Message(SQLModel, table=True):
     __tablename__ = "message"
+    # история чата читается страницами по ключу (created_at, id) — см. routers/chats.py
+    __table_args__ = (Index("ix_message_chat_created", "chat_id", "created_at", "id"),)
     id: Optional[int] = Field(primary_key=True)
     sender: SenderType = Field(
         sa_column=Column(
@@ -153,7 +173,8 @@ class Document(SQLModel, table=True):
     __tablename__ = "document"
     id: Optional[int] = Field(primary_key=True)
     name: str = Field(max_length=255)
-    data: Optional[bytes] = Field(sa_column=Column(LONGBLOB()))
+    sha256: str = Field(max_length=64, index=True)       # файл в storage.blob_store
+    size: int = Field(default=0)
     discipline_id: int =  Field(sa_column=Column(ForeignKey("discipline.id", ondelete="CASCADE")))
 
     discipline: Optional[Discipline] = Relationship(back_populates="documents")
@@ -162,9 +183,10 @@ class Document(SQLModel, table=True):
 
 class Work(SQLModel, table=True):
     __tablename__ = "work"
+    __mapper_args__ = {"properties": {"task": deferred(_work_task)}}
     id: Optional[int] = Field(primary_key=True)
     name: str = Field(max_length=255)
-    task: Optional[str] = Field(sa_column=Column(Text()))
+    task: Optional[str] = Field(sa_column=_work_task)
     number: int = Field(nullable=False)
     document_id: Optional[int] = Field(sa_column=Column(ForeignKey("document.id", ondelete="SET NULL")))
     document_section: Optional[str] = Field(max_length=255)
@@ -178,3 +200,44 @@ class Work(SQLModel, table=True):
         sa_relationship_kwargs={"passive_deletes": True,}
     )
     chats: List["Chat"] = Relationship(back_populates="work")
+
+
+class Job(SQLModel, table=True):
+    __tablename__ = "job"
+    id: Optional[int] = Field(primary_key=True)
+    kind: str = Field(max_length=45)                      # тип задачи, например "check_upload"
+    chat_id: int = Field(sa_column=Column(ForeignKey("chat.id", ondelete="CASCADE")))
+    status: JobStatus = Field(default=JobStatus.QUEUED, sa_column=Column(SQLEnum(JobStatus, name="job_status"), index=True))
+    attempts: int = Field(default=0)
+    result: Optional[str] = Field(sa_column=Column(Text())) # JSON с результатом
+    error: Optional[str] = Field(sa_column=Column(Text()))
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)   # обновляется, пока задача выполняется
+
+
+# Кэш извлечённого из документов текста (assistant_core.extract_text_cached)
+class ExtractedText(SQLModel, table=True):
+    __tablename__ = "extracted_text"
+    sha256: str = Field(max_length=64, primary_key=True)              # хэш байтов файла
+    extractor_version: int = Field(primary_key=True)                  # версия извлечения и нормализации
+    extension: str = Field(max_length=16, primary_key=True)           # от расширения зависит парсер
+    text: str = Field(sa_column=Column(LONGTEXT(), nullable=False))
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+# Сигнатура MinHash текста последней загруженной версии работы (similarity.py)
+class MinHashSignature(SQLModel, table=True):
+    __tablename__ = "minhash_signature"
+    chat_id: Optional[int] = Field(sa_column=Column(ForeignKey("chat.id", ondelete="CASCADE"), primary_key=True))
+    work_id: int = Field(sa_column=Column(ForeignKey("work.id", ondelete="CASCADE"), index=True))
+    signature: bytes = Field(sa_column=Column(LargeBinary(), nullable=False))   # SIMILARITY_PERMUTATIONS чисел uint64
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+# Корзины LSH: чаты одной работы с совпавшей полосой сигнатуры — кандидаты в почти-дубликаты
+class MinHashBucket(SQLModel, table=True):
+    __tablename__ = "minhash_bucket"
+    work_id: Optional[int] = Field(sa_column=Column(ForeignKey("work.id", ondelete="CASCADE"), primary_key=True))
+    band: int = Field(primary_key=True)
+    bucket: int = Field(sa_column=Column(BigInteger(), primary_key=True))     # хэш полосы сигнатуры
+    chat_id: Optional[int] = Field(sa_column=Column(ForeignKey("chat.id", ondelete="CASCADE"), primary_key=True))
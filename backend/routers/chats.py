@@ -1,15 +1,22 @@
+import base64
+import binascii
+import json
+import os
+from datetime import datetime
+from typing import Annotated, Optional
 from fastapi import APIRouter, HTTPException, Depends, Query, BackgroundTasks, UploadFile, File
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.concurrency import run_in_threadpool
-from typing import Annotated
 from pydantic import BaseModel
-from sqlmodel import Session, select
-from database import get_session
-from models import User as UserModel, Chat as ChatModel, Message as MessageModel, UserWork as UserWorkModel, ChatStage
+from sqlmodel import Session, select, and_, or_
+from database import get_session, engine
+from models import User as UserModel, Chat as ChatModel, Message as MessageModel, UserWork as UserWorkModel, ChatStage, Job as JobModel
 from core.security import oauth2_scheme, decode_access_token
-from model_utils import generate_once
-from model_utils import generate_once_mistral
-from assistant_core import handle_checking_the_work_stage, handle_checking_the_corrected_work_stage
+from model_utils import generate_answer
+from model_utils import stream_answer
+from jobs import job_runner, FINISHED_STATUSES
+from storage import blob_store, BlobTooLargeError
+import telemetry
 
 
 router = APIRouter()
@@ -18,11 +25,112 @@ class Message(BaseModel):
     text: str
 
 
+def sse_event(event: str, data: dict) -> str:
+    """Формирует одно событие Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+# Как часто SSE-поток задачи перечитывает её состояние, если задача выполняется в другом процессе
+JOB_EVENTS_INTERVAL = 2.0
+
+WORK_MAX_SIZE      = int(os.getenv("WORK_MAX_SIZE", str(50 * 1024 * 1024)))   # файл работы, байт (запрос ограничивает ещё и nginx)
+MESSAGES_PAGE_SIZE = int(os.getenv("MESSAGES_PAGE_SIZE", "50"))     # сообщений на странице истории по умолчанию
+MESSAGES_PAGE_MAX  = int(os.getenv("MESSAGES_PAGE_MAX", "200"))     # наибольший limit
+
+
+def message_payload(message) -> dict:
+    return {
+        "id": message.id,
+        "sender": message.sender,
+        "context": message.text,
+        "created_at": message.created_at.isoformat()
+    }
+
+
+def encode_cursor(message) -> str:
+    """Курсор страницы — ключ (created_at, id) сообщения, непрозрачный для клиента"""
+    raw = json.dumps([message.created_at.isoformat(), message.id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        created_at, message_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return datetime.fromisoformat(created_at), int(message_id)
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(400, "Некорректный курсор")
+
+
+def message_page(session: Session, chat_id: int, limit: int, before: Optional[tuple[datetime, int]] = None, after: Optional[tuple[datetime, int]] = None) -> dict:
+    """
+    Страница истории чата по ключу (created_at, id), сообщения — в хронологическом порядке.
+    Без before/after — последние limit сообщений. has_more — есть ли ещё сообщения
+    в направлении листания: более ранние для before и последней страницы, более новые для after.
+    """
+    # сравнение кортежей расписано через OR: так MySQL идёт по индексу ix_message_chat_created
+    query = select(MessageModel.id, MessageModel.sender, MessageModel.text, MessageModel.created_at).where(MessageModel.chat_id == chat_id)
+    if after is not None:
+        created_at, message_id = after
+        query = query.where(or_(MessageModel.created_at > created_at, and_(MessageModel.created_at == created_at, MessageModel.id > message_id)))
+        query = query.order_by(MessageModel.created_at, MessageModel.id)
+    else:
+        if before is not None:
+            created_at, message_id = before
+            query = query.where(or_(MessageModel.created_at < created_at, and_(MessageModel.created_at == created_at, MessageModel.id < message_id)))
+        query = query.order_by(MessageModel.created_at.desc(), MessageModel.id.desc())
+
+    # лишняя строка показывает, есть ли следующая страница
+    messages = session.exec(query.limit(limit + 1)).all()
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if after is None:
+        messages.reverse()
+    return {
+        "messages": [message_payload(message) for message in messages],
+        "has_more": has_more,
+        # курсоры для следующих запросов: before — страница раньше, after — новые сообщения
+        "before": encode_cursor(messages[0]) if messages else None,
+        "after": encode_cursor(messages[-1]) if messages else None,
+    }
+
+
+def job_payload(job: JobModel, session: Session) -> dict:
+    """Состояние задачи проверки для клиента; после завершения — с сообщением ассистента и этапом чата"""
+    payload = {"job_id": job.id, "status": job.status, "error": job.error}
+    if job.status in FINISHED_STATUSES:
+        chat = session.exec(select(ChatModel.stage, ChatModel.document_name).where(ChatModel.id == job.chat_id)).one()
+        payload["chat"] = {"stage": chat.stage, "document_name": chat.document_name}
+        result = json.loads(job.result) if job.result else {}
+        ai_message = session.get(MessageModel, result["ai_message_id"]) if "ai_message_id" in result else None
+        payload["ai_message"] = {
+            "id": ai_message.id,
+            "sender": "ai",
+            "context": ai_message.text,
+            "created_at": ai_message.created_at.isoformat()
+        } if ai_message else None
+    return payload
+
+
+def get_user_job(job_id: int, token: str, session: Session) -> JobModel:
+    """Задача, принадлежащая чату текущего пользователя"""
+    user_login = decode_access_token(token)
+    user = session.exec(select(UserModel).where(UserModel.login == user_login)).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="Пользователь не найден")
+
+    job = session.get(JobModel, job_id)
+    owner_id = session.exec(select(ChatModel.user_id).where(ChatModel.id == job.chat_id)).first() if job else None
+    if owner_id is None or owner_id != user.id:
+        raise HTTPException(404, "Задача не найдена")
+    return job
+
+
 # Получить или создать чат для работы
 @router.get("/work/{work_id}/chat", summary="Получить или создать чат для работы", tags=["Чаты"])
 async def get_or_create_chat(work_id: int, token: Annotated[str, Depends(oauth2_scheme)], mode: str = Query("acceptance of work"), session: Session = Depends(get_session)):
     """
-    Получает чат, включая все сообщения, или создаёт новый чат для работы, если его ещё нет.
+    Получает чат с последними MESSAGES_PAGE_SIZE сообщениями или создаёт новый чат для работы, если его ещё нет.
+    Более ранние сообщения — GET /chat/{chat_id}/messages?before=<before>, если has_more.
     Доступен только студенту, назначенному на работу.
     Требуется авторизация с использованием токена доступа.
 
@@ -42,7 +150,11 @@ async def get_or_create_chat(work_id: int, token: Annotated[str, Depends(oauth2_
     if not uw:
         raise HTTPException(403, "Нет доступа")
 
-    chat = session.exec(select(ChatModel).where(ChatModel.user_id == user.id, ChatModel.mode == mode, ChatModel.work_id == work_id)).first()
+    # только возвращаемые столбцы
+    chat = session.exec(
+        select(ChatModel.id, ChatModel.stage, ChatModel.document_name)
+        .where(ChatModel.user_id == user.id, ChatModel.mode == mode, ChatModel.work_id == work_id)
+    ).first()
 
     if not chat:
         chat = ChatModel(user_id=user.id, work_id=work_id, mode=mode)
@@ -50,17 +162,54 @@ async def get_or_create_chat(work_id: int, token: Annotated[str, Depends(oauth2_
         session.commit()
         session.refresh(chat)
 
-    messages = session.exec(select(MessageModel).where(MessageModel.chat_id == chat.id).order_by(MessageModel.created_at)).all()
-
     return {"chat_id": chat.id,
             "stage": chat.stage,
             "document_name": chat.document_name,
-            "messages": [{
-                "id": message.id,
-                "sender": message.sender,
-                "context": message.text,
-                "created_at": message.created_at.isoformat()
-            } for message in messages]}
+            **message_page(session, chat.id, MESSAGES_PAGE_SIZE)}
+
+
+# История сообщений чата по страницам
+@router.get("/chat/{chat_id}/messages", summary="Получить страницу истории сообщений чата", tags=["Чаты"])
+async def get_messages(chat_id: int, token: Annotated[str, Depends(oauth2_scheme)],
+                       limit: int = Query(MESSAGES_PAGE_SIZE, ge=1, le=MESSAGES_PAGE_MAX),
+                       before: Optional[str] = Query(None), after: Optional[str] = Query(None),
+                       since_id: Optional[int] = Query(None), session: Session = Depends(get_session)):
+    """
+    Возвращает до limit сообщений в хронологическом порядке, курсоры before / after и признак has_more.
+    Требуется авторизация с использованием токена доступа.
+
+    Параметры (указывается не больше одного):
+    - **before**: курсор — сообщения раньше него (листание истории вверх)
+    - **after**: курсор — сообщения после него
+    - **since_id**: ID последнего полученного сообщения — только новые сообщения после него
+    - без параметров — последние limit сообщений
+
+    Параметр пути:
+    - **chat_id**: ID чата
+    """
+    user_login = decode_access_token(token)
+    user = session.exec(select(UserModel).where(UserModel.login == user_login)).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="Пользователь не найден")
+
+    owner_id = session.exec(select(ChatModel.user_id).where(ChatModel.id == chat_id)).first()
+    if owner_id is None or owner_id != user.id:
+        raise HTTPException(404, "Чат не найден")
+
+    if sum(value is not None for value in (before, after, since_id)) > 1:
+        raise HTTPException(400, "Укажите только один из параметров before, after, since_id")
+
+    if since_id is not None:
+        created_at = session.exec(select(MessageModel.created_at).where(MessageModel.id == since_id, MessageModel.chat_id == chat_id)).first()
+        if created_at is None:
+            raise HTTPException(404, "Сообщение не найдено")
+        return message_page(session, chat_id, limit, after=(created_at, since_id))
+
+    return message_page(
+        session, chat_id, limit,
+        before=decode_cursor(before) if before is not None else None,
+        after=decode_cursor(after) if after is not None else None,
+    )
 
 
 # Добавить сообщение от пользователя и получить сообщение от LLM
@@ -98,9 +247,9 @@ async def add_message_and_generate_answer(chat_id: int, message_data: Message, t
     else:
         user_message = None
 
-    # Генерируем ответ 
-    # ai_text: str = await run_in_threadpool(generate_once, message_data.text)
-    ai_text = await generate_once_mistral(message_data.text)
+    # Генерируем ответ (бэкенд выбирается через LLM_BACKEND)
+    with telemetry.stage(chat.stage):
+        ai_text = await generate_answer(message_data.text)
 
     # Сохраняем ответ модели
     ai_message = MessageModel(chat_id=chat_id, sender="ai", text=ai_text)
@@ -124,12 +273,94 @@ async def add_message_and_generate_answer(chat_id: int, message_data: Message, t
     }, status_code=200)
 
 
+# Добавить сообщение от пользователя и получить потоковый ответ LLM
+@router.post("/chat/{chat_id}/messages/stream", summary="Добавить сообщение от пользователя и получить ответ LLM потоком (SSE)", tags=["Чаты"])
+async def add_message_and_stream_answer(chat_id: int, message_data: Message, token: Annotated[str, Depends(oauth2_scheme)], session: Session = Depends(get_session)):
+    """
+    Сохраняем сообщение пользователя и отдаём ответ LLM по мере генерации в формате Server-Sent Events.
+    Требуется авторизация с использованием токена доступа.
+
+    События потока:
+    - **user_message**: сохранённое сообщение пользователя
+    - **token**: очередной фрагмент ответа (`{"delta": "..."}`)
+    - **ai_message**: сохранённое сообщение модели, отправляется после окончания генерации
+    - **error**: ошибка генерации
+
+    Поля для добавления сообщения:
+    - **text**: текст сообщения пользователя
+
+    Параметр пути:
+    - **chat_id**: ID чата, в который добавляется сообщение
+    """
+    user_login = decode_access_token(token)
+
+    user = session.exec(select(UserModel).where(UserModel.login == user_login)).first()
+
+    if not user:
+        raise HTTPException(status_code=404, detail="Пользователь не найден")
+
+    # проверяем, что чат принадлежит пользователю
+    chat = session.get(ChatModel, chat_id)
+    if not chat or chat.user_id != user.id:
+        raise HTTPException(404, "Чат не найден")
+
+    if not message_data.text:
+        raise HTTPException(400, "Сообщение не может быть пустым")
+
+    # Сохраняем сообщение пользователя
+    user_message = MessageModel(chat_id=chat_id, sender="user", text=message_data.text)
+    session.add(user_message)
+    session.commit()
+    session.refresh(user_message)
+    stage = chat.stage.value
+    user_message_data = {
+        "id": user_message.id,
+        "sender": "user",
+        "context": user_message.text,
+        "created_at": user_message.created_at.isoformat()
+    }
+
+    async def event_stream():
+        yield sse_event("user_message", user_message_data)
+
+        parts = []
+        try:
+            async for delta in stream_answer(message_data.text, stage=stage):
+                parts.append(delta)
+                yield sse_event("token", {"delta": delta})
+        except Exception as error:
+            yield sse_event("error", {"detail": f"Ошибка генерации ответа: {error}"})
+            return
+
+        # Сессия зависимости уже закрыта к этому моменту — сохраняем ответ в своей
+        with Session(engine) as stream_session:
+            ai_message = MessageModel(chat_id=chat_id, sender="ai", text="".join(parts).strip())
+            stream_session.add(ai_message)
+            stream_session.commit()
+            stream_session.refresh(ai_message)
+            yield sse_event("ai_message", {
+                "id": ai_message.id,
+                "sender": "ai",
+                "context": ai_message.text,
+                "created_at": ai_message.created_at.isoformat()
+            })
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        # nginx не должен буферизовать поток
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # Загрузка файла работы и запуск проверки
-@router.post("/chat/{chat_id}/upload", summary="Загрузить файл работы и запустить проверку", tags=["Чаты"])
+@router.post("/chat/{chat_id}/upload", summary="Загрузить файл работы и запустить проверку", tags=["Чаты"], status_code=202)
 async def upload_work(chat_id: int, token: Annotated[str, Depends(oauth2_scheme)], file: UploadFile = File(...), session: Session = Depends(get_session)):
     """
-    Принимает файл (PDF / DOCX / TXT), сохраняет в chat.document_data и запускает этап проверки (next_turn). 
-    Возвращает первое сообщение ассистента с вопросом №1.
+    Принимает файл (PDF / DOCX / TXT) не больше WORK_MAX_SIZE байт (иначе 413),
+    сохраняет в хранилище файлов (storage.py) и ставит проверку в очередь фоновых задач.
+    Отвечает сразу (202) идентификатором задачи: результат — сообщение ассистента — можно получить
+    через GET /jobs/{job_id} или дождаться в потоке GET /jobs/{job_id}/events.
     """
     user_login = decode_access_token(token)
     user = session.exec(select(UserModel).where(UserModel.login == user_login)).first()
@@ -143,36 +374,87 @@ async def upload_work(chat_id: int, token: Annotated[str, Depends(oauth2_scheme)
     if chat.stage not in (ChatStage.NEW, ChatStage.RETURNED_FOR_REVISION):
         raise HTTPException(400, "Файл уже загружен")
 
-    data = await file.read()
-    if not data:
+    if file.size is not None and file.size > WORK_MAX_SIZE:
+        raise HTTPException(413, f"Файл больше {WORK_MAX_SIZE / (1024 * 1024):g} МБ")
+    # файл пишется в хранилище кусками, в базе остаются хэш и размер
+    try:
+        blob = await run_in_threadpool(blob_store.put_file, file.file, WORK_MAX_SIZE)
+    except BlobTooLargeError:
+        raise HTTPException(413, f"Файл больше {WORK_MAX_SIZE / (1024 * 1024):g} МБ")
+    if not blob.size:
         raise HTTPException(400, "Загруженный файл пуст или испорчен")
-    chat.document_data = data
+    chat.document_sha256 = blob.sha256
+    chat.document_size = blob.size
     chat.document_name = file.filename
-    chat.stage = ChatStage.CHECKING_THE_WORK if chat.meta is None else ChatStage.CHECKING_CORRECTED_WORK
-    session.add(chat); 
-    session.commit(); 
+    # chat.meta не загружаем: достаточно знать, есть ли результат прошлой проверки
+    first_upload = session.exec(select(ChatModel.meta.is_(None)).where(ChatModel.id == chat.id)).one()
+    chat.stage = ChatStage.CHECKING_THE_WORK if first_upload else ChatStage.CHECKING_CORRECTED_WORK
+    # файл и задача на его проверку сохраняются вместе
+    job = JobModel(kind="check_upload", chat_id=chat.id)
+    session.add(chat)
+    session.add(job)
+    session.commit()
     session.refresh(chat)
+    session.refresh(job)
+    job_runner.wake()
 
-    if chat.stage == ChatStage.CHECKING_THE_WORK:
-        # запускаем проверку работы
-        assistant_reply = await handle_checking_the_work_stage(chat, session)
-    else:
-        # запускаем проверку исправленной работы
-        assistant_reply = await handle_checking_the_corrected_work_stage(chat, session)
-
-    ai_message = MessageModel(chat_id=chat_id, sender="ai", text=assistant_reply)
-    session.add(ai_message); 
-    session.commit(); 
-    session.refresh(ai_message)
-
-    return {"ai_message": {
-            "id": ai_message.id,
-            "sender": "ai",
-            "context": ai_message.text,
-            "created_at": ai_message.created_at.isoformat()
-        },
+    return JSONResponse({
+        "job_id": job.id,
+        "status": job.status,
         "chat": {
             "stage": chat.stage,
             "document_name": chat.document_name
         }
-    }
\ No newline at end of file
+    }, status_code=202)
+
+
+# Состояние задачи проверки
+@router.get("/jobs/{job_id}", summary="Получить состояние задачи проверки работы", tags=["Чаты"])
+async def get_job(job_id: int, token: Annotated[str, Depends(oauth2_scheme)], session: Session = Depends(get_session)):
+    """
+    Возвращает статус задачи (queued / running / done / failed).
+    После завершения в ответе есть сообщение ассистента (ai_message) и новый этап чата.
+    Требуется авторизация с использованием токена доступа.
+
+    Параметр пути:
+    - **job_id**: ID задачи, полученный при загрузке файла
+    """
+    job = get_user_job(job_id, token, session)
+    return job_payload(job, session)
+
+
+# Подписка на завершение задачи проверки
+@router.get("/jobs/{job_id}/events", summary="Дождаться завершения задачи проверки (SSE)", tags=["Чаты"])
+async def subscribe_job(job_id: int, token: Annotated[str, Depends(oauth2_scheme)], session: Session = Depends(get_session)):
+    """
+    Поток Server-Sent Events с событием **status** при каждом изменении статуса задачи.
+    Последнее событие — со статусом done или failed (в том же формате, что GET /jobs/{job_id}),
+    после него поток закрывается.
+    Требуется авторизация с использованием токена доступа.
+
+    Параметр пути:
+    - **job_id**: ID задачи, полученный при загрузке файла
+    """
+    get_user_job(job_id, token, session)
+
+    async def event_stream():
+        last_status = None
+        while True:
+            with Session(engine) as stream_session:
+                job = stream_session.get(JobModel, job_id)
+                if job is None:      # чат удалён вместе с задачей
+                    yield sse_event("error", {"detail": "Задача не найдена"})
+                    return
+                payload = job_payload(job, stream_session)
+            if payload["status"] != last_status:
+                last_status = payload["status"]
+                yield sse_event("status", payload)
+            if last_status in FINISHED_STATUSES:
+                return
+            await job_runner.wait(job_id, JOB_EVENTS_INTERVAL)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -1,20 +1,50 @@
-from fastapi import APIRouter, HTTPException, Depends
+import os
+from fastapi import APIRouter, HTTPException, Depends, Request, UploadFile, File
 from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
 from typing import Annotated, Optional, List
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from sqlmodel import Session, select
 from database import get_session
 from models import User as UserModel, Discipline as DisciplineModel, Document as DocumentModel, TeacherStudent as TeacherStudentModel, UserWork as UserWorkModel, Work as WorkModel, StudentDiscipline as StudentDisciplineModel
-import base64
 from core.security import oauth2_scheme, decode_access_token
+from core.downloads import blob_response
+from storage import blob_store, BlobTooLargeError
 
 
 router = APIRouter()
 
+# Ограничения на документы дисциплины (общий размер запроса ограничивает ещё и nginx: client_max_body_size)
+DOCUMENT_MAX_SIZE      = int(os.getenv("DOCUMENT_MAX_SIZE", str(50 * 1024 * 1024)))       # файл в multipart-загрузке, байт
+DOCUMENT_JSON_MAX_SIZE = int(os.getenv("DOCUMENT_JSON_MAX_SIZE", str(5 * 1024 * 1024)))   # файл в поле data JSON-тела, байт
+DOCUMENT_MAX_FILES     = int(os.getenv("DOCUMENT_MAX_FILES", "20"))                        # файлов в одной загрузке
 
+
+def get_accessible_discipline(discipline_id: int, user: UserModel, session: Session) -> DisciplineModel:
+    """Дисциплина, доступная пользователю: своя — преподавателю, дисциплина своего преподавателя — студенту"""
+    discipline = session.exec(select(DisciplineModel).where(DisciplineModel.id == discipline_id)).first()
+    if not discipline:
+        raise HTTPException(404, "Дисциплина не найдена")
+
+    if user.role == "teacher":
+        # у преподавателя должна совпадать связь
+        if discipline.teacher_id != user.id:
+            raise HTTPException(404, "Дисциплина не найдена")
+    elif user.role == "student":
+        # у студента должна быть запись teacher_student для этого препода
+        has_access = session.exec(select(TeacherStudentModel).where(TeacherStudentModel.teacher_id == discipline.teacher_id, TeacherStudentModel.student_id == user.id)).first()
+        if not has_access:
+            raise HTTPException(403, "У вас нет доступа к этой дисциплине")
+    else:
+        # прочие роли не имеют доступа
+        raise HTTPException(403, "Недостаточно прав")
+    return discipline
+
+
+# Небольшие документы можно передать прямо в JSON; большие — через POST /disciplines/{discipline_id}/documents/upload
 class Document(BaseModel):
     name: str
-    data: bytes
+    data: bytes = Field(max_length=DOCUMENT_JSON_MAX_SIZE)
 
 
 class Discipline(BaseModel):
@@ -47,14 +77,14 @@ async def get_disciplines(token: Annotated[str, Depends(oauth2_scheme)], session
     
     if user.role == "teacher":
         # все дисциплины преподавателя
-        disciplines = session.exec(select(DisciplineModel).where(DisciplineModel.teacher_id == user.id)).all()
+        disciplines = session.exec(select(DisciplineModel.id, DisciplineModel.name).where(DisciplineModel.teacher_id == user.id)).all()
     elif user.role == "student":
         # получаем всех преподавателей, у которых студент в списке
         teacher_ids = session.exec(select(TeacherStudentModel.teacher_id).where(TeacherStudentModel.student_id == user.id)).all()
         if not teacher_ids:
             disciplines = []
         else:
-            disciplines = session.exec(select(DisciplineModel).where(DisciplineModel.teacher_id.in_(teacher_ids))).all()
+            disciplines = session.exec(select(DisciplineModel.id, DisciplineModel.name).where(DisciplineModel.teacher_id.in_(teacher_ids))).all()
     else:
         disciplines = []
 
@@ -97,9 +127,11 @@ async def add_new_discipline(discipline_data: Discipline, token: Annotated[str,
 
     if discipline_data.documents:
         for document in discipline_data.documents:
+            blob = await run_in_threadpool(blob_store.put, document.data)
             new_document = DocumentModel(
                 name=document.name,
-                data=document.data,
+                sha256=blob.sha256,
+                size=blob.size,
                 discipline_id=new_discipline.id
             )
             session.add(new_document)
@@ -125,36 +157,21 @@ async def get_discipline_info(discipline_id: int, token: Annotated[str, Depends(
     if not user:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
 
-    # Шаг 1: забираем дисциплину по ID
-    discipline = session.exec(select(DisciplineModel).where(DisciplineModel.id == discipline_id)).first()
-    if not discipline:
-        raise HTTPException(404, "Дисциплина не найдена")
-
-    # Шаг 2: проверяем права
-    if user.role == "teacher":
-        # у преподавателя должна совпадать связь
-        if discipline.teacher_id != user.id:
-            raise HTTPException(404, "Дисциплина не найдена")
-    elif user.role == "student":
-        # у студента должна быть запись teacher_student для этого препода
-        has_access = session.exec(select(TeacherStudentModel).where(TeacherStudentModel.teacher_id == discipline.teacher_id, TeacherStudentModel.student_id == user.id)).first()
-        if not has_access:
-            raise HTTPException(403, "У вас нет доступа к этой дисциплине")
-    else:
-        # прочие роли не имеют доступа
-        raise HTTPException(403, "Недостаточно прав")
+    # Шаги 1–2: забираем дисциплину по ID и проверяем права
+    discipline = get_accessible_discipline(discipline_id, user, session)
 
     # Шаг 3: собираем список работ
     if user.role == 'teacher':
         # преподавателю отдаём все работы
+        rows = session.exec(select(WorkModel.id, WorkModel.name, WorkModel.number).where(WorkModel.discipline_id == discipline_id)).all()
         works_data = [
             {"id": w.id, "name": w.name, "number": w.number}
-            for w in discipline.works
+            for w in rows
         ]
     else:
         # студенту — только назначенные
         rows = session.exec(
-            select(WorkModel, UserWorkModel.status)
+            select(WorkModel.id, WorkModel.name, WorkModel.number, UserWorkModel.status)
             .join(UserWorkModel, UserWorkModel.work_id == WorkModel.id)
             .where(WorkModel.discipline_id == discipline_id, UserWorkModel.student_id == user.id,)).all()
         works_data = [
@@ -162,8 +179,8 @@ async def get_discipline_info(discipline_id: int, token: Annotated[str, Depends(
                 "id": work.id,
                 "name": work.name, 
                 "number": work.number,
-                "status": status
-            } for work, status in rows
+                "status": work.status
+            } for work in rows
         ]
 
     # Шаг 4: собираем список студентов, назначенных на эту дисциплину (только для teacher)
@@ -171,7 +188,7 @@ async def get_discipline_info(discipline_id: int, token: Annotated[str, Depends(
     if user.role == "teacher":
         # получаем всех User, у которых есть запись в student_discipline
         rows = session.exec(
-            select(UserModel)
+            select(UserModel.id, UserModel.last_name, UserModel.first_name, UserModel.login)
             .join(StudentDisciplineModel, StudentDisciplineModel.student_id == UserModel.id)
             .where(StudentDisciplineModel.discipline_id == discipline_id)
         ).all()
@@ -180,16 +197,20 @@ async def get_discipline_info(discipline_id: int, token: Annotated[str, Depends(
             for s in rows
         ]
 
+    teacher = session.exec(select(UserModel.last_name, UserModel.first_name).where(UserModel.id == discipline.teacher_id)).one()
+    # только описание документов; сами файлы — GET /disciplines/{discipline_id}/documents/{document_id}/download
+    documents = session.exec(select(DocumentModel.id, DocumentModel.name, DocumentModel.size).where(DocumentModel.discipline_id == discipline_id)).all()
+
     return JSONResponse({"Discipline": {
         "id": discipline.id,
         "name": discipline.name,
-        "teacher": f"{discipline.teacher.last_name} {discipline.teacher.first_name}",
+        "teacher": f"{teacher.last_name} {teacher.first_name}",
         "documents": [
             {
                 "id": document.id,
                 "name": document.name,
-                "data": base64.b64encode(document.data).decode()
-            } for document in discipline.documents
+                "size": document.size
+            } for document in documents
         ],
         "works": works_data,
         "students": students_data
@@ -224,9 +245,11 @@ async def update_discipline(discipline_id: int, discipline_data: DisciplineUpdat
 
     if discipline_data.documents:
         for document in discipline_data.documents:
+            blob = await run_in_threadpool(blob_store.put, document.data)
             new_document = DocumentModel(
                 name=document.name,
-                data=document.data,
+                sha256=blob.sha256,
+                size=blob.size,
                 discipline_id=discipline.id
             )
             session.add(new_document)
@@ -264,6 +287,88 @@ async def delete_discipline(discipline_id: int, token: Annotated[str, Depends(oa
     return JSONResponse({"message": "Дисциплина успешно удалена"}, status_code=200)
 
 
+# Загрузить документы в дисциплину
+@router.post("/disciplines/{discipline_id}/documents/upload", summary="Загрузить документы в дисциплину (multipart/form-data)", tags=["Дисциплины"], status_code=201)
+async def upload_documents(discipline_id: int, token: Annotated[str, Depends(oauth2_scheme)], files: List[UploadFile] = File(...), session: Session = Depends(get_session)):
+    """
+    Добавляет в дисциплину документы, переданные как multipart/form-data (поле **files**, можно несколько).
+    Файлы пишутся в хранилище кусками с подсчётом SHA-256 по ходу записи, без декодирования в памяти;
+    документы добавляются одной транзакцией: если хотя бы один файл не подошёл, не добавляется ни один.
+    Требуется авторизация с использованием токена доступа.
+
+    Ограничения: не больше DOCUMENT_MAX_FILES файлов, каждый — не больше DOCUMENT_MAX_SIZE байт (иначе 413).
+
+    Параметр пути: **discipline_id**
+    """
+    user_login = decode_access_token(token)
+
+    user = session.exec(select(UserModel).where(UserModel.login == user_login)).first()
+
+    if not user:
+        raise HTTPException(status_code=404, detail="Пользователь не найден")
+
+    discipline = session.exec(select(DisciplineModel).where(DisciplineModel.id == discipline_id, DisciplineModel.teacher_id == user.id)).first()
+
+    if not discipline:
+        raise HTTPException(status_code=404, detail="Дисциплина не найдена")
+
+    if len(files) > DOCUMENT_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"За один раз можно загрузить не больше {DOCUMENT_MAX_FILES} файлов")
+
+    # размеры известны после разбора формы — проверяем все файлы до записи в хранилище
+    too_large = [file.filename for file in files if file.size is not None and file.size > DOCUMENT_MAX_SIZE]
+    if too_large:
+        raise HTTPException(status_code=413, detail=f"Файлы больше {DOCUMENT_MAX_SIZE / (1024 * 1024):g} МБ: {', '.join(too_large)}")
+
+    documents = []
+    for file in files:
+        try:
+            blob = await run_in_threadpool(blob_store.put_file, file.file, DOCUMENT_MAX_SIZE)
+        except BlobTooLargeError:
+            raise HTTPException(status_code=413, detail=f"Файл {file.filename} больше {DOCUMENT_MAX_SIZE / (1024 * 1024):g} МБ")
+        if not blob.size:
+            raise HTTPException(status_code=400, detail=f"Файл {file.filename} пуст")
+        documents.append(DocumentModel(name=file.filename, sha256=blob.sha256, size=blob.size, discipline_id=discipline.id))
+
+    session.add_all(documents)
+    session.flush()
+    documents_data = [{"id": document.id, "name": document.name, "size": document.size} for document in documents]
+    session.commit()
+
+    return JSONResponse({"documents": documents_data, "message": "Документы успешно загружены"}, status_code=201)
+
+
+# Скачать документ
+@router.get("/disciplines/{discipline_id}/documents/{document_id}/download", summary="Скачать документ дисциплины", tags=["Дисциплины"])
+async def download_document(discipline_id: int, document_id: int, request: Request, token: Annotated[str, Depends(oauth2_scheme)], session: Session = Depends(get_session)):
+    """
+    Отдаёт файл документа потоком.
+    Поддерживаются заголовки Range (один диапазон, ответ 206), If-Range и If-None-Match (ответ 304):
+    ETag документа — SHA-256 его содержимого.
+    Доступно преподавателю дисциплины и его студентам.
+    Требуется авторизация с использованием токена доступа.
+
+    Параметры пути: **discipline_id**, **document_id**
+    """
+    user_login = decode_access_token(token)
+
+    user = session.exec(select(UserModel).where(UserModel.login == user_login)).first()
+
+    if not user:
+        raise HTTPException(status_code=404, detail="Пользователь не найден")
+
+    get_accessible_discipline(discipline_id, user, session)
+
+    document = session.exec(
+        select(DocumentModel.name, DocumentModel.sha256, DocumentModel.size)
+        .where(DocumentModel.id == document_id, DocumentModel.discipline_id == discipline_id)
+    ).first()
+    if not document or not blob_store.exists(document.sha256):
+        raise HTTPException(status_code=404, detail="Документ не найден")
+
+    return blob_response(request, document.sha256, document.size, document.name)
+
+
 # Удалить документ
 @router.delete("/disciplines/{discipline_id}/documents/{document_id}/delete", summary="Удалить документ из дисциплины", tags=["Дисциплины"])
 async def delete_document_from_discipline(discipline_id: int, document_id: int, token: Annotated[str, Depends(oauth2_scheme)], session: Session = Depends(get_session)):
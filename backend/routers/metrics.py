@@ -0,0 +1,50 @@
+import time
+from fastapi import APIRouter, HTTPException, Depends, Query
+from typing import Annotated
+from sqlmodel import Session, select
+from database import get_session
+from models import User as UserModel, ChatStage
+from core.security import oauth2_scheme, decode_access_token
+import model_utils
+import telemetry
+
+
+router = APIRouter()
+
+
+# Телеметрия LLM и этапов проверки
+@router.get("/metrics", summary="Получить телеметрию обращений к LLM и этапов проверки", tags=["Метрики"])
+async def get_metrics(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    stage: ChatStage | None = Query(None),
+    backend: str | None = Query(None),
+    window: float | None = Query(None, gt=0),
+    session: Session = Depends(get_session),
+):
+    """
+    Возвращает агрегаты телеметрии этого процесса:
+    - **llm**: по группам (этап чата, бэкенд) — число вызовов, из них из кэша и с ошибкой,
+      сумма токенов промпта и ответа, p50/p95 ожидания в очереди, времени до первого токена и полного времени
+    - **spans**: по группам (этап чата, интервал) — извлечение текста, сборка промпта, разбор JSON,
+      ожидание фоновой задачи и т.д.
+    - **hedging**: счётчики хеджирования, если оно включено (LLM_HEDGE=1)
+
+    Доступно только преподавателю.
+    Требуется авторизация с использованием токена доступа.
+
+    Параметры запроса:
+    - **stage**: только указанный этап чата
+    - **backend**: только указанный бэкенд (local / mistral / hedged)
+    - **window**: только записи за последние window секунд
+    """
+    user_login = decode_access_token(token)
+    user = session.exec(select(UserModel).where(UserModel.login == user_login)).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="Пользователь не найден")
+    if user.role != "teacher":
+        raise HTTPException(403, "Нет доступа")
+
+    since = time.time() - window if window else None
+    summary = telemetry.registry.summary(stage.value if stage else None, backend, since)
+    summary["hedging"] = model_utils.get_hedged_router().stats() if model_utils.LLM_HEDGE else None
+    return summary
@@ -27,7 +27,7 @@ async def search_users(token: Annotated[str, Depends(oauth2_scheme)], session: S
     if not current_user:
         raise HTTPException(404, "Пользователь не найден")
 
-    stmt = (select(UserModel).where(UserModel.id != current_user.id,(UserModel.last_name.ilike(f"%{query}%")) |(UserModel.login.ilike(f"%{query}%"))).limit(20))
+    stmt = (select(UserModel.id, UserModel.last_name, UserModel.first_name, UserModel.login).where(UserModel.id != current_user.id,(UserModel.last_name.ilike(f"%{query}%")) |(UserModel.login.ilike(f"%{query}%"))).limit(20))
     users = session.exec(stmt).all()
 
     users_data = [
@@ -58,7 +58,7 @@ async def get_students_from_list(token: Annotated[str, Depends(oauth2_scheme)],
     if user.role != "teacher":
         raise HTTPException(status_code=403, detail="Только преподаватель может просматривать своих студентов")
     
-    students = session.exec(select(UserModel).join(TeacherStudentModel, TeacherStudentModel.student_id == UserModel.id).where(TeacherStudentModel.teacher_id == user.id)).all()
+    students = session.exec(select(UserModel.id, UserModel.last_name, UserModel.first_name, UserModel.login).join(TeacherStudentModel, TeacherStudentModel.student_id == UserModel.id).where(TeacherStudentModel.teacher_id == user.id)).all()
 
     students_data = [
         {
@@ -1,11 +1,12 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query
 from fastapi.responses import JSONResponse
 from typing import Annotated
 from pydantic import BaseModel
 from sqlmodel import Session, select, update
 from database import get_session
-from models import User as UserModel, Discipline as DisciplineModel, Work as WorkModel, UserWork as UserWorkModel, StudentDiscipline as StudentDisciplineModel
+from models import User as UserModel, Discipline as DisciplineModel, Work as WorkModel, UserWork as UserWorkModel, StudentDiscipline as StudentDisciplineModel, Chat as ChatModel, Document as DocumentModel
 from core.security import oauth2_scheme, decode_access_token
+from similarity import suspicious_pairs, SIMILARITY_THRESHOLD, SIMILARITY_MIN_THRESHOLD
 
 
 router = APIRouter()
@@ -126,14 +127,19 @@ async def get_work_info(discipline_id: int, work_id: int, token: Annotated[str,
     if not user:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
 
-    work = session.exec(select(WorkModel).where(DisciplineModel.id == discipline_id, WorkModel.id == work_id)).first()
+    # только возвращаемые столбцы, имя документа — в том же запросе
+    work = session.exec(
+        select(WorkModel.id, WorkModel.name, WorkModel.task, WorkModel.number, WorkModel.document_id, WorkModel.document_section, DocumentModel.name.label("document_name"))
+        .outerjoin(DocumentModel, DocumentModel.id == WorkModel.document_id)
+        .where(WorkModel.id == work_id, WorkModel.discipline_id == discipline_id)
+    ).first()
 
     if not work:
         raise HTTPException(status_code=404, detail="Работа не найдена")
 
     # Получаем студентов и их статус через таблицу user_work
     students = session.exec(
-        select(UserModel, UserWorkModel.status)
+        select(UserModel.id, UserModel.last_name, UserModel.first_name, UserWorkModel.status)
         .join(UserWorkModel, UserWorkModel.student_id == UserModel.id)
         .where(UserWorkModel.work_id == work_id)
     ).all()
@@ -144,15 +150,15 @@ async def get_work_info(discipline_id: int, work_id: int, token: Annotated[str,
         "task": work.task,
         "number": work.number,
         "document_id": work.document_id,
-        "document_name": work.document.name,
+        "document_name": work.document_name,
         "document_section": work.document_section,
         "students": [
             {
                 "id": student.id,
                 "last_name": student.last_name,
                 "first_name": student.first_name,
-                "status": status
-            } for student, status in students
+                "status": student.status
+            } for student in students
         ]
     }
 
@@ -346,3 +352,65 @@ async def remove_student_from_work(discipline_id: int, work_id: int, student_id:
     session.commit()
 
     return JSONResponse({"message": "Студент успешно удален из работы"}, status_code=200)
+
+
+# Похожие отчёты студентов по работе
+@router.get("/disciplines/{discipline_id}/work/{work_id}/similar", summary="Получить пары похожих отчётов по работе", tags=["Работы"])
+async def get_similar_submissions(discipline_id: int, work_id: int, token: Annotated[str, Depends(oauth2_scheme)], threshold: float = Query(SIMILARITY_THRESHOLD, ge=SIMILARITY_MIN_THRESHOLD, le=1), session: Session = Depends(get_session)):
+    """
+    Возвращает пары студентов, чьи последние загруженные отчёты по работе почти совпадают,
+    с оценкой сходства (доля общих фрагментов текста, от 0 до 1), по убыванию сходства.
+    Доступно только преподавателю дисциплины.
+    Требуется авторизация с использованием токена доступа.
+
+    Параметры пути:
+    - **discipline_id**: ID дисциплины
+    - **work_id**: ID работы
+
+    Параметр запроса:
+    - **threshold**: минимальное сходство пары, не ниже SIMILARITY_MIN_THRESHOLD (≈ 0.43):
+      менее похожие пары индекс MinHash/LSH не находит
+    """
+    user_login = decode_access_token(token)
+
+    # Проверяем, что пользователь существует
+    user = session.exec(select(UserModel).where(UserModel.login == user_login)).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="Пользователь не найден")
+
+    # Проверяем, что дисциплина принадлежит текущему преподавателю
+    discipline = session.exec(select(DisciplineModel).where(DisciplineModel.id == discipline_id, DisciplineModel.teacher_id == user.id)).first()
+    if not discipline:
+        raise HTTPException(status_code=404, detail="Дисциплина не найдена")
+
+    # Проверяем, что работа существует и принадлежит дисциплине
+    work = session.exec(select(WorkModel).where(WorkModel.id == work_id, WorkModel.discipline_id == discipline_id)).first()
+    if not work:
+        raise HTTPException(status_code=404, detail="Работа не найдена")
+
+    pairs = suspicious_pairs(session, work_id, threshold)
+
+    # студенты чатов из найденных пар (без содержимого файлов)
+    chat_ids = {chat_id for pair in pairs for chat_id in pair["chat_ids"]}
+    students = {
+        chat_id: {
+            "chat_id": chat_id,
+            "id": student_id,
+            "last_name": last_name,
+            "first_name": first_name,
+            "document_name": document_name
+        } for chat_id, document_name, student_id, last_name, first_name in session.exec(
+            select(ChatModel.id, ChatModel.document_name, UserModel.id, UserModel.last_name, UserModel.first_name)
+            .join(UserModel, UserModel.id == ChatModel.user_id)
+            .where(ChatModel.id.in_(chat_ids))
+        ).all()
+    } if chat_ids else {}
+
+    return JSONResponse({
+        "pairs": [
+            {
+                "similarity": round(pair["similarity"], 3),
+                "students": [students[chat_id] for chat_id in pair["chat_ids"]]
+            } for pair in pairs if all(chat_id in students for chat_id in pair["chat_ids"])
+        ]
+    }, status_code=200)
@@ -0,0 +1,183 @@
+"""
+Поиск почти-дубликатов среди отчётов одной работы (MinHash + LSH).
+
+Текст отчёта разбивается на шинглы — последовательности из SIMILARITY_SHINGLE
+слов, — по ним строится сигнатура MinHash из SIMILARITY_PERMUTATIONS чисел.
+Доля совпавших позиций двух сигнатур — оценка коэффициента Жаккара множеств
+шинглов. Сигнатура режется на SIMILARITY_BANDS полос; хэш каждой полосы —
+корзина в таблице minhash_bucket. Кандидаты в дубликаты — только чаты,
+попавшие хотя бы в одну общую корзину, поэтому ни загрузка, ни запрос не
+сравнивают все пары отчётов работы.
+
+Индекс обновляется при проверке каждой загруженной версии (jobs.check_upload);
+уже загруженные работы индексируются командой
+    python -m similarity
+"""
+import asyncio
+import hashlib
+import math
+import os
+import random
+import re
+import struct
+from typing import Iterable, Optional
+from sqlalchemy import delete
+from sqlalchemy.orm import aliased
+from sqlmodel import Session, select
+from starlette.concurrency import run_in_threadpool
+from models import Chat as ChatModel, MinHashSignature as SignatureModel, MinHashBucket as BucketModel
+
+
+# При изменении параметров индекс нужно перестроить (python -m similarity)
+SIMILARITY_SHINGLE      = int(os.getenv("SIMILARITY_SHINGLE", "5"))          # слов в шингле
+SIMILARITY_PERMUTATIONS = int(os.getenv("SIMILARITY_PERMUTATIONS", "128"))   # длина сигнатуры
+SIMILARITY_BANDS        = int(os.getenv("SIMILARITY_BANDS", "32"))           # полос LSH; порог кандидата ≈ (1/полос)^(полос/длина)
+SIMILARITY_THRESHOLD    = float(os.getenv("SIMILARITY_THRESHOLD", "0.5"))    # с какой оценки сходства пара подозрительна
+
+_PRIME = (1 << 61) - 1
+# одни и те же перестановки во всех процессах
+_rng = random.Random(20240601)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(SIMILARITY_PERMUTATIONS)]
+_ROWS = SIMILARITY_PERMUTATIONS // SIMILARITY_BANDS
+# Порог кандидата LSH (≈ 0.42 при 32 полосах по 4 строки), округлённый вверх: пары
+# с меньшим сходством почти никогда не попадают в общую корзину, и искать их бессмысленно
+SIMILARITY_MIN_THRESHOLD = math.ceil((1 / SIMILARITY_BANDS) ** (1 / _ROWS) * 100) / 100
+
+
+# ---------- MinHash ----------
+def shingles(text: str, size: int = SIMILARITY_SHINGLE) -> set[int]:
+    """64-битные хэши шинглов текста (регистр и пунктуация не учитываются)"""
+    words = re.findall(r"\w+", text.lower())
+    if not words:
+        return set()
+    grams = (" ".join(words[i:i + size]) for i in range(max(1, len(words) - size + 1)))
+    return {int.from_bytes(hashlib.blake2b(gram.encode(), digest_size=8).digest(), "little") for gram in grams}
+
+
+def minhash(hashes: Iterable[int]) -> Optional[list[int]]:
+    """Сигнатура MinHash множества хэшей; None для пустого множества"""
+    hashes = list(hashes)
+    if not hashes:
+        return None
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def similarity(first: list[int], second: list[int]) -> float:
+    """Оценка коэффициента Жаккара по двум сигнатурам"""
+    return sum(x == y for x, y in zip(first, second)) / len(first)
+
+
+def band_buckets(signature: list[int]) -> list[int]:
+    """Корзина каждой полосы сигнатуры (знаковое 64-битное число, как BIGINT)"""
+    buckets = []
+    for band in range(SIMILARITY_BANDS):
+        rows = signature[band * _ROWS:(band + 1) * _ROWS]
+        digest = hashlib.blake2b(struct.pack(f"<{len(rows)}Q", *rows), digest_size=8).digest()
+        buckets.append(int.from_bytes(digest, "little", signed=True))
+    return buckets
+
+
+def pack_signature(signature: list[int]) -> bytes:
+    return struct.pack(f"<{len(signature)}Q", *signature)
+
+
+def unpack_signature(data: bytes) -> list[int]:
+    return list(struct.unpack(f"<{len(data) // 8}Q", data))
+
+
+# ---------- индекс ----------
+async def index_submission(session: Session, chat: ChatModel, text: str):
+    """
+    Заменяет сигнатуру и корзины чата сигнатурой нового текста.
+    Изменения добавляются в сессию вызывающего и фиксируются вместе с ней.
+    """
+    # на длинных отчётах это сотни тысяч умножений — не в цикле событий
+    signature = await run_in_threadpool(lambda: minhash(shingles(text)))
+    session.exec(delete(BucketModel).where(BucketModel.chat_id == chat.id))
+    existing = session.get(SignatureModel, chat.id)
+    if signature is None:
+        if existing is not None:
+            session.delete(existing)
+        return
+
+    if existing is None:
+        existing = SignatureModel(chat_id=chat.id, work_id=chat.work_id, signature=b"")
+    existing.work_id = chat.work_id
+    existing.signature = pack_signature(signature)
+    session.add(existing)
+    for band, bucket in enumerate(band_buckets(signature)):
+        session.add(BucketModel(work_id=chat.work_id, band=band, bucket=bucket, chat_id=chat.id))
+    session.flush()
+
+
+def _score(session: Session, pairs: set[tuple[int, int]], threshold: float) -> list[dict]:
+    chat_ids = {chat_id for pair in pairs for chat_id in pair}
+    if not chat_ids:
+        return []
+    signatures = {
+        row.chat_id: unpack_signature(row.signature)
+        for row in session.exec(select(SignatureModel).where(SignatureModel.chat_id.in_(chat_ids))).all()
+    }
+    scored = []
+    for first, second in pairs:
+        if first in signatures and second in signatures:
+            score = similarity(signatures[first], signatures[second])
+            if score >= threshold:
+                scored.append({"chat_ids": (first, second), "similarity": score})
+    scored.sort(key=lambda pair: pair["similarity"], reverse=True)
+    return scored
+
+
+def suspicious_pairs(session: Session, work_id: int, threshold: float = SIMILARITY_THRESHOLD) -> list[dict]:
+    """
+    Пары чатов работы с оценкой сходства не ниже threshold, по убыванию сходства.
+    threshold ниже SIMILARITY_MIN_THRESHOLD поднимается до него: такие пары индекс не находит.
+    """
+    threshold = max(threshold, SIMILARITY_MIN_THRESHOLD)
+    # кандидаты — пары с общей корзиной; соединение идёт по первичному ключу (work_id, band, bucket, chat_id)
+    other = aliased(BucketModel)
+    rows = session.exec(
+        select(BucketModel.chat_id, other.chat_id)
+        .join(other, (other.work_id == BucketModel.work_id) & (other.band == BucketModel.band) & (other.bucket == BucketModel.bucket))
+        .where(BucketModel.work_id == work_id, BucketModel.chat_id < other.chat_id)
+        .distinct()
+    ).all()
+    return _score(session, set(rows), threshold)
+
+
+def similar_to(session: Session, chat_id: int, threshold: float = SIMILARITY_THRESHOLD) -> list[dict]:
+    """Чаты той же работы, похожие на чат chat_id (threshold — как в suspicious_pairs)"""
+    threshold = max(threshold, SIMILARITY_MIN_THRESHOLD)
+    other = aliased(BucketModel)
+    rows = session.exec(
+        select(other.chat_id)
+        .join(other, (other.work_id == BucketModel.work_id) & (other.band == BucketModel.band) & (other.bucket == BucketModel.bucket))
+        .where(BucketModel.chat_id == chat_id, other.chat_id != chat_id)
+        .distinct()
+    ).all()
+    return _score(session, {tuple(sorted((chat_id, other_id))) for other_id in rows}, threshold)
+
+
+# ---------- перестройка индекса ----------
+async def rebuild_index():
+    """Индексирует все чаты с загруженным файлом"""
+    from database import engine
+    from assistant_core import extract_text_cached
+
+    with Session(engine) as session:
+        chat_ids = session.exec(select(ChatModel.id).where(ChatModel.document_sha256.is_not(None), ChatModel.work_id.is_not(None))).all()
+    for chat_id in chat_ids:
+        with Session(engine) as session:
+            chat = session.get(ChatModel, chat_id)
+            try:
+                text = await extract_text_cached(chat.document_sha256, chat.document_name)
+            except RuntimeError as error:
+                print(f"чат {chat_id}: {error}")
+                continue
+            await index_submission(session, chat, text)
+            session.commit()
+    print(f"проиндексировано чатов: {len(chat_ids)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(rebuild_index())
@@ -0,0 +1,202 @@
+"""
+Хранилище файлов (загруженные работы, документы дисциплин) вне базы данных.
+
+Файлы адресуются SHA-256 содержимого: в таблицах остаются только хэш,
+размер и имя, одинаковые файлы хранятся один раз. Запись и чтение идут
+кусками по BLOB_CHUNK_SIZE, файл целиком в памяти не собирается.
+
+Где лежат байты, решает бэкенд (BlobBackend); по умолчанию — каталог на
+локальном диске (BLOB_ROOT). Другой бэкенд регистрируется в BLOB_BACKENDS
+и выбирается через BLOB_BACKEND.
+
+Перенос старых LONGBLOB-столбцов и удаление файлов, на которые больше нет
+ссылок: python migrate_blobs.py
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from io import BytesIO
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterator, NamedTuple, Optional
+
+
+BLOB_BACKEND    = os.getenv("BLOB_BACKEND", "local")
+BLOB_ROOT       = os.getenv("BLOB_ROOT", str(Path(__file__).resolve().parent / "data" / "blobs"))   # для бэкенда local
+BLOB_CHUNK_SIZE = int(os.getenv("BLOB_CHUNK_SIZE", str(1024 * 1024)))        # кусок чтения и записи, байт
+BLOB_SPOOL_SIZE = int(os.getenv("BLOB_SPOOL_SIZE", str(8 * 1024 * 1024)))    # до этого размера файл до записи держится в памяти
+
+
+class BlobRef(NamedTuple):
+    sha256: str
+    size: int
+
+
+class BlobTooLargeError(ValueError):
+    """Файл больше допустимого размера"""
+
+
+class BlobBackend(ABC):
+    """Байты по ключу — SHA-256 содержимого (64 шестнадцатеричных символа)"""
+
+    @abstractmethod
+    def exists(self, key: str) -> bool: ...
+
+    @abstractmethod
+    def size(self, key: str) -> int: ...
+
+    @abstractmethod
+    def open(self, key: str) -> BinaryIO:
+        """Файловый объект для чтения с поддержкой seek; FileNotFoundError, если ключа нет"""
+
+    @abstractmethod
+    def save(self, key: str, file: BinaryIO):
+        """Сохраняет содержимое file с текущей позиции; запись атомарна — читатели не видят половину файла"""
+
+    @abstractmethod
+    def touch(self, key: str):
+        """Обновляет время записи: файл снова нужен, сборщик мусора не должен удалить его раньше ссылки в базе"""
+
+    @abstractmethod
+    def delete(self, key: str): ...
+
+    @abstractmethod
+    def keys(self) -> Iterator[tuple[str, float]]:
+        """Все ключи с временем записи (для сборки мусора)"""
+
+
+class LocalBackend(BlobBackend):
+    """Каталог на диске: root/ab/cd/abcd…; временные файлы — в root/tmp на той же файловой системе"""
+    def __init__(self, root: str = BLOB_ROOT):
+        self.root = Path(root)
+        self._tmp = self.root / "tmp"
+        self._tmp.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        if len(key) != 64 or not all(c in "0123456789abcdef" for c in key):
+            raise ValueError(f"Некорректный ключ файла: {key!r}")
+        return self.root / key[:2] / key[2:4] / key
+
+    def exists(self, key: str) -> bool:
+        return self._path(key).is_file()
+
+    def size(self, key: str) -> int:
+        return self._path(key).stat().st_size
+
+    def open(self, key: str) -> BinaryIO:
+        return open(self._path(key), "rb")
+
+    def save(self, key: str, file: BinaryIO):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self._tmp)
+        try:
+            with os.fdopen(fd, "wb") as out:
+                shutil.copyfileobj(file, out, BLOB_CHUNK_SIZE)
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def touch(self, key: str):
+        os.utime(self._path(key))
+
+    def delete(self, key: str):
+        try:
+            self._path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+    def keys(self) -> Iterator[tuple[str, float]]:
+        for path in self.root.glob("??/??/*"):
+            if len(path.name) == 64:
+                yield path.name, path.stat().st_mtime
+
+
+BLOB_BACKENDS: dict[str, Callable[[], BlobBackend]] = {
+    "local": LocalBackend,
+}
+
+
+class BlobStore:
+    """Контентно-адресуемое хранилище поверх бэкенда"""
+    def __init__(self, backend: BlobBackend, chunk_size: int = BLOB_CHUNK_SIZE):
+        self.backend = backend
+        self.chunk_size = chunk_size
+
+    def put_file(self, file: BinaryIO, max_size: Optional[int] = None) -> BlobRef:
+        """
+        Сохраняет содержимое file (с текущей позиции), читая его кусками.
+        Если такой файл уже есть, второй раз он не записывается.
+        BlobTooLargeError — если файл длиннее max_size байт.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        with tempfile.SpooledTemporaryFile(max_size=BLOB_SPOOL_SIZE) as spool:
+            while chunk := file.read(self.chunk_size):
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise BlobTooLargeError(f"Файл больше {max_size} байт")
+                digest.update(chunk)
+                spool.write(chunk)
+            key = digest.hexdigest()
+            if self.backend.exists(key):
+                self.backend.touch(key)
+            else:
+                spool.seek(0)
+                self.backend.save(key, spool)
+        return BlobRef(key, size)
+
+    def put(self, data: bytes) -> BlobRef:
+        key = hashlib.sha256(data).hexdigest()
+        if self.backend.exists(key):
+            self.backend.touch(key)
+        else:
+            self.backend.save(key, BytesIO(data))
+        return BlobRef(key, len(data))
+
+    def open(self, key: str) -> BinaryIO:
+        return self.backend.open(key)
+
+    def read(self, key: str) -> bytes:
+        with self.backend.open(key) as file:
+            return file.read()
+
+    def iter_chunks(self, key: str, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        """Байты [start, end) кусками по chunk_size; end=None — до конца файла"""
+        with self.backend.open(key) as file:
+            file.seek(start)
+            remaining = None if end is None else end - start
+            while remaining is None or remaining > 0:
+                chunk = file.read(self.chunk_size if remaining is None else min(self.chunk_size, remaining))
+                if not chunk:
+                    return
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def size(self, key: str) -> int:
+        return self.backend.size(key)
+
+    def exists(self, key: str) -> bool:
+        return self.backend.exists(key)
+
+    def collect_garbage(self, referenced: set[str], grace: float = 3600) -> int:
+        """
+        Удаляет файлы, на которые нет ссылок. Файлы моложе grace секунд не трогаются:
+        они могут принадлежать загрузке, ещё не зафиксированной в базе.
+        """
+        deadline = time.time() - grace
+        removed = 0
+        for key, modified in list(self.backend.keys()):
+            if key not in referenced and modified < deadline:
+                self.backend.delete(key)
+                removed += 1
+        return removed
+
+
+blob_store = BlobStore(BLOB_BACKENDS[BLOB_BACKEND]())
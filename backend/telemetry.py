@@ -0,0 +1,265 @@
+"""
+Телеметрия обращений к LLM и этапов проверки работы.
+
+Каждый вызов generate_answer / stream_answer оставляет запись: этап чата
+(ChatStage), бэкенд, токены промпта и ответа, ожидание в очереди, время
+до первого токена и полное время. Отдельно пишутся интервалы этапов
+обработки (извлечение текста, сборка промпта, разбор JSON, ожидание
+фоновой задачи). Записи хранятся в памяти процесса в ограниченном окне
+и агрегируются по запросу (registry.summary, GET /metrics).
+
+Этап задаётся контекстом: with stage(ChatStage.CHECKING_THE_WORK): ...
+— все вызовы LLM внутри, включая параллельные задачи, помечаются им.
+"""
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from typing import Iterator, Optional
+
+
+TELEMETRY_MAX_RECORDS = int(os.getenv("TELEMETRY_MAX_RECORDS", "10000"))   # записей каждого вида в окне
+
+# Метрики вызова LLM, по которым считаются перцентили
+LLM_TIMINGS = ("queue_wait", "ttft", "total")
+
+_current_stage: ContextVar[Optional[str]] = ContextVar("telemetry_stage", default=None)
+_current_call: ContextVar[Optional["LLMCall"]] = ContextVar("telemetry_call", default=None)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class TelemetryRegistry:
+    """Окно последних записей о вызовах LLM и интервалах этапов с агрегацией"""
+    def __init__(self, max_records: int = TELEMETRY_MAX_RECORDS):
+        self._calls: deque[dict] = deque(maxlen=max_records)
+        self._spans: deque[dict] = deque(maxlen=max_records)
+        self._lock = Lock()
+
+    def record_call(self, record: dict):
+        with self._lock:
+            self._calls.append(record)
+
+    def record_span(self, stage: Optional[str], name: str, seconds: float):
+        with self._lock:
+            self._spans.append({"stage": stage, "name": name, "seconds": seconds, "at": time.time()})
+
+    def calls(self, stage: Optional[str] = None, backend: Optional[str] = None, since: Optional[float] = None) -> list[dict]:
+        with self._lock:
+            records = list(self._calls)
+        return [
+            r for r in records
+            if (stage is None or r["stage"] == stage)
+            and (backend is None or r["backend"] == backend)
+            and (since is None or r["at"] >= since)
+        ]
+
+    def spans(self, stage: Optional[str] = None, since: Optional[float] = None) -> list[dict]:
+        with self._lock:
+            records = list(self._spans)
+        return [r for r in records if (stage is None or r["stage"] == stage) and (since is None or r["at"] >= since)]
+
+    def summary(self, stage: Optional[str] = None, backend: Optional[str] = None, since: Optional[float] = None) -> dict:
+        """Агрегаты по группам (этап, бэкенд) для вызовов и (этап, интервал) для интервалов"""
+        groups: dict[tuple, list[dict]] = {}
+        for record in self.calls(stage, backend, since):
+            groups.setdefault((record["stage"], record["backend"]), []).append(record)
+
+        llm = []
+        for (group_stage, group_backend), records in sorted(groups.items(), key=lambda item: tuple(map(str, item[0]))):
+            entry = {
+                "stage": group_stage,
+                "backend": group_backend,
+                "calls": len(records),
+                "cached": sum(r["cached"] for r in records),
+                "errors": sum(r["error"] is not None for r in records),
+                "prompt_tokens": sum(r["prompt_tokens"] or 0 for r in records),
+                "completion_tokens": sum(r["completion_tokens"] or 0 for r in records),
+            }
+            for name in LLM_TIMINGS:
+                values = [r[name] for r in records if r[name] is not None]
+                entry[f"{name}_p50"] = percentile(values, 50)
+                entry[f"{name}_p95"] = percentile(values, 95)
+            llm.append(entry)
+
+        span_groups: dict[tuple, list[float]] = {}
+        if backend is None:
+            for record in self.spans(stage, since):
+                span_groups.setdefault((record["stage"], record["name"]), []).append(record["seconds"])
+        spans = [
+            {
+                "stage": group_stage,
+                "name": name,
+                "count": len(values),
+                "seconds_total": sum(values),
+                "seconds_p50": percentile(values, 50),
+                "seconds_p95": percentile(values, 95),
+            }
+            for (group_stage, name), values in sorted(span_groups.items(), key=lambda item: tuple(map(str, item[0])))
+        ]
+        return {"llm": llm, "spans": spans}
+
+
+registry = TelemetryRegistry()
+
+
+class LLMCall:
+    """Замеры одного обращения к LLM; бэкенды дополняют его через current_call()"""
+    def __init__(self, stage: Optional[str], backend: str):
+        self.stage = stage
+        self.backend = backend
+        self.started = time.perf_counter()
+        self.cached = True            # сбрасывается, если ответ пришлось генерировать
+        self.prompt_tokens: Optional[int] = None
+        self.completion_tokens: Optional[int] = None
+        self.queue_wait: Optional[float] = None
+        self.ttft: Optional[float] = None
+
+    def mark_dequeued(self):
+        """Запрос дождался места (семафор, поток из пула) и начал выполняться"""
+        if self.queue_wait is None:
+            self.queue_wait = time.perf_counter() - self.started
+
+    def mark_first_token(self):
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.started
+
+
+def current_stage() -> Optional[str]:
+    return _current_stage.get()
+
+
+def current_call() -> Optional[LLMCall]:
+    return _current_call.get()
+
+
+@contextmanager
+def stage(value) -> Iterator[None]:
+    """Помечает вызовы LLM и интервалы внутри блока этапом value (ChatStage или строка)"""
+    token = _current_stage.set(getattr(value, "value", value))
+    try:
+        yield
+    finally:
+        _current_stage.reset(token)
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Записывает длительность блока как интервал name текущего этапа"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.record_span(current_stage(), name, time.perf_counter() - start)
+
+
+def finish_call(call: LLMCall, error: Optional[BaseException] = None):
+    """Записывает обращение в реестр"""
+    registry.record_call({
+        "stage": call.stage,
+        "backend": call.backend,
+        "cached": call.cached,
+        "prompt_tokens": call.prompt_tokens,
+        "completion_tokens": call.completion_tokens,
+        "queue_wait": call.queue_wait,
+        "ttft": call.ttft,
+        "total": time.perf_counter() - call.started,
+        "error": f"{type(error).__name__}: {error}" if error is not None else None,
+        "at": time.time(),
+    })
+
+
+@contextmanager
+def llm_call(backend: str) -> Iterator[LLMCall]:
+    """
+    Замер одного обращения к LLM; запись попадает в реестр при выходе из блока.
+    Внутри блока вызов доступен бэкендам через current_call() (в том числе
+    в потоках из пула и в задачах asyncio — контекст копируется).
+    """
+    call = LLMCall(current_stage(), backend)
+    token = _current_call.set(call)
+    error = None
+    try:
+        yield call
+    except BaseException as exc:
+        error = exc
+        raise
+    finally:
+        _current_call.reset(token)
+        finish_call(call, error)
+
+
+def mark_dequeued():
+    call = current_call()
+    if call is not None:
+        call.mark_dequeued()
+
+
+def mark_first_token():
+    call = current_call()
+    if call is not None:
+        call.mark_first_token()
+
+
+def set_backend(backend: str):
+    """Какой бэкенд на самом деле ответил (при хеджировании у каждой попытки своя запись)"""
+    call = current_call()
+    if call is not None:
+        call.backend = backend
+
+
+def adopt_call(source: LLMCall):
+    """
+    Переносит в текущий вызов токены и времена вложенного вызова source
+    (ответ хеджирования). Времена пересчитываются от начала текущего вызова.
+    """
+    call = current_call()
+    if call is None or call is source:
+        return
+    offset = source.started - call.started
+    if call.prompt_tokens is None:
+        call.prompt_tokens = source.prompt_tokens
+    if call.completion_tokens is None:
+        call.completion_tokens = source.completion_tokens
+    if call.queue_wait is None and source.queue_wait is not None:
+        call.queue_wait = offset + source.queue_wait
+    if call.ttft is None and source.ttft is not None:
+        call.ttft = offset + source.ttft
+
+
+def set_tokens(prompt_tokens: Optional[int] = None, completion_tokens: Optional[int] = None):
+    call = current_call()
+    if call is None:
+        return
+    if prompt_tokens is not None:
+        call.prompt_tokens = prompt_tokens
+    if completion_tokens is not None:
+        call.completion_tokens = completion_tokens
+
+
+class FirstTokenTimer:
+    """
+    «Стример» для mdl.generate, который только отмечает время первого токена
+    у вызова, активного при создании (generate вызывает put сначала с промптом).
+    """
+    def __init__(self):
+        self.call = current_call()
+        self._seen_prompt = False
+
+    def put(self, value):
+        if not self._seen_prompt:
+            self._seen_prompt = True
+            return
+        if self.call is not None:
+            self.call.mark_first_token()
+
+    def end(self):
+        pass